@@ -0,0 +1,113 @@
+# wigli benchmarks bench_messages.py
+
+"""
+Measures the memory and access time of chat histories of 10k and 100k
+messages held three ways: a list of WigliMessages as they were before
+they were slotted, a list of slotted WigliMessages, and a
+WigliMessageStore.
+
+    python benchmarks/bench_messages.py
+"""
+
+from argparse import ArgumentParser
+from random import Random
+from sys import exit
+from time import perf_counter, time
+from tracemalloc import get_traced_memory, start, stop
+
+from wigli._wigli_bots import WigliMessage, WigliMessageStore
+
+SIZES = [10_000, 100_000]
+ROLES = ["user", "assistant", "system"]
+WORDS = "the duck dives for food and surfaces a few metres away".split()
+
+
+class DictMessage(object):
+    # WigliMessage as it was, with a __dict__ per instance
+    def __init__(self, content: str, role: str, timestamp: float):
+        self.role = role
+        self.content = content
+        self.timestamp = timestamp
+
+
+def make_contents(size: int, seed: int = 0) -> list:
+    random = Random(seed)
+    return [
+        " ".join(random.choices(WORDS, k=random.randint(5, 80))).encode()
+        for _ in range(size)
+    ]
+
+
+# Each builder decodes its own copy of the contents, as loading an
+# archive would, so every representation pays for the text it holds
+
+
+def build_dict_list(contents: list) -> list:
+    return [
+        DictMessage(content.decode(), ROLES[n % 3], time())
+        for n, content in enumerate(contents)
+    ]
+
+
+def build_slotted_list(contents: list) -> list:
+    return [
+        WigliMessage(content.decode(), ROLES[n % 3], time())
+        for n, content in enumerate(contents)
+    ]
+
+
+def build_store(contents: list) -> WigliMessageStore:
+    store = WigliMessageStore()
+    for n, content in enumerate(contents):
+        store.append(WigliMessage(content.decode(), ROLES[n % 3], time()))
+    return store
+
+
+def measure(build, contents: list) -> tuple:
+    """
+    Returns the bytes the built history keeps allocated, the seconds it
+    took to build and the seconds it takes to read every message.
+    """
+    start()
+    started = perf_counter()
+    messages = build(contents)
+    built = perf_counter() - started
+    size = get_traced_memory()[0]
+    stop()
+
+    started = perf_counter()
+    for message in messages:
+        message.content
+    read = perf_counter() - started
+    return size, built, read
+
+
+def main() -> int:
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", nargs="+", type=int, default=SIZES)
+    args = parser.parse_args()
+
+    builds = [
+        ("list of dict messages", build_dict_list),
+        ("list of slotted messages", build_slotted_list),
+        ("WigliMessageStore", build_store),
+    ]
+    print(
+        f"{'messages':>9} {'representation':26} {'memory':>10} "
+        f"{'per message':>12} {'build':>9} {'read all':>9}"
+    )
+    for size in args.sizes:
+        # The contents themselves are allocated outside the measurement
+        contents = make_contents(size)
+        for name, build in builds:
+            memory, built, read = measure(build, contents)
+            print(
+                f"{size:>9} {name:26} {memory / 2**20:8.1f}MB "
+                f"{memory / size:10.0f} B {built * 1000:7.0f}ms "
+                f"{read * 1000:7.0f}ms"
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
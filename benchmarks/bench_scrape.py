@@ -0,0 +1,116 @@
+# wigli benchmarks bench_scrape.py
+
+"""
+Compares webpage text extraction pipelines over a corpus of saved pages.
+
+For every .html file in the corpus directory, this times the original
+pipeline (html.parser and soup.get_text()) against extract_text() with
+each available tree builder, and counts the tokens each one would spend
+in a summarization prompt.
+
+Save pages to the corpus first, then run the benchmark:
+
+    python benchmarks/bench_scrape.py --save https://en.wikipedia.org/wiki/Duck
+    python benchmarks/bench_scrape.py
+"""
+
+from argparse import ArgumentParser
+from os.path import dirname, join
+from sys import exit
+from time import perf_counter
+from typing import Callable, List
+from urllib.parse import urlparse
+
+from bs4 import BeautifulSoup
+from slugify import slugify
+
+from wigli._wigli_http import WigliHTTP
+from wigli._wigli_tools import (
+    HTML_PARSER,
+    count_tokens,
+    extract_text,
+    list_dir,
+    make_dir,
+)
+
+CORPUS_DIR = join(dirname(__file__), "pages")
+REPEATS = 5
+
+
+def original_pipeline(html: bytes) -> str:
+    return BeautifulSoup(html, "html.parser").get_text()
+
+
+def pipelines() -> List[tuple]:
+    found = [
+        ("get_text", original_pipeline),
+        ("extract html.parser", lambda html: extract_text(html, "html.parser")),
+    ]
+    if HTML_PARSER == "lxml":
+        found.append(("extract lxml", lambda html: extract_text(html, "lxml")))
+    return found
+
+
+def best_time(pipeline: Callable, html: bytes) -> tuple:
+    best = float("inf")
+    for _ in range(REPEATS):
+        start = perf_counter()
+        text = pipeline(html)
+        best = min(best, perf_counter() - start)
+    return best, text
+
+
+def save_pages(urls: List[str], corpus_dir: str):
+    make_dir(corpus_dir)
+    http = WigliHTTP()
+    for url in urls:
+        status, headers, body = http.get(url, max_bytes=None)
+        parsed = urlparse(url if "://" in url else "http://" + url)
+        filename = slugify(parsed.netloc + parsed.path, only_ascii=True)
+        with open(join(corpus_dir, filename + ".html"), "wb") as f:
+            f.write(body)
+        print(f"Saved {url} ({len(body)} bytes, status {status})")
+
+
+def main() -> int:
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--corpus", default=CORPUS_DIR)
+    parser.add_argument("--save", nargs="+", metavar="URL")
+    args = parser.parse_args()
+
+    if args.save:
+        save_pages(args.save, args.corpus)
+        return 0
+
+    pages = sorted(f for f in list_dir(args.corpus) if f.endswith(".html"))
+    if len(pages) == 0:
+        print(f"No .html pages in {args.corpus}, save some with --save")
+        return 1
+
+    names = [name for name, _ in pipelines()]
+    totals = {name: [0.0, 0] for name in names}
+    print(f"{'page':40} " + " ".join(f"{name:>26}" for name in names))
+    for page in pages:
+        with open(join(args.corpus, page), "rb") as f:
+            html = f.read()
+        row = []
+        for name, pipeline in pipelines():
+            seconds, text = best_time(pipeline, html)
+            tokens = count_tokens(text)
+            totals[name][0] += seconds
+            totals[name][1] += tokens
+            row.append(f"{seconds * 1000:9.1f} ms {tokens:8d} tok")
+        print(f"{page[:40]:40} " + " ".join(f"{cell:>26}" for cell in row))
+
+    print(
+        f"{'total':40} "
+        + " ".join(
+            f"{f'{s * 1000:9.1f} ms {t:8d} tok':>26}"
+            for s, t in totals.values()
+        )
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,144 @@
+# wigli benchmarks bench_startup.py
+
+"""
+Measures how long common wigli invocations spend importing modules,
+using python -X importtime, and checks them against the budget in
+startup_budget.json.
+
+Each invocation runs several times in a fresh interpreter against a
+scratch data directory holding one saved chat. The benchmark fails if
+an invocation's median import time is over its budget, or if it imports
+a module its budget forbids.
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --runs 10 --show 15
+"""
+
+from argparse import ArgumentParser
+from json import load
+from os.path import dirname, join
+from shlex import split
+from statistics import median
+from subprocess import run
+from sys import executable, exit
+from tempfile import TemporaryDirectory
+from time import perf_counter, time
+
+BUDGET_FILE = join(dirname(__file__), "startup_budget.json")
+RUNS = 5
+# Runs the CLI the way the console script does, but on a scratch data
+# directory so the user's chats are never touched
+CHILD = (
+    "import sys\n"
+    "from wigli._wigli_cli import wigli_cli\n"
+    "wigli_cli(sys.argv[2:], data_dir=sys.argv[1])\n"
+)
+
+
+def make_data_dir(data_dir: str):
+    import openai
+
+    from wigli import WigliBot
+    from wigli._wigli_data import WigliData
+
+    openai.api_key = "benchmark"
+    data = WigliData(time, data_dir=data_dir)
+    bot = WigliBot(data=data, title="Startup Benchmark")
+    for n in range(20):
+        bot.And({"role": "user", "content": f"Quack {n}"})
+
+
+def parse_importtime(stderr: str) -> tuple:
+    """
+    Returns the microseconds spent importing from the CLI's own first
+    import on, and a dict of each module's cumulative import time.
+    Imports made by the interpreter's startup, like site, are left out.
+    """
+    total = 0
+    started = False
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:") :].split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue  # The header
+        cumulative, name = int(fields[1]), fields[2]
+        top_level = not name[1:].startswith(" ")
+        name = name.strip()
+        started = started or name.startswith("wigli")
+        if not started:
+            continue
+        modules[name] = cumulative
+        if top_level:
+            total += cumulative
+    return total, modules
+
+
+def measure(argv: list, data_dir: str, runs: int) -> tuple:
+    """
+    Returns the median import and wall times in milliseconds, and the
+    modules imported with their cumulative times from the median run.
+    """
+    results = []
+    for _ in range(runs):
+        started = perf_counter()
+        process = run(
+            [executable, "-X", "importtime", "-c", CHILD, data_dir, *argv],
+            capture_output=True,
+            text=True,
+        )
+        wall = perf_counter() - started
+        total, modules = parse_importtime(process.stderr)
+        results.append((total, wall, modules))
+    results.sort(key=lambda result: result[0])
+    total, _, modules = results[len(results) // 2]
+    wall = median(result[1] for result in results)
+    return total / 1000, wall * 1000, modules
+
+
+def main() -> int:
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=RUNS)
+    parser.add_argument(
+        "--show",
+        type=int,
+        default=5,
+        help="how many of the slowest imports to list per invocation",
+    )
+    args = parser.parse_args()
+
+    with open(BUDGET_FILE) as f:
+        budgets = load(f)
+
+    failures = []
+    with TemporaryDirectory() as data_dir:
+        make_data_dir(data_dir)
+        print(f"{'invocation':12} {'imports':>9} {'budget':>9} {'wall':>9}")
+        for invocation, budget in budgets.items():
+            import_ms, wall_ms, modules = measure(
+                split(invocation), data_dir, args.runs
+            )
+            print(
+                f"{invocation:12} {import_ms:7.0f}ms {budget['import_ms']:7}ms "
+                f"{wall_ms:7.0f}ms"
+            )
+            slowest = sorted(modules.items(), key=lambda item: -item[1])
+            for name, cumulative in slowest[: args.show]:
+                print(f"{'':14}{cumulative / 1000:7.1f}ms  {name}")
+            if import_ms > budget["import_ms"]:
+                failures.append(
+                    f"{invocation}: {import_ms:.0f}ms of imports is over "
+                    f"its {budget['import_ms']}ms budget"
+                )
+            for name in budget.get("forbidden", []):
+                if name in modules:
+                    failures.append(f"{invocation}: imported {name}")
+
+    for failure in failures:
+        print(f"Over budget: {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    exit(main())
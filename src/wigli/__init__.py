@@ -1,15 +1,48 @@
 # wigli __init__.py
 
-from wigli._wigli_bots import (
-    WigliMessage,
-    WigliInjection,
-    WigliCommand,
-    WigliBot,
-    OneShotBot,
-    CommandBot,
-)
-
-from wigli._wigli_cli import WigliInvocation, wigli_cli
+from importlib import import_module
+from typing import TYPE_CHECKING
+
+# The public names are imported from their modules on first use, so
+# commands like "wigli -V" don't import the OpenAI client and the other
+# heavy dependencies
+_EXPORTS = {
+    "WigliMessage": "wigli._wigli_bots",
+    "WigliInjection": "wigli._wigli_bots",
+    "WigliCommand": "wigli._wigli_bots",
+    "WigliBot": "wigli._wigli_bots",
+    "OneShotBot": "wigli._wigli_bots",
+    "CommandBot": "wigli._wigli_bots",
+    "WigliInvocation": "wigli._wigli_cli",
+    "wigli_cli": "wigli._wigli_cli",
+}
+
+__all__ = list(_EXPORTS)
+
+if TYPE_CHECKING:
+    from wigli._wigli_bots import (
+        WigliMessage,
+        WigliInjection,
+        WigliCommand,
+        WigliBot,
+        OneShotBot,
+        CommandBot,
+    )
+
+    from wigli._wigli_cli import WigliInvocation, wigli_cli
+
+
+def __getattr__(name: str):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(import_module(_EXPORTS[name]), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
+
 
 NOTES = f"""\
 This command-line toolset implements the \
@@ -1,8 +1,6 @@
 # wigli __main__.py
 
-from sys import exit, argv
-
-from wigli._wigli_cli import wigli_cli
+from wigli._wigli_daemon import main
 
 if __name__ == "__main__":
-    exit(wigli_cli(argv_=argv[1:]))
+    main()
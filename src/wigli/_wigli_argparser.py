@@ -1,9 +1,21 @@
 # wigli _wigli_argparser.py
 
-from argparse import ArgumentParser, RawTextHelpFormatter
+import sys
+
+from argparse import (
+    ArgumentError,
+    ArgumentParser,
+    ArgumentTypeError,
+    RawTextHelpFormatter,
+)
+from datetime import datetime
 from time import time
+from typing import Iterable
 
 from wigli._wigli_tools import contains_any, format_timestamp
+from wigli._wigli_batch import DEFAULT_CONCURRENCY, ORDERS
+from wigli._wigli_usage import USAGE_KEYS
+from wigli._wigli_registry import BUILTIN_PLUGINS, plugin_dest
 from wigli._wigli_version import VERSION
 
 MAX_VERBOSITY = 3
@@ -18,7 +30,39 @@ def contains_any_flagargs(list, flags):
     return False
 
 
-def fetch_args(argv):
+def parse_since(value: str) -> float:
+    """
+    Reads a --since argument, either a Unix timestamp or an ISO 8601 date
+    and time like 2023-04-03 or 2023-04-03T06:05, as a timestamp.
+    """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise ArgumentTypeError(
+            f"expected a timestamp or an ISO 8601 date, not {value!r}"
+        )
+
+
+def parse_usage_keys(value: str) -> tuple:
+    """
+    Reads a --usage argument, a comma-separated list of what to group
+    the usage ledger by.
+    """
+    keys = tuple(key.strip() for key in value.split(",") if key.strip())
+    for key in keys:
+        if key not in USAGE_KEYS:
+            raise ArgumentTypeError(
+                f"can't group usage by {key!r}, choose from "
+                + ", ".join(USAGE_KEYS)
+            )
+    return keys
+
+
+def fetch_args(argv, plugins: Iterable[dict] = BUILTIN_PLUGINS):
     no_prompt_args = [
         "--noprompt",
         # "--transcript",
@@ -29,6 +73,13 @@ def fetch_args(argv):
         "--version",
         "--botcommands",
         "--set-api-key",
+        "--web-cache-stats",
+        "--branches",
+        "--serve",
+        "--batch",
+        "--interactive",
+        "--stats",
+        "--usage",
         # "--audio",
     ]
     no_prompt_flags = [
@@ -40,6 +91,7 @@ def fetch_args(argv):
         "-b",
         "-L",
         "-K",
+        "-I",
         # "-a",
     ]
 
@@ -130,12 +182,6 @@ Visit https://github.com/VulcanicAI/Wigli to learn more.
         action="store_true",
         help="force a fresh instance",
     )
-    parser.add_argument(
-        "-s",
-        "--search",
-        action="store_true",
-        help="enable assistant to use search commands",
-    )
     parser_resume.add_argument(
         "-r",
         "--resume-last",
@@ -173,6 +219,27 @@ Visit https://github.com/VulcanicAI/Wigli to learn more.
         action="store_true",
         help="no chat just print conversation transcript in full",
     )
+    parser.add_argument(
+        "--limit",
+        metavar="N",
+        type=int,
+        default=None,
+        help="only print the last N messages of the transcript",
+    )
+    parser.add_argument(
+        "--since",
+        metavar="TIME",
+        type=parse_since,
+        default=None,
+        help="only print transcript messages, or --stats and --usage records,\nsince a timestamp or ISO date",
+    )
+    parser.add_argument(
+        "--output",
+        metavar="FILE",
+        type=str,
+        default=None,
+        help="write the transcript or batch results to FILE instead of printing them",
+    )
     parser.add_argument(
         "--system",
         type=str,
@@ -203,17 +270,117 @@ Visit https://github.com/VulcanicAI/Wigli to learn more.
         help="erase a given number of messages from the conversation history",
     )
     parser.add_argument(
-        "-x",
-        "--python",
+        "--serve",
         action="store_true",
-        help="enable python interpreter",
+        help="run a daemon that keeps Wigli loaded, so later commands start instantly",
+    )
+    parser.add_argument(
+        "-I",
+        "--interactive",
+        action="store_true",
+        help="chat back and forth in one session, with /help for commands",
+    )
+    parser.add_argument(
+        "--batch",
+        metavar="FILE",
+        type=str,
+        default=None,
+        help="run each prompt in a JSON lines file (- for stdin) in a new chat\nand print each result as a JSON line",
+    )
+    parser.add_argument(
+        "--concurrency",
+        metavar="N",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help=f"how many batch prompts to run at once (default {DEFAULT_CONCURRENCY})",
     )
     parser.add_argument(
-        "-P",
-        "--professor",
+        "--order",
+        choices=ORDERS,
+        default="input",
+        help="print batch results in the order of the prompts, or as they finish",
+    )
+    parser.add_argument(
+        "--lean",
         action="store_true",
-        help="summon the professor",
+        help="don't save batch prompts as chats, skipping titles and transcripts",
     )
+    parser.add_argument(
+        "--rate",
+        metavar="N",
+        type=float,
+        default=None,
+        help="send at most N requests to OpenAI a minute",
+    )
+    parser.add_argument(
+        "--python-memory",
+        metavar="MB",
+        type=int,
+        default=None,
+        help="let --python code use at most MB megabytes of data memory\n(default 4096)",
+    )
+    parser.add_argument(
+        "--branches",
+        action="store_true",
+        help="list the branches that erasing and retrying made in the chat",
+    )
+    parser.add_argument(
+        "--branch",
+        metavar="N",
+        type=int,
+        default=None,
+        help="switch the chat to branch N before chatting",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="print latency and throughput percentiles of past completions\nby model and bot",
+    )
+    parser.add_argument(
+        "--usage",
+        metavar="BY",
+        nargs="?",
+        const=("day", "model"),
+        type=parse_usage_keys,
+        default=None,
+        help=f"print the tokens spent, grouped by a comma-separated list of\n{', '.join(USAGE_KEYS)} (default day,model)",
+    )
+    parser.add_argument(
+        "--budget",
+        metavar="N",
+        type=int,
+        default=None,
+        help="stop before this command's requests spend more than N tokens",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="print how long each phase of the command took",
+    )
+    parser.add_argument(
+        "--web-cache-stats",
+        action="store_true",
+        help="print statistics for the cache of downloaded webpages",
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="ignore cached web search and URL summary results",
+    )
+    for plugin in plugins:
+        try:
+            parser.add_argument(
+                *plugin["flags"],
+                action="store_true",
+                dest=plugin_dest(plugin),
+                help=plugin["description"],
+            )
+        except ArgumentError as e:
+            # A plugin can't shadow a core flag or another plugin
+            print(
+                f"[WARNING: PLUGIN {plugin['name']} WAS SKIPPED: {e}]",
+                file=sys.stderr,
+            )
     parser.add_argument(
         "-f",
         "--fileprompt",
@@ -237,12 +404,12 @@ Visit https://github.com/VulcanicAI/Wigli to learn more.
         action="store_true",
         help=f"interpret prompt as a Python function and invoke the headless DocTest bot",
     )
-    # parser.add_argument(
-    #     "-L",
-    #     "--list-installed-plugins",
-    #     action="store_true",
-    #     help=f"list installed plugins",
-    # )
+    parser.add_argument(
+        "-L",
+        "--list-installed-plugins",
+        action="store_true",
+        help=f"list installed plugins",
+    )
     # parser.add_argument(
     #     "--list-plugins",
     #     action="store_true",
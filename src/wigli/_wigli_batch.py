@@ -0,0 +1,242 @@
+# wigli _wigli_batch.py
+
+from json import dumps, loads
+from threading import Lock, Semaphore
+from time import perf_counter, time
+from typing import IO, Iterable, Iterator, TYPE_CHECKING
+
+from wigli._wigli_bots import WigliBot, WigliMessage, WigliWorkerPool
+from wigli._wigli_registry import WigliPluginRegistry
+from wigli._wigli_usage import usage_context
+
+if TYPE_CHECKING:
+    from wigli._wigli_data import WigliData
+
+DEFAULT_CONCURRENCY = 4
+ORDERS = ("input", "completion")
+# How many items may be read ahead of the ones running, per worker
+READ_AHEAD = 2
+
+
+def read_batch(lines: Iterable[str]) -> Iterator[dict]:
+    """
+    Reads the prompts in a batch file, one per line, skipping blank lines.
+
+    Each line is either a JSON string, the prompt, or a JSON object with
+    a "prompt" and optionally an "id" to identify its result, a "system"
+    prompt to inject first, a "model" and a list of "plugins" by name or
+    flag. A line that can't be read becomes an item with an "error".
+
+    Yields
+    ------
+    dict
+        The item, with its "index" among the items.
+    """
+    index = 0
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        item = {"index": index}
+        index += 1
+        try:
+            value = loads(line)
+        except ValueError as e:
+            item["error"] = f"[ERROR: LINE {number} IS NOT JSON: {e}]"
+            yield item
+            continue
+        if isinstance(value, str):
+            value = {"prompt": value}
+        if not isinstance(value, dict) or not isinstance(
+            value.get("prompt"), str
+        ):
+            item["error"] = f"[ERROR: LINE {number} HAS NO PROMPT]"
+            yield item
+            continue
+        plugins = value.get("plugins", [])
+        if isinstance(plugins, str):
+            plugins = [plugins]
+        item.update(
+            id=value.get("id"),
+            prompt=value["prompt"],
+            system=value.get("system"),
+            model=value.get("model"),
+            plugins=list(plugins),
+        )
+        yield item
+
+
+class WigliBatch(object):
+    """
+    Runs a batch of prompts, each in a new chat, a few at a time, and
+    writes a JSON line with each one's result.
+
+    Every request waits on the process's rate limiter, so a batch can be
+    kept under an account's limits with set_rate_limit.
+
+    Attributes
+    ----------
+    data: WigliData
+        Where chats are saved and the API key is loaded from.
+    plugins: WigliPluginRegistry
+        The installed plugins items can ask for.
+    out: IO
+        Where result lines are written.
+    concurrency: int
+        How many prompts run at once.
+    order: str
+        "input" to write results in the order of the prompts, holding
+        back results that finish early, or "completion" to write each
+        result as soon as it's ready.
+    lean: bool
+        Don't save the items as chats, so they aren't titled and have no
+        transcripts. Only the result lines are kept, and the items'
+        requests are still recorded in the usage ledger and metrics.
+    system: str
+        A system prompt for items that don't give their own.
+    default_plugins: List[str]
+        Plugins added to every item.
+    """
+
+    def __init__(
+        self,
+        data: "WigliData",
+        plugins: WigliPluginRegistry,
+        out: IO,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        order: str = "input",
+        lean: bool = False,
+        system: str | None = None,
+        default_plugins: Iterable[str] = (),
+    ):
+        if order not in ORDERS:
+            raise ValueError(f"order must be one of {ORDERS}, not {order!r}")
+        self.data = data
+        self.plugins = plugins
+        self.out = out
+        self.concurrency = max(1, concurrency)
+        self.order = order
+        self.lean = lean
+        self.system = system
+        self.default_plugins = list(default_plugins)
+
+        self._out_lock = Lock()
+        self._plugins_lock = Lock()
+        self._stamp_lock = Lock()
+        self._last_stamp = 0.0
+        self._pending = {}
+        self._next = 0
+        self._failed = 0
+
+    def run(self, lines: Iterable[str]) -> dict:
+        """
+        Runs every prompt in a batch file's lines and writes the results.
+
+        Items are read as workers free up, so a long batch file is never
+        held in memory all at once.
+
+        Returns
+        -------
+        dict
+            The number of "items" run, how many "failed" and the
+            "seconds" the batch took.
+        """
+        started = perf_counter()
+        slots = Semaphore(self.concurrency * READ_AHEAD)
+
+        def on_result(index: int, result: tuple):
+            record, e = result
+            if e is not None:
+                record = self._record({"index": index}, error=e)
+            self._write(record)
+            slots.release()
+
+        pool = WigliWorkerPool(self.concurrency, on_result=on_result)
+        count = 0
+        for item in read_batch(lines):
+            slots.acquire()
+            pool.submit(item["index"], self._run_item, item)
+            count += 1
+        pool.join()
+        return {
+            "items": count,
+            "failed": self._failed,
+            "seconds": round(perf_counter() - started, 3),
+        }
+
+    def _record(self, item: dict, **fields) -> dict:
+        record = {
+            "index": item["index"],
+            "id": item.get("id"),
+            "prompt": item.get("prompt"),
+            "response": None,
+            "error": item.get("error"),
+            "seconds": 0.0,
+        }
+        record.update(fields)
+        if isinstance(record["error"], BaseException):
+            e = record["error"]
+            record["error"] = f"[ERROR: {type(e).__name__.upper()}: {e}]"
+        return record
+
+    def _run_item(self, item: dict) -> dict:
+        if item.get("error") is not None:
+            return self._record(item)
+        started = perf_counter()
+        try:
+            response = self._chat(item)
+        except Exception as e:
+            return self._record(
+                item, error=e, seconds=round(perf_counter() - started, 3)
+            )
+        seconds = round(perf_counter() - started, 3)
+        if response in (WigliBot.KEY_ERR_MSG, WigliBot.EMPTY_MSG):
+            return self._record(item, error=response, seconds=seconds)
+        return self._record(item, response=response, seconds=seconds)
+
+    def _birthstamp(self) -> float:
+        # Each item's chat is saved under its own birthstamp, so two items
+        # started in the same instant mustn't share one
+        with self._stamp_lock:
+            self._last_stamp = max(time(), self._last_stamp + 1e-6)
+            return self._last_stamp
+
+    def _chat(self, item: dict) -> str:
+        bot = WigliBot(
+            data=self.data, stream=False, birthstamp=self._birthstamp()
+        )
+        if self.lean:
+            # The data directory was only needed to find the API key
+            bot.data = None
+
+        for name_or_flag in self.default_plugins + item["plugins"]:
+            name = self.plugins.find(name_or_flag)
+            if name is None:
+                raise LookupError(f"no plugin named {name_or_flag}")
+            # Loading a plugin and recording its keywords share state
+            with self._plugins_lock:
+                bot = self.plugins.apply(name, bot)
+
+        system = item["system"] if item["system"] is not None else self.system
+        if system is not None:
+            bot.Inject([WigliMessage(system, "system")])
+
+        kwargs = {} if item["model"] is None else {"model": item["model"]}
+        # Lean items are still charged to the data directory's ledger
+        with usage_context(data=self.data, birthstamp=bot.birthstamp):
+            return bot.Chat(item["prompt"], **kwargs)
+
+    def _write(self, record: dict):
+        with self._out_lock:
+            if record["error"] is not None:
+                self._failed += 1
+            if self.order == "completion":
+                self._emit(record)
+                return
+            self._pending[record["index"]] = record
+            while self._next in self._pending:
+                self._emit(self._pending.pop(self._next))
+                self._next += 1
+
+    def _emit(self, record: dict):
+        self.out.write(dumps(record) + "\n")
+        self.out.flush()
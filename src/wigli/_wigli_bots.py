@@ -1,20 +1,36 @@
 # wigli wigli_bots.py
 
-import openai
-
+from array import array
+from collections.abc import MutableSequence
+from contextlib import contextmanager
 from copy import deepcopy
-from dotenv import load_dotenv
-from json import load
+from hashlib import blake2b
+from inspect import signature
+from json import dumps, load
 from os import getenv
 from os.path import join
-from slugify import slugify
-from time import time
-from typing import Any, Callable, Iterable, List, TYPE_CHECKING
-
+from re import compile, escape
+from sys import intern
+from threading import Condition, Event, Lock, Thread, local
+from time import monotonic, perf_counter, sleep, time
+from typing import Any, Callable, Generator, Iterable, List, TYPE_CHECKING
+from uuid import uuid4
+
+from wigli._wigli_profile import profiled, record, span
+from wigli._wigli_usage import (
+    WigliTokenBudget,
+    bind_usage,
+    current_usage,
+    estimate_cost,
+    get_token_budget,
+    usage_context,
+)
 from wigli._wigli_tools import (
     clamp,
+    count_text_tokens,
     count_tokens,
     format_timestamp,
+    percentile,
     plural,
     pluralize,
 )
@@ -22,10 +38,27 @@ from wigli._wigli_tools import (
 if TYPE_CHECKING:
     from wigli._wigli_data import WigliData
 
+# openai, dotenv and slugify are imported where they're used, so that
+# loading and listing chats doesn't import the OpenAI client
+
 MAX_COMMANDS = 8
+MAX_COMMAND_WORKERS = 4
+CMD_TIMEOUT = 60
+TURN_TIMEOUT = 5 * 60
+CMD_CACHE_TTL = 60 * 60
+CMD_CACHE_SIZE = 64
 DEFAULT_TEMPERATURE = 1
 MAX_TOKENS = 2**12
 CH_PER_TOK = 4
+# Forks of forks deeper than this are flattened into one list
+MAX_HISTORY_DEPTH = 16
+# Times a chat request turned away for going over the rate limit is
+# retried, waiting RATE_LIMIT_BACKOFF seconds and then twice as long
+RATE_LIMIT_RETRIES = 3
+RATE_LIMIT_BACKOFF = 2
+
+# Whether bots encoded in this thread leave their messages in their tree
+_archiving = local()
 
 
 def format_message(
@@ -80,14 +113,34 @@ def assert_type(
             raise error(msg)
         else:
             raise error(
-                f"""{name} must be of type {" or ".join(expected_types)}"""
+                f"""{name} must be of type {" or ".join(t.__name__ for t in expected_types)}"""
             )
 
 
+def _init_params(cls: type) -> set:
+    """
+    Returns the names of the keyword arguments a class's constructors
+    accept, across its base classes.
+    """
+    params = set()
+    for base in cls.__mro__:
+        init = base.__dict__.get("__init__")
+        if init is None:
+            continue
+        for param in signature(init).parameters.values():
+            if param.kind in (param.POSITIONAL_OR_KEYWORD, param.KEYWORD_ONLY):
+                params.add(param.name)
+    return params
+
+
 ## Objects
 
 
 class WigliMessage(object):
+    # No per-message __dict__, and every message with the same role
+    # shares one role string
+    __slots__ = ("role", "content", "timestamp")
+
     def __init__(
         self,
         message: str | dict = None,
@@ -101,12 +154,12 @@ class WigliMessage(object):
         if isinstance(message, dict):
             temp_role = message.get("role")
             if isinstance(temp_role, str):
-                self.role = temp_role
+                self.role = intern(temp_role)
             message = message.get("content")
         if isinstance(message, str):
             self.content = message
         if isinstance(role, str):
-            self.role = role
+            self.role = intern(role)
         if isinstance(timestamp, float):
             self.timestamp = timestamp
         if self.timestamp is None:
@@ -131,6 +184,311 @@ class WigliMessage(object):
         return [("role", self.role), ("content", self.content)]
 
 
+class WigliMessageStore(MutableSequence):
+    """
+    A list of WigliMessages kept as parallel arrays, for chats too long
+    to hold as one object per message. Each message is a role id, a
+    timestamp and the start of its content in one shared UTF-8 buffer.
+
+    Messages are built from the arrays when they are read, so changing a
+    message taken from the store doesn't change the store. Assign the
+    changed message back instead. Appending, and removing or slicing
+    from the end, are fast. Changes anywhere else rebuild the arrays.
+
+    Attributes
+    ----------
+    roles: list
+        Every role seen so far, indexed by role id.
+    role_ids: array
+        The role id of each message.
+    timestamps: array
+        The timestamp of each message.
+    offsets: array
+        Where each message's content starts in the buffer, followed by
+        the end of the last message's content.
+    buffer: bytearray
+        The content of every message, encoded as UTF-8.
+    """
+
+    def __init__(self, messages: Iterable[WigliMessage | dict] = ()):
+        self.clear()
+        self.extend(messages)
+
+    def clear(self):
+        self.roles = []
+        self.role_ids = array("H")
+        self.timestamps = array("d")
+        self.offsets = array("Q", [0])
+        self.buffer = bytearray()
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def _message(self, n: int) -> WigliMessage:
+        message = WigliMessage.__new__(WigliMessage)
+        message.role = self.roles[self.role_ids[n]]
+        message.content = self.buffer[
+            self.offsets[n] : self.offsets[n + 1]
+        ].decode()
+        message.timestamp = self.timestamps[n]
+        return message
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self._message(n)
+
+    def __getitem__(self, index: int | slice):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return WigliMessageStore(
+                    self._message(n) for n in range(start, stop, step)
+                )
+            store = WigliMessageStore()
+            stop = max(start, stop)
+            store.roles = list(self.roles)
+            store.role_ids = self.role_ids[start:stop]
+            store.timestamps = self.timestamps[start:stop]
+            base = self.offsets[start]
+            store.offsets = array(
+                "Q", (offset - base for offset in self.offsets[start : stop + 1])
+            )
+            store.buffer = self.buffer[base : self.offsets[stop]]
+            return store
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("message index out of range")
+        return self._message(index)
+
+    def __setitem__(self, index: int | slice, value):
+        messages = list(self)
+        messages[index] = value
+        self._rebuild(messages)
+
+    def __delitem__(self, index: int | slice):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+        else:
+            start = index + len(self) if index < 0 else index
+            if not 0 <= start < len(self):
+                raise IndexError("message index out of range")
+            stop, step = start + 1, 1
+        if step == 1 and stop >= len(self):
+            # Trimming the end only needs the arrays cut short
+            if start < stop:
+                del self.role_ids[start:]
+                del self.timestamps[start:]
+                del self.buffer[self.offsets[start] :]
+                del self.offsets[start + 1 :]
+            return
+        messages = list(self)
+        del messages[index]
+        self._rebuild(messages)
+
+    def insert(self, index: int, value: WigliMessage | dict | str):
+        if index >= len(self):
+            self.append(value)
+            return
+        messages = list(self)
+        messages.insert(index, value)
+        self._rebuild(messages)
+
+    def append(self, value: WigliMessage | dict | str):
+        message = format_message(value)
+        try:
+            role_id = self.roles.index(message.role)
+        except ValueError:
+            role_id = len(self.roles)
+            self.roles.append(intern(message.role))
+        self.role_ids.append(role_id)
+        self.timestamps.append(message.timestamp)
+        self.buffer += message.content.encode()
+        self.offsets.append(len(self.buffer))
+
+    def _rebuild(self, messages: List[WigliMessage]):
+        self.clear()
+        self.extend(messages)
+
+    def __getstate__(self) -> dict:
+        # Archived as plain messages, like a list
+        return {"messages": list(self)}
+
+    def __setstate__(self, state: dict):
+        self.__init__(state.get("messages", []))
+
+    def __repr__(self) -> str:
+        return f"WigliMessageStore({list(self)!r})"
+
+
+class WigliHistory(MutableSequence):
+    """
+    A bot's message history, forkable in constant time.
+
+    A history is its own list of messages appended to the first
+    parent_len messages of a parent. Parents are frozen, so forking a
+    history freezes what it has so far into a new parent that the fork
+    and the original both build on, without copying any messages.
+    Trimming the end only shortens the view of the parent. Changes
+    further back copy the messages into the history's own list first.
+
+    Attributes
+    ----------
+    parent: WigliHistory
+        The frozen history this one extends, or None.
+    parent_len: int
+        How many of the parent's messages come first in this history.
+    own: list
+        The messages added since the last fork.
+    """
+
+    def __init__(
+        self,
+        messages: Iterable[WigliMessage] = (),
+        parent: "WigliHistory | None" = None,
+        parent_len: int = 0,
+    ):
+        self.parent = parent
+        self.parent_len = parent_len
+        self.own = list(messages)
+
+    def __len__(self) -> int:
+        return self.parent_len + len(self.own)
+
+    def _segments(self) -> List[tuple]:
+        # (messages, how many of them are in this history), oldest first
+        segments = [(self.own, len(self.own))]
+        history, limit = self.parent, self.parent_len
+        while history is not None and limit > 0:
+            segments.append((history.own, limit - history.parent_len))
+            history, limit = history.parent, min(limit, history.parent_len)
+        return segments[::-1]
+
+    def __iter__(self):
+        for messages, count in self._segments():
+            for n in range(max(0, count)):
+                yield messages[n]
+
+    def __getitem__(self, index: int | slice):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if start == 0 and step == 1:
+                # A prefix shares this history's messages
+                stop = max(0, stop)
+                base = self.fork()
+                base.parent_len = min(base.parent_len, stop)
+                return base
+            return WigliHistory(list(self)[index])
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("message index out of range")
+        history = self
+        while index < history.parent_len:
+            history = history.parent
+        return history.own[index - history.parent_len]
+
+    def _unshare(self):
+        self.own = list(self)
+        self.parent = None
+        self.parent_len = 0
+
+    def __setitem__(self, index: int | slice, value):
+        if not isinstance(index, slice):
+            n = index + len(self) if index < 0 else index
+            if self.parent_len <= n < len(self):
+                self.own[n - self.parent_len] = value
+                return
+        self._unshare()
+        self.own[index] = value
+
+    def __delitem__(self, index: int | slice):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+        else:
+            start = index + len(self) if index < 0 else index
+            if not 0 <= start < len(self):
+                raise IndexError("message index out of range")
+            stop, step = start + 1, 1
+        if step == 1 and stop >= len(self):
+            # Trimming the end never touches the shared messages
+            if start < self.parent_len:
+                self.own = []
+                self.parent_len = max(0, start)
+            elif start < stop:
+                del self.own[start - self.parent_len :]
+            return
+        self._unshare()
+        del self.own[index]
+
+    def insert(self, index: int, value: WigliMessage):
+        if index < 0:
+            index = max(0, index + len(self))
+        if index < self.parent_len:
+            self._unshare()
+            self.own.insert(index, value)
+        else:
+            self.own.insert(index - self.parent_len, value)
+
+    def append(self, value: WigliMessage):
+        self.own.append(value)
+
+    def depth(self) -> int:
+        depth = 0
+        history = self.parent
+        while history is not None:
+            depth += 1
+            history = history.parent
+        return depth
+
+    def fork(self) -> "WigliHistory":
+        """
+        Returns a new history with the same messages that can be changed
+        without affecting this one, and vice versa.
+        """
+        if self.depth() >= MAX_HISTORY_DEPTH:
+            # Long chains of forks make indexing slow, flatten them
+            self._unshare()
+        if len(self.own) > 0:
+            frozen = WigliHistory(
+                parent=self.parent, parent_len=self.parent_len
+            )
+            # Nothing appends to a frozen history, so the list is shared
+            frozen.own = self.own
+            self.parent = frozen
+            self.parent_len = len(frozen)
+            self.own = []
+        return WigliHistory(parent=self.parent, parent_len=self.parent_len)
+
+    def __getstate__(self) -> dict:
+        # Archived as plain messages, like a list
+        return {"messages": list(self)}
+
+    def __setstate__(self, state: dict):
+        self.__init__(state.get("messages", []))
+
+    def __repr__(self) -> str:
+        return f"WigliHistory({list(self)!r})"
+
+
+def _message_key(message: WigliMessage) -> tuple:
+    return (message.role, message.content, message.timestamp)
+
+
+def fork_messages(
+    messages: Iterable[WigliMessage],
+) -> "WigliHistory | WigliMessageStore":
+    """
+    Returns a copy of a bot's messages to give to a new bot, sharing the
+    messages themselves wherever possible.
+    """
+    if isinstance(messages, WigliHistory):
+        return messages.fork()
+    if isinstance(messages, WigliMessageStore):
+        return messages[:]
+    return WigliHistory(messages)
+
+
 class WigliInjection(object):
     def __init__(
         self,
@@ -159,12 +517,12 @@ class WigliInjection(object):
         self.reminder_period = reminder_period
         self.reminder_messages = reminder_messages
 
-        if self.reminder_messages is None:
-            return
+        if self.reminder_messages is not None:
+            self.reminder_messages = format_messages(
+                self.reminder_messages
+            )
 
-        self.reminder_messages = format_messages(
-            self.reminder_messages
-        )
+        self._digest = self._make_digest()
 
     def do_reminder_tick(self):
         self.reminder_timer += 1
@@ -173,15 +531,63 @@ class WigliInjection(object):
             return self.reminder_messages
         return []
 
+    # Archives from before digests were cached don't have one
+    _digest = None
+
+    def _make_digest(self) -> bytes:
+        digest = blake2b(digest_size=16)
+        for messages in (self.injection_messages, self.reminder_messages):
+            for msg in messages or []:
+                digest.update(msg.role.encode() + b"\0")
+                digest.update(msg.content.encode() + b"\0")
+            digest.update(b"\1")
+        return digest.digest()
+
+    def digest(self) -> bytes:
+        """
+        Identifies the injection by the roles and contents of its
+        messages, ignoring their timestamps. Computed once, so the
+        messages shouldn't be changed after construction.
+        """
+        if self._digest is None:
+            self._digest = self._make_digest()
+        return self._digest
+
     def __hash__(self):
-        return hash(
-            "\n".join(
-                [str(msg) for msg in self.injection_messages]
-            )
-        )
+        return hash(self.digest())
+
+    def __eq__(self, other):
+        if not isinstance(other, WigliInjection):
+            return NotImplemented
+        return self.digest() == other.digest()
+
+    def __getstate__(self) -> dict:
+        # The digest is recomputed rather than archived
+        state = dict(self.__dict__)
+        state.pop("_digest", None)
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
 
 
 class WigliCommand(WigliInjection):
+    # Whether invocations may run on the CommandBot's worker pool
+    # alongside other commands. Interactive commands should opt out.
+    concurrent = True
+    # String(s) ending an invocation's span. None means the span runs
+    # until the next command keyword or the end of the message.
+    terminator = None
+    # Whether all spans in a message are joined and parsed as one call
+    batch = False
+    # Whether results may be reused for repeated calls with equal arguments
+    cacheable = False
+    # Maps an invocation's arg to what makes calls equal for the cache,
+    # or None to compare the arg's messages exactly
+    cache_key = None
+    # Seconds an invocation may run before it is abandoned, or None
+    timeout = CMD_TIMEOUT
+
     def __init__(
         self,
         cmd: dict,
@@ -198,6 +604,165 @@ class WigliCommand(WigliInjection):
         parse_function = cmd.get("parse_function")
         assert_type(parse_function, "parse", Callable)
         self.parse = parse_function
+        concurrent = cmd.get("concurrent", True)
+        assert_type(concurrent, "concurrent", bool)
+        self.concurrent = concurrent
+        terminator = cmd.get("terminator", None)
+        assert_type(
+            terminator, "terminator", [str, list, tuple, type(None)]
+        )
+        if isinstance(terminator, str):
+            terminator = (terminator,)
+        self.terminator = terminator
+        batch = cmd.get("batch", False)
+        assert_type(batch, "batch", bool)
+        self.batch = batch
+        cacheable = cmd.get("cacheable", False)
+        assert_type(cacheable, "cacheable", bool)
+        self.cacheable = cacheable
+        cache_key = cmd.get("cache_key", None)
+        assert_type(cache_key, "cache_key", [Callable, type(None)])
+        self.cache_key = cache_key
+        timeout = cmd.get("timeout", CMD_TIMEOUT)
+        assert_type(timeout, "timeout", [int, float, type(None)])
+        self.timeout = timeout
+        self._digest = self._make_digest()
+
+    def _make_digest(self) -> bytes:
+        # Commands with the same prompts but different keywords differ
+        keyword = getattr(self, "keyword", "")
+        return blake2b(
+            keyword.encode() + b"\0" + super()._make_digest(),
+            digest_size=16,
+        ).digest()
+
+
+def query_cache_key(arg: dict) -> str:
+    """
+    A cache_key for commands taking a free-text query, so trivially
+    different calls, like search_web("Rust") and search_web( rust ),
+    share a cache key. Only the quotes around the whole query are
+    dropped, since quotes inside it can change what it finds.
+    """
+    query = " ".join((arg.get("messages") or [""])[0].split())
+    return query.strip('"').strip("'").casefold()
+
+
+class WigliCommandCache(object):
+    """
+    A least-recently-used cache of command results, archived with the
+    chat it belongs to.
+
+    Attributes
+    ----------
+    ttl: float
+        How many seconds a result stays fresh.
+    size: int
+        The maximum number of results to keep.
+    entries: dict
+        Maps cache keys to (timestamp, results), least recently used first.
+    """
+
+    def __init__(
+        self, ttl: float = CMD_CACHE_TTL, size: int = CMD_CACHE_SIZE
+    ):
+        self.ttl = ttl
+        self.size = size
+        self.entries = {}
+
+    @staticmethod
+    def make_key(cmd: WigliCommand, arg: dict) -> str:
+        cache_key = getattr(cmd, "cache_key", None)
+        if cache_key is None:
+            key = arg.get("messages", [])
+        else:
+            key = cache_key(arg)
+        return cmd.keyword + "\n" + dumps(key)
+
+    def get(self, key: str) -> List[WigliMessage] | None:
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        timestamp, results = entry
+        if time() - timestamp > self.ttl:
+            return None
+        self.entries[key] = entry
+        # Fresh copies so the archived history gets current timestamps
+        return [WigliMessage(msg.content, msg.role) for msg in results]
+
+    def put(self, key: str, results: List[WigliMessage]):
+        self.entries.pop(key, None)
+        self.entries[key] = (time(), results)
+        while len(self.entries) > self.size:
+            del self.entries[next(iter(self.entries))]
+
+    def clear(self):
+        self.entries = {}
+
+
+class WigliCommandMatcher(object):
+    """
+    Finds the invocations of a set of commands in a message with a
+    single scan over one combined keyword pattern.
+
+    Attributes
+    ----------
+    cmds: frozenset
+        The commands this matcher was built for.
+    """
+
+    def __init__(self, cmds: Iterable[WigliCommand]):
+        self.cmds = frozenset(cmds)
+        self.by_keyword = {cmd.keyword: cmd for cmd in self.cmds}
+        # Longest keywords first so a keyword that prefixes another
+        # doesn't shadow it
+        keywords = sorted(self.by_keyword, key=len, reverse=True)
+        self.pattern = (
+            compile("|".join(escape(k) for k in keywords))
+            if len(keywords) > 0
+            else None
+        )
+
+    def find(self, msg: str) -> List[tuple]:
+        """
+        Returns the span of every command invocation in a message.
+
+        Keywords inside an earlier invocation's span, such as a
+        search_web( call written inside a Python code block, are skipped.
+
+        Parameters
+        ----------
+        msg: str
+            The message to scan.
+
+        Returns
+        -------
+        list
+            (start, end, WigliCommand) tuples in order of appearance.
+        """
+        if self.pattern is None:
+            return []
+        matches = list(self.pattern.finditer(msg))
+        spans = []
+        span_end = 0
+        for n, match in enumerate(matches):
+            if match.start() < span_end:
+                continue
+            cmd = self.by_keyword[match.group()]
+            if cmd.terminator is None:
+                span_end = (
+                    matches[n + 1].start()
+                    if n + 1 < len(matches)
+                    else len(msg)
+                )
+            else:
+                span_end = len(msg)
+                for terminator in cmd.terminator:
+                    end = msg.find(terminator, match.end())
+                    if 0 <= end < span_end:
+                        span_end = end + len(terminator)
+            spans.append((match.start(), span_end, cmd))
+        return spans
 
 
 class WigliBot(object):
@@ -207,6 +772,7 @@ class WigliBot(object):
     EMPTY_MSG = "[ERROR: NO PROMPT]"
     KEY_ERR_MSG = "[ERROR: NO OPENAI API KEY]"
     TIMEOUT_MSG = f"[ERROR: OPENAI FAILED TO RESPOND FOR {TIMEOUT} SECONDS]"
+    BUDGET_MSG = "[ERROR: TOKEN BUDGET OF {limit} REACHED]"
 
     def __init__(
         self,
@@ -220,13 +786,17 @@ class WigliBot(object):
         prompt: str | None = None,
         title: str | None = None,
         filename: str | None = None,
-        birthstamp: float = time(),
+        birthstamp: float | None = None,
         touchstamp: float | None = None,
         stream: bool = True,
         reminders: set | None = set(),
+        compact: bool = False,
+        branch: int | None = None,
     ):
         # Default class attribute values
-        self.messages = []
+        self.compact = compact
+        self.branch = branch
+        self.messages = WigliMessageStore() if compact else WigliHistory()
         self.reminders = reminders
         self.stream = stream
 
@@ -236,37 +806,113 @@ class WigliBot(object):
 
         self.title = title
         self.filename = filename
-        self.birthstamp = birthstamp
+        self.birthstamp = time() if birthstamp is None else birthstamp
         self.touchstamp = (
             self.birthstamp
             if touchstamp is None
             else touchstamp
         )
 
+        import openai
+        from dotenv import load_dotenv
+
         if openai.api_key is None:
             self.log("No openai.api_key found")
             self.log("Attempting load_dotenv()")
             load_dotenv()
             openai.api_key = getenv("OPENAI_API_KEY")
 
-        if openai.api_key is None:
+        if openai.api_key is None and self.data is not None:
             self.log("No openai.api_key found")
             dotenv_path = join(self.data.data_dir, ".env")
             self.log(f"Attempting load_dotenv(dotenv_path={dotenv_path})")
             load_dotenv(dotenv_path=dotenv_path)
             openai.api_key = getenv("OPENAI_API_KEY")
 
-        if messages is not None:
+        if isinstance(messages, WigliHistory) and not compact:
+            # Forked histories are adopted, not copied
+            self.messages = messages
+        elif messages is not None:
             self.Inject(messages)
         if prompt is not None:
             self.Inject(prompt)
 
+    def __getstate__(self):
+        # Histories are archived as plain lists of messages, and rendered
+        # transcripts are rebuilt on demand rather than archived, though
+        # what was written to the transcript file is. Metrics are kept in
+        # the data directory's metrics file instead
+        state = dict(self.__dict__)
+        for cache in (
+            "_fragments",
+            "_fragments_last",
+            "_completions",
+            "_tree_sync",
+        ):
+            state.pop(cache, None)
+        state["messages"] = list(self.messages)
+        state.pop("_tree_node", None)
+        synced = self.__dict__.get("_tree_sync")
+        if (
+            synced is not None
+            and synced[0] == len(self.messages) > 0
+            and _message_key(synced[2]) == _message_key(self.messages[-1])
+        ):
+            # Where the last message is in the chat's tree, so WigliData
+            # can leave the messages out of the chat's JSON file
+            state["_tree_node"] = synced[1]
+            if getattr(_archiving, "in_tree", False):
+                state["messages"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        messages = state.get("messages") or []
+        self.messages = (
+            WigliMessageStore(messages)
+            if getattr(self, "compact", False)
+            else WigliHistory(messages)
+        )
+
+    @staticmethod
+    @contextmanager
+    def archiving_in_tree():
+        """
+        Leaves out the messages of the bots encoded in this thread in
+        the with block, wherever their chat tree already holds them.
+        WigliData uses it to save chats, restoring the messages from the
+        tree when they're read.
+        """
+        _archiving.in_tree = True
+        try:
+            yield
+        finally:
+            _archiving.in_tree = False
+
     @classmethod
     def FromBot(cls, bot, *args, **kwargs):
+        """
+        Makes a bot of this class that continues another bot's chat.
+
+        The new bot shares the other bot's history up to now, without
+        copying it, and shares its WigliData. Everything else is deep
+        copied. Attributes this class can't take, like the commands of a
+        CommandBot given to a plain WigliBot, are left behind. A forked
+        CommandBot keeps the session too, so it shares the other bot's
+        Python kernel and variables unless it's given a new session.
+        """
+        params = _init_params(cls)
         copied_attrs = {}
         for attr in vars(bot).keys():
-            if attr != "log":
-                value = getattr(bot, attr)
+            # Private attributes are caches, not constructor arguments
+            if attr == "log" or attr.startswith("_") or attr not in params:
+                continue
+            value = getattr(bot, attr)
+            if attr == "messages":
+                copied_attrs[attr] = fork_messages(value)
+            elif attr == "data":
+                copied_attrs[attr] = value
+            else:
                 copied_attrs[attr] = deepcopy(value)
 
         # Update copied_attrs with kwargs, overwriting any conflicting keys
@@ -340,6 +986,8 @@ class WigliBot(object):
         return self
 
     def make_filename(self):
+        from slugify import slugify
+
         filename = slugify(
             self.title, ok="_", only_ascii=True, lower=False
         )
@@ -353,6 +1001,7 @@ class WigliBot(object):
         for reminder in self.reminders:
             self.Inject(reminder.do_reminder_tick())
 
+    @profiled("bot.chat")
     def Chat(
         self,
         prompt: str
@@ -394,7 +1043,8 @@ class WigliBot(object):
             return self.EMPTY_MSG
 
         # Check if messages will fit in model
-        tokens = count_tokens(self.messages, model)
+        with span("bot.count_tokens"):
+            tokens = count_tokens(self.messages, model)
         self.log(
             f"Counted {tokens} {pluralize('token')} in self.messages"
         )
@@ -403,27 +1053,48 @@ class WigliBot(object):
                 print(self.LIMIT_MSG, flush=True)
             return self.LIMIT_MSG
 
+        # Stop before a request that could take the run over its budget
+        budget = get_token_budget()
+        if budget is not None and not budget.allows(tokens):
+            message = self.BUDGET_MSG.format(limit=budget.limit)
+            self.log(f"{budget.remaining()} tokens left in the budget")
+            if stream:
+                print(message, flush=True)
+            return message
+
         # Convert _WigliMessages into dicts
         dict_messages = [
             {key: val for key, val in m.items()}
             for m in self.messages
         ]
 
+        import openai
+
+        requested = perf_counter()
         try:
-            # OpenAI API request
-            completion = openai.ChatCompletion.create(
-                model=model,
-                messages=dict_messages,
-                temperature=temperature,
-                # n=n,
-                stream=stream,
-                # stop=stop,
-                # max_tokens=max_tokens,
-                # presence_penalty=presence_penalty,
-                # frequence_penalty=frequence_penalty,
-                # logit_bias=logit_bias,
-                # user=user,
-            )
+            for attempt in range(RATE_LIMIT_RETRIES + 1):
+                get_rate_limiter().acquire()
+                try:
+                    # OpenAI API request
+                    completion = openai.ChatCompletion.create(
+                        model=model,
+                        messages=dict_messages,
+                        temperature=temperature,
+                        # n=n,
+                        stream=stream,
+                        # stop=stop,
+                        # max_tokens=max_tokens,
+                        # presence_penalty=presence_penalty,
+                        # frequence_penalty=frequence_penalty,
+                        # logit_bias=logit_bias,
+                        # user=user,
+                    )
+                    break
+                except openai.error.RateLimitError:
+                    if attempt == RATE_LIMIT_RETRIES:
+                        raise
+                    self.log("Rate limited by OpenAI, waiting to retry")
+                    sleep(RATE_LIMIT_BACKOFF * 2**attempt)
         except openai.error.AuthenticationError as e:
             self.log(
                 f'OpenAI API Key AuthenticationError... Run "wigli --set-api-key <your_openai_api_key>" to fix this.\n\n{e}',
@@ -431,11 +1102,17 @@ class WigliBot(object):
             )
             return self.KEY_ERR_MSG
 
+        # When each streamed piece of the response arrived
+        arrivals = []
         if not stream:
+            record("bot.response", perf_counter() - requested, model=model)
             finish_reason = completion.choices[0].finish_reason
             response = WigliMessage(
                 completion.choices[0].message
             )
+            usage = completion.get("usage") or {}
+            prompt_tokens = usage.get("prompt_tokens", tokens)
+            completion_tokens = usage.get("completion_tokens")
         else:
             finish_reason = "stop"
             response = WigliMessage(role="assistant")
@@ -443,11 +1120,36 @@ class WigliBot(object):
             for event in completion:
                 choice = event.choices[0]
                 if "content" in choice.delta.keys():
+                    arrivals.append(perf_counter())
+                    if len(arrivals) == 1:
+                        record(
+                            "bot.first_token",
+                            arrivals[0] - requested,
+                            model=model,
+                        )
                     response.content += choice.delta.content
                     print(
                         choice.delta.content, end="", flush=True
                     )
                 finish_reason = choice.finish_reason
+            if len(arrivals) > 0:
+                record("bot.stream", perf_counter() - arrivals[0], model=model)
+            # Streamed responses don't report usage, so the reply is
+            # counted like the prompt was. A piece of a stream can hold
+            # several tokens, so the pieces aren't counted instead
+            prompt_tokens = tokens
+            with span("bot.count_tokens"):
+                completion_tokens = count_text_tokens(response.content, model)
+
+        self._record_completion(
+            model,
+            requested,
+            arrivals,
+            prompt_tokens,
+            completion_tokens,
+            finish_reason,
+        )
+        self._record_usage(model, prompt_tokens, completion_tokens)
 
         if finish_reason == "length":
             if stream:
@@ -462,6 +1164,118 @@ class WigliBot(object):
         self.do_reminders_tick()
         return response.content
 
+    @property
+    def completions(self) -> List[dict]:
+        """
+        The metrics of each completion this bot has requested since it
+        was made or loaded, oldest first, as described in
+        _record_completion.
+        """
+        return self.__dict__.setdefault("_completions", [])
+
+    def _record_completion(
+        self,
+        model: str,
+        requested: float,
+        arrivals: List[float],
+        prompt_tokens: int | None,
+        completion_tokens: int | None,
+        finish_reason: str | None,
+    ):
+        """
+        Records a completion's metrics on the bot and in its WigliData's
+        metrics file.
+
+        The metrics are a dict of the "timestamp", "model", "bot" class,
+        whether it was a "stream", the "seconds" from request to the end
+        of the response, the seconds to the "first_token" and the 50th,
+        95th and 99th percentile seconds between tokens, as
+        "inter_token_p50" and so on, when the response was streamed, the
+        "prompt_tokens" and "completion_tokens", and the "finish_reason".
+        """
+        seconds = perf_counter() - requested
+        gaps = [
+            later - earlier for earlier, later in zip(arrivals, arrivals[1:])
+        ]
+        metrics = {
+            "timestamp": time(),
+            "model": model,
+            "bot": type(self).__name__,
+            "stream": len(arrivals) > 0,
+            "seconds": round(seconds, 4),
+            "first_token": (
+                round(arrivals[0] - requested, 4)
+                if len(arrivals) > 0
+                else None
+            ),
+        }
+        for q in (50, 95, 99):
+            gap = percentile(gaps, q)
+            metrics[f"inter_token_p{q}"] = (
+                None if gap is None else round(gap, 4)
+            )
+        metrics.update(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            finish_reason=finish_reason,
+        )
+        self.completions.append(metrics)
+        # Metrics exporters get every completion through the span hooks
+        record(
+            "bot.completion",
+            seconds,
+            **{key: value for key, value in metrics.items() if key != "seconds"},
+        )
+        data = self._usage_data()
+        if data is not None:
+            data.record_completion(metrics)
+
+    def _usage_data(self) -> "WigliData | None":
+        # Bots made by commands have no data of their own, so their
+        # requests are recorded with the chat that ran the command
+        if self.data is not None:
+            return self.data
+        return current_usage().get("data")
+
+    def _record_usage(
+        self,
+        model: str,
+        prompt_tokens: int | None,
+        completion_tokens: int | None,
+    ):
+        """
+        Spends a request's tokens from the token budget and records them
+        in the usage ledger, the data directory's usage file.
+
+        Each entry in the ledger has the "timestamp", "model", "chat"
+        filename and "birthstamp", "bot" class and "command" keyword the
+        request is attributed to, its "prompt_tokens" and
+        "completion_tokens", and its estimated "cost" in US dollars.
+        """
+        budget = get_token_budget()
+        if budget is not None:
+            budget.charge((prompt_tokens or 0) + (completion_tokens or 0))
+        data = self._usage_data()
+        if data is None:
+            return
+        context = current_usage()
+        own = self.data is not None
+        data.record_usage(
+            {
+                "timestamp": time(),
+                "model": model,
+                "chat": self.filename if own else context.get("chat"),
+                "birthstamp": (
+                    self.birthstamp if own else context.get("birthstamp")
+                ),
+                "bot": type(self).__name__,
+                "command": context.get("command"),
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "cost": estimate_cost(model, prompt_tokens, completion_tokens),
+            }
+        )
+
     def extract_transcript(
         self, limit=None, truncation=None, start=0
     ):
@@ -498,6 +1312,62 @@ class WigliBot(object):
 
         return dates, roles, messages
 
+    def iter_transcript(
+        self,
+        limit=None,
+        truncation=None,
+        linestart="",
+        since=None,
+    ) -> Generator[str, None, None]:
+        """
+        Yields a transcript of the chat in plain text format one message
+        at a time, so a transcript of any length can be written out
+        without building it in memory. Each message is prefaced by the
+        date, time, and sender's name.
+
+        Parameters
+        ----------
+        limit: int
+            The amount of messages to limit the transcription to.
+        truncation: int
+            The amount of characters to limit each message to.
+        linestart: str
+            What to start each message with.
+        since: float
+            Leave out messages sent before this timestamp.
+
+        Yields
+        ------
+        str
+            Each message's entry, ending in a newline.
+        """
+
+        def selected(message: WigliMessage) -> bool:
+            return since is None or message.timestamp >= since
+
+        # Counting first keeps the last limit messages without holding them
+        skip = 0
+        if limit is not None:
+            if since is None:
+                total = len(self.messages)
+            else:
+                total = sum(1 for m in self.messages if selected(m))
+            skip = max(total - limit, 0)
+
+        for message in self.messages:
+            if not selected(message):
+                continue
+            if skip > 0:
+                skip -= 1
+                continue
+            text = "> " + message.content.strip().replace("\n", "\n> ")
+            if truncation and len(text) > truncation:
+                text = text[:truncation] + "..."
+            yield (
+                f"{linestart}{format_timestamp(message.timestamp)} "
+                f"[{message.role}]: {text}\n"
+            )
+
     def format_transcript(
         self,
         limit=None,
@@ -522,35 +1392,51 @@ class WigliBot(object):
         str
             The entire chat history in plain human-readable text.
         """
-
-        archive_len = len(self.messages)
-        self.log(f"archive_len is {archive_len}")
-        if limit is not None and limit < archive_len:
-            script_len = limit
-        else:
-            script_len = archive_len
-        dates, roles, messages = self.extract_transcript(
-            limit=limit
-        )
-
         return "\n\n".join(
-            [
-                f"""\
-{linestart}{dates[n]} [{roles[n]}]: \
-{
-    (
-        (messages[n][:truncation] + '...')
-        if truncation and len(messages[n]) > truncation
-        else messages[n]
-    ) 
-}
-"""
-                for n in range(
-                    archive_len - script_len, archive_len
-                )
-            ]
+            self.iter_transcript(
+                limit=limit, truncation=truncation, linestart=linestart
+            )
         )
 
+    def markdown_fragments(self, start: int = 0) -> List[str]:
+        """
+        Returns each message formatted as in format_transcript_markdown.
+
+        The fragments are cached, so only the messages added since the
+        last call are formatted. After messages are erased or replaced,
+        every message is formatted again.
+
+        Parameters
+        ----------
+        start: int, optional
+            The first message to return. If the earlier ones aren't
+            cached, only the messages from start on are formatted, and
+            they aren't cached either.
+        """
+        fragments = self.__dict__.get("_fragments")
+        done = 0 if fragments is None else len(fragments)
+        if (
+            fragments is None
+            or done > len(self.messages)
+            or (
+                done > 0
+                and self._fragments_last
+                != _message_key(self.messages[done - 1])
+            )
+        ):
+            if start > 0:
+                return [
+                    self.messages[n].md()
+                    for n in range(start, len(self.messages))
+                ]
+            fragments = self._fragments = []
+            done = 0
+        for n in range(done, len(self.messages)):
+            fragments.append(self.messages[n].md())
+        if len(fragments) > 0:
+            self._fragments_last = _message_key(self.messages[-1])
+        return fragments[start:] if start > 0 else fragments
+
     def format_transcript_markdown(self, limit=None):
         """
         Returns a transcript of the chat in markdown format.
@@ -561,30 +1447,22 @@ class WigliBot(object):
         ----------
         limit: int
             The amount of messages to limit the transcription to.
-        truncation: int
-            The amount of characters to limit each message to.
 
         Returns
         -------
         str
             The entire chat history formatted in markdown.
         """
-
-        dates, roles, messages = self.extract_transcript(
-            limit=limit
-        )
-
-        return "\n\n".join(
-            [
-                f"""\
-#### [{roles[n].title()}](##### "{dates[n]}"):\n\n{messages[n]}"""
-                for n in range(len(messages))
-            ]
-        )
+        fragments = self.markdown_fragments()
+        if limit is not None and limit < len(fragments):
+            fragments = fragments[len(fragments) - limit :]
+        return "\n\n".join(fragments)
 
     def erase_messages(self, num_messages_to_erase):
         """
-        Removes messages from the end of the chat and updates the birthstamp.
+        Removes messages from the end of the chat. The erased messages
+        are kept in the chat's tree, and the next message starts a new
+        branch.
 
         Parameters
         ----------
@@ -608,8 +1486,6 @@ class WigliBot(object):
             self.messages = self.messages[
                 :-num_messages_to_erase
             ]
-            # Update birthstamp so original doesn't get deleted
-            self.birthstamp = self.touchstamp
 
     def _last_message(self) -> str:
         if len(self.messages) > 0:
@@ -642,11 +1518,181 @@ class OneShotBot(WigliBot):
         return self.Chat()
 
 
+class WigliRateLimiter(object):
+    """
+    Spaces out requests to at most per_minute a minute, letting a burst
+    of up to burst requests through at once after a quiet spell. The
+    allowance refills continuously, like a token bucket.
+    """
+
+    def __init__(self, per_minute: float | None = None, burst: int = 1):
+        self.per_minute = per_minute
+        self.burst = burst
+        self.lock = Lock()
+        self.allowance = float(burst)
+        self.updated = monotonic()
+
+    def acquire(self):
+        """
+        Waits until a request may be sent, then counts it.
+        """
+        if self.per_minute is None:
+            return
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.allowance = min(
+                    self.burst,
+                    self.allowance
+                    + (now - self.updated) * self.per_minute / 60,
+                )
+                self.updated = now
+                if self.allowance >= 1:
+                    self.allowance -= 1
+                    return
+                wait = (1 - self.allowance) * 60 / self.per_minute
+            sleep(wait)
+
+
+def get_rate_limiter() -> WigliRateLimiter:
+    """
+    Returns the limiter every chat request in this process waits on.
+    """
+    return _rate_limiter
+
+
+def set_rate_limit(per_minute: float | None, burst: int = 1):
+    """
+    Limits chat requests in this process to per_minute a minute, or
+    lifts the limit when per_minute is None.
+    """
+    global _rate_limiter
+    _rate_limiter = WigliRateLimiter(per_minute, burst=burst)
+
+
+_rate_limiter = WigliRateLimiter()
+
+
+class WigliWorkerPool(object):
+    """
+    Runs command invocations, or any function taking an arg dict, on
+    daemon threads, at most max_workers at a time. An invocation still
+    running when its arg["timeout"] runs out has its arg["cancel"] event
+    set and is abandoned, so a hung command can't block the bot.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = MAX_COMMAND_WORKERS,
+        on_result: Callable[[Any, tuple], None] | None = None,
+    ):
+        self.max_workers = max_workers
+        # Given each (result, exception) pair as it comes in, instead of
+        # keeping them all for join
+        self.on_result = on_result
+        self.changed = Condition()
+        self.queue = []
+        self.running = {}
+        self.results = {}
+        # Finished invocations whose on_result call hasn't returned yet
+        self.delivering = 0
+
+    def submit(self, key: Any, run: Callable, arg: dict):
+        # Requests made by the workers count toward this thread's usage
+        run = bind_usage(run)
+        with self.changed:
+            self.queue.append((key, run, arg))
+            self._start_queued()
+
+    def _start_queued(self):
+        while len(self.queue) > 0 and len(self.running) < self.max_workers:
+            key, run, arg = self.queue.pop(0)
+            timeout = arg.get("timeout")
+            deadline = float("inf") if timeout is None else time() + timeout
+            self.running[key] = (arg, deadline)
+            Thread(
+                target=self._work, args=(key, run, arg), daemon=True
+            ).start()
+
+    def _work(self, key: Any, run: Callable, arg: dict):
+        try:
+            result = (run(arg), None)
+        except BaseException as e:
+            result = (None, e)
+        with self.changed:
+            # Abandoned workers have already been given a timeout result
+            finished = key in self.running
+            if finished:
+                del self.running[key]
+                if self.on_result is None:
+                    self.results[key] = result
+                else:
+                    self.delivering += 1
+                self._start_queued()
+        try:
+            if finished and self.on_result is not None:
+                self.on_result(key, result)
+        finally:
+            with self.changed:
+                if finished and self.on_result is not None:
+                    self.delivering -= 1
+                self.changed.notify_all()
+
+    def join(self) -> dict:
+        """
+        Waits for every submitted invocation to finish or time out.
+
+        Returns
+        -------
+        dict
+            Maps each key to a (result, exception) pair. Abandoned
+            invocations get a TimeoutError.
+        """
+        with self.changed:
+            while len(self.running) > 0 or self.delivering > 0:
+                now = time()
+                for key, (arg, deadline) in list(self.running.items()):
+                    if deadline <= now:
+                        arg["cancel"].set()
+                        del self.running[key]
+                        if self.on_result is None:
+                            self.results[key] = (None, TimeoutError())
+                        else:
+                            self.on_result(key, (None, TimeoutError()))
+                self._start_queued()
+                deadline = min(
+                    (d for _, d in self.running.values()), default=float("inf")
+                )
+                if len(self.running) > 0 or self.delivering > 0:
+                    self.changed.wait(
+                        None if deadline == float("inf") else deadline - now
+                    )
+        return self.results
+
+
 class CommandBot(WigliBot):
-    def __init__(self, *args, **kwargs):
+    CMD_TIMEOUT_MSG = "[ERROR: COMMAND {keyword} TIMED OUT AFTER {timeout:g} SECONDS]"
+    CMD_ERROR_MSG = "[ERROR: COMMAND {keyword} FAILED: {error}]"
+    TURN_TIMEOUT_MSG = "[ERROR: COMMANDS STOPPED AFTER {timeout:g} SECONDS]"
+
+    def __init__(
+        self,
+        *args,
+        active_cmds: set | None = None,
+        cmd_cache: WigliCommandCache | None = None,
+        session: str | None = None,
+        **kwargs,
+    ):
+        self.active_cmds = set() if active_cmds is None else active_cmds
+        self.cmd_cache = (
+            WigliCommandCache() if cmd_cache is None else cmd_cache
+        )
+        # Identifies this chat to commands that keep state between
+        # calls, and survives FromBot and archiving
+        self.session = uuid4().hex if session is None else session
         super().__init__(*args, **kwargs)
-        self.active_cmds = set()
 
+    @profiled("commandbot.chat")
     def Chat(
         self,
         prompt: str
@@ -657,8 +1703,19 @@ class CommandBot(WigliBot):
         *args,
         **kwargs,
     ) -> str:
+        token_budget = kwargs.pop("token_budget", None)
+        if token_budget is not None:
+            # Spent by this turn's requests, and those its commands make
+            budget = WigliTokenBudget(token_budget, parent=get_token_budget())
+            with usage_context(budget=budget):
+                return self.Chat(prompt, *args, **kwargs)
         reprompt = kwargs.pop("reprompt", True)
         nochat = kwargs.pop("nochat", False)
+        refresh = kwargs.pop("refresh", False)
+        turn_timeout = kwargs.pop("turn_timeout", TURN_TIMEOUT)
+        turn_end = (
+            float("inf") if turn_timeout is None else time() + turn_timeout
+        )
         if nochat:
             if prompt is not None:
                 self.And(prompt, role="user")
@@ -671,24 +1728,42 @@ class CommandBot(WigliBot):
         args = []
         for num_commands in range(MAX_COMMANDS):
             self.log("Parsing message for commands")
-            for cmd in self.active_cmds:
-                if cmd.keyword in response:
-                    arg = cmd.parse(response)
-                    if arg is not None:
-                        arg["stream"] = self.stream
-                        result = cmd.run(arg)
-                        break
-            else:
+            invocations = self.parse_commands(response)
+            if len(invocations) <= 0:
+                break
+
+            if time() >= turn_end:
+                self.log(
+                    self.TURN_TIMEOUT_MSG.format(timeout=turn_timeout),
+                    v=0 if self.stream else 3,
+                )
                 break
 
-            if result[-1].role == "quit":
+            budget = get_token_budget()
+            if budget is not None and budget.remaining() <= 0:
+                self.log(
+                    self.BUDGET_MSG.format(limit=budget.limit),
+                    v=0 if self.stream else 3,
+                )
+                break
+
+            results = self.run_commands(
+                invocations, refresh=refresh, deadline=turn_end
+            )
+
+            if any(
+                len(result) > 0 and result[-1].role == "quit"
+                for result in results
+            ):
                 break
 
             if not reprompt:
                 break
 
             self.log("Reprompting with command output")
-            kwargs["prompt"] = result
+            kwargs["prompt"] = [
+                message for result in results for message in result
+            ]
 
             response = super().Chat(*args, **kwargs)
         else:
@@ -701,6 +1776,213 @@ bot {plural('command', MAX_COMMANDS)}, use the -b flag."""
 
         return self.messages[-1].content
 
+    def __getstate__(self):
+        # The keyword matcher is rebuilt on demand rather than archived
+        state = super().__getstate__()
+        state.pop("_matcher", None)
+        return state
+
+    def get_matcher(self) -> WigliCommandMatcher:
+        """
+        Returns the keyword matcher for active_cmds, rebuilding it only
+        if active_cmds has changed since it was last built.
+        """
+        matcher = self.__dict__.get("_matcher")
+        if matcher is None or matcher.cmds != self.active_cmds:
+            matcher = WigliCommandMatcher(self.active_cmds)
+            self._matcher = matcher
+        return matcher
+
+    @profiled("commands.parse")
+    def parse_commands(self, response: str) -> List[tuple]:
+        """
+        Finds every command invocation in a message.
+
+        Each command's parse function is handed only the text of its
+        own span, or the joined text of all its spans for batch commands.
+
+        Parameters
+        ----------
+        response: str
+            The message to scan for command keywords.
+
+        Returns
+        -------
+        list
+            (WigliCommand, arg) pairs in the order they appear in the
+            message.
+        """
+        groups = []
+        batches = {}
+        for start, end, cmd in self.get_matcher().find(response):
+            if cmd in batches:
+                batches[cmd][2].append(response[start:end])
+                continue
+            group = (start, cmd, [response[start:end]])
+            if cmd.batch:
+                batches[cmd] = group
+            groups.append(group)
+
+        found = []
+        for start, cmd, texts in groups:
+            cmd_args = cmd.parse("\n".join(texts))
+            if cmd_args is None:
+                continue
+            if isinstance(cmd_args, dict):
+                cmd_args = [cmd_args]
+            for n, arg in enumerate(cmd_args):
+                found.append((start, n, cmd, arg))
+
+        found.sort(key=lambda invocation: invocation[:2])
+        return [(cmd, arg) for *_, cmd, arg in found]
+
+    @profiled("commands.run")
+    def run_commands(
+        self,
+        invocations: List[tuple],
+        refresh: bool = False,
+        deadline: float = float("inf"),
+    ) -> List[List[WigliMessage]]:
+        """
+        Runs command invocations, concurrently where the commands allow it.
+
+        Results of cacheable commands are served from cmd_cache when an
+        equal call was made recently, and repeated calls within one
+        message only run once. A command that times out or raises gets
+        an error message as its result, which is never cached. A command
+        can also keep a result it knows is incomplete out of the cache by
+        setting arg["cacheable"] to False.
+
+        Parameters
+        ----------
+        invocations: list
+            (WigliCommand, arg) pairs as returned by parse_commands.
+        refresh: bool, optional
+            Ignore cached results and run every command again.
+        deadline: float, optional
+            Time by which every command must finish. Each command gets
+            the smaller of its own timeout and the time left, as
+            arg["timeout"], and an arg["cancel"] event that is set if it
+            is abandoned. arg["session"] is the bot's session.
+
+        Returns
+        -------
+        list
+            One list of result messages per invocation, in the same
+            order as the invocations.
+        """
+        # Archives from before the cache existed don't have one
+        cache = self.__dict__.get("cmd_cache")
+        if cache is None:
+            cache = self.cmd_cache = WigliCommandCache()
+        if self.__dict__.get("session") is None:
+            self.session = uuid4().hex
+
+        results = [None] * len(invocations)
+        keys = [None] * len(invocations)
+        pending = {}
+        for n, (cmd, arg) in enumerate(invocations):
+            if not cmd.cacheable:
+                continue
+            keys[n] = cache.make_key(cmd, arg)
+            if not refresh:
+                results[n] = cache.get(keys[n])
+            if results[n] is None and keys[n] in pending:
+                # Same call earlier in this message, reuse its result
+                results[n] = []
+            pending.setdefault(keys[n], n)
+
+        to_run = [n for n in range(len(invocations)) if results[n] is None]
+        pooled = [n for n in to_run if invocations[n][0].concurrent]
+        # Interleaved streams are unreadable, so concurrent commands
+        # run quietly and their results are printed in order afterward
+        quiet = len(pooled) > 1
+
+        started = time()
+        pool = WigliWorkerPool()
+        for n in to_run:
+            cmd, arg = invocations[n]
+            arg["stream"] = self.stream and not (quiet and cmd.concurrent)
+            arg["session"] = self.session
+            arg["cancel"] = Event()
+            arg["timeout"] = min(
+                float("inf") if cmd.timeout is None else cmd.timeout,
+                deadline - time(),
+            )
+            if arg["timeout"] == float("inf"):
+                arg["timeout"] = None
+            if cmd.concurrent:
+                pool.submit(n, self._bind_command(cmd), arg)
+        # Interactive commands run here and bound their own blocking
+        # work with arg["timeout"]
+        outcomes = {}
+        for n in to_run:
+            cmd, arg = invocations[n]
+            if not cmd.concurrent:
+                try:
+                    outcomes[n] = (self._bind_command(cmd)(arg), None)
+                except Exception as e:
+                    outcomes[n] = (None, e)
+        outcomes.update(pool.join())
+        failed = set()
+        for n, (result, error) in outcomes.items():
+            cmd, arg = invocations[n]
+            if isinstance(error, TimeoutError):
+                self.log(f"Command {cmd.keyword} timed out")
+                timeout = arg["timeout"]
+                if timeout is None:
+                    timeout = round(time() - started)
+                message = self.CMD_TIMEOUT_MSG.format(
+                    keyword=cmd.keyword, timeout=timeout
+                )
+            elif isinstance(error, Exception):
+                # One failing command doesn't cost the others their results
+                self.log(f"Command {cmd.keyword} failed: {error!r}")
+                message = self.CMD_ERROR_MSG.format(
+                    keyword=cmd.keyword, error=error
+                )
+            elif error is not None:
+                raise error
+            else:
+                results[n] = result
+                continue
+            failed.add(n)
+            results[n] = [WigliMessage(message, "system")]
+
+        for n, key in enumerate(keys):
+            if key is None:
+                continue
+            if pending[key] == n and n in to_run:
+                # Don't cache a timeout or error in place of a real result
+                arg = invocations[n][1]
+                if n not in failed and arg.get("cacheable", True):
+                    cache.put(key, results[n])
+            elif pending[key] != n:
+                results[n] = [
+                    WigliMessage(msg.content, msg.role)
+                    for msg in results[pending[key]]
+                ]
+
+        if self.stream:
+            for n in range(len(invocations)):
+                if (quiet and n in pooled) or n not in to_run or n in failed:
+                    for message in results[n]:
+                        print(message.content, flush=True)
+
+        return results
+
+    def _bind_command(self, cmd: WigliCommand) -> Callable:
+        # Requests the command makes are recorded with this chat
+        own = self.data is not None
+        context = current_usage()
+        return bind_usage(
+            cmd.run,
+            data=self._usage_data(),
+            chat=self.filename if own else context.get("chat"),
+            birthstamp=self.birthstamp if own else context.get("birthstamp"),
+            command=cmd.keyword,
+        )
+
     def And(
         self,
         messages: str
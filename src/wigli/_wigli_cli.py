@@ -1,9 +1,11 @@
 # wigli _wigli_cli.py
 
-from jsonpickle import decode
+import sys
+
 from math import floor
+from os import environ
 from os.path import join
-from sys import version_info, argv
+from sys import argv, modules
 from time import time
 from typing import List
 
@@ -11,19 +13,10 @@ from wigli import WigliBot, CommandBot, WigliMessage
 from wigli._wigli_argparser import fetch_args
 from wigli._wigli_version import VERSION
 from wigli._wigli_data import WigliData
-from wigli._wigli_tools import clamp
-
-# if version_info < (3, 10):
-#     from importlib_metadata import entry_points
-# else:
-#     from importlib.metadata import entry_points
-
-from wigli._wigli_plugins import (
-    Doctest,
-    HistoryProfessor,
-    PythonBot,
-    SearchBot,
-)
+from wigli._wigli_profile import WigliProfile, profiled, span
+from wigli._wigli_registry import WigliPluginRegistry, plugin_dest
+from wigli._wigli_tools import clamp, plural
+from wigli._wigli_usage import set_token_budget
 
 
 def wigli_cli(
@@ -37,14 +30,43 @@ def wigli_cli(
     WigliInvocation in accordance with the user's command-line arguments.
     """
 
-    invocation = WigliInvocation(
-        argv_, data_dir=data_dir, verbosity=verbosity
-    )
-    if invocation.prompt is None:
+    # Looked for before parsing, so parsing and loading are timed too
+    if argv_ is not None and "--profile" in argv_:
+        profile = WigliProfile()
+        try:
+            with profile:
+                _run_invocation(argv_, data_dir, verbosity)
+        finally:
+            print(profile.format(), file=sys.stderr)
         return
+    _run_invocation(argv_, data_dir, verbosity)
+
+
+def _run_invocation(
+    argv_: List[str] | None, data_dir: str | None, verbosity: int
+):
+    from wigli._wigli_bots import get_rate_limiter, set_rate_limit
+
+    # A --budget, --rate or --python-memory is for one command, even when
+    # the daemon runs it. The memory limit is only put back if plugins
+    # were loaded already, as they are in the daemon
+    rate_limiter = get_rate_limiter()
+    plugins = modules.get("wigli._wigli_plugins")
+    memory_limit = getattr(plugins, "PYTHON_MEMORY_LIMIT", None)
+    try:
+        invocation = WigliInvocation(
+            argv_, data_dir=data_dir, verbosity=verbosity
+        )
+        if invocation.prompt is None:
+            return
 
-    invocation.log("Starting chat")
-    invocation.Chat()
+        invocation.log("Starting chat")
+        invocation.Chat()
+    finally:
+        set_token_budget(None)
+        set_rate_limit(rate_limiter.per_minute, burst=rate_limiter.burst)
+        if plugins is not None:
+            plugins.PYTHON_MEMORY_LIMIT = memory_limit
 
 
 class WigliInvocation(object):
@@ -57,26 +79,35 @@ class WigliInvocation(object):
         self.archive = None
         self._timestamp = time()
 
-        self.data = WigliData(
-            self._get_timestamp,
-            data_dir=data_dir,
-            verbosity=verbosity,
-        )
+        with span("cli.setup"):
+            self.data = WigliData(
+                self._get_timestamp,
+                data_dir=data_dir,
+                verbosity=verbosity,
+            )
 
-        self.log = self.data.log
-        self.log("Hello, logger!")
-        self.bot = None
-        self.argv = argv
-        self.args = fetch_args(argv)
+            self.log = self.data.log
+            self.log("Hello, logger!")
+            self.bot = None
+            self.argv = argv
+            self.plugins = WigliPluginRegistry(
+                cache_path=join(self.data.data_dir, "plugins.json")
+            )
+        with span("cli.parse_args"):
+            self.args = fetch_args(argv, plugins=self.plugins)
         self.prompt = self._handle_args()
         self.log(f"fetched args for argv: {argv}")
 
+    @profiled("cli.chat")
     def Chat(self) -> str:
+        if self.args.refresh and isinstance(self.bot, CommandBot):
+            return self.bot.Chat(self.prompt, refresh=True)
         return self.bot.Chat(self.prompt)
 
     def _get_timestamp(self):
         return self._timestamp
 
+    @profiled("cli.setup_bot")
     def _bot_from_args(self) -> str:
         injection = []
 
@@ -88,17 +119,16 @@ class WigliInvocation(object):
         if self.bot is None:
             self.bot = WigliBot(data=self.data)
 
-        if self.args.professor:
-            self.log("Summoning Professor Wigli", v=0)
-            self.bot = HistoryProfessor.FromBot(self.bot)
-
-        if self.args.python:
-            self.log("Injecting Python capabilities", v=0)
-            self.bot = PythonBot.FromBot(self.bot)
-
-        if self.args.search:
-            self.log("Injecting web search capabilities", v=0)
-            self.bot = SearchBot.FromBot(self.bot)
+        # Plugin modules are only imported if their flag was given
+        for plugin in self.plugins:
+            if getattr(self.args, plugin_dest(plugin), False):
+                self.log(
+                    plugin.get(
+                        "message", f"Injecting the {plugin['name']} plugin"
+                    ),
+                    v=0,
+                )
+                self.bot = self.plugins.apply(plugin["name"], self.bot)
 
         self.bot.Inject(injection)
 
@@ -124,13 +154,58 @@ OPENAI_API_KEY={self.args.set_api_key}
 """
                 )
             self.log(f"Saved API key at {join(self.data.data_dir, '.env')}", v=0)
+            # A running daemon would keep using the old key otherwise
+            environ["OPENAI_API_KEY"] = self.args.set_api_key
+            if "openai" in modules:
+                modules["openai"].api_key = self.args.set_api_key
+            return
+
+        if self.args.serve:
+            from wigli._wigli_daemon import serve
+
+            serve(self.data.data_dir, verbosity=self.args.verbosity)
+            return
+
+        if self.args.rate is not None:
+            from wigli._wigli_bots import set_rate_limit
+
+            set_rate_limit(self.args.rate)
+
+        if self.args.budget is not None:
+            set_token_budget(self.args.budget)
+
+        if self.args.python_memory is not None:
+            from wigli import _wigli_plugins
+
+            memory_limit = self.args.python_memory * 2**20
+            _wigli_plugins.PYTHON_MEMORY_LIMIT = memory_limit
+
+        if self.args.batch is not None:
+            self._run_batch()
+            return
+
+        if self.args.web_cache_stats:
+            from wigli._wigli_http import get_http
+
+            stats = get_http().cache.stats()
+            print(
+                "\n".join(
+                    f"{name.title()}: {value}" for name, value in stats.items()
+                )
+            )
+            return
+
+        if self.args.stats:
+            print(self._format_stats())
+            return
+
+        if self.args.usage is not None:
+            print(self._format_usage())
+            return
+
+        if self.args.list_installed_plugins:
+            print(self.plugins.format_listing())
             return
-        
-        # if self.args.list_installed_plugins:
-        #     discovered_plugins = entry_points(group='wigli._wigli_plugins')
-        #     for discovered_plugin in discovered_plugins:
-        #         print(f"    {discovered_plugin}")
-        #     return
 
         # List previous chats
         if self.args.list:  # or self.args.transcriptbrief:
@@ -151,18 +226,28 @@ Loaded previous chat: {getattr(self.bot, "title", "No title")}""",
                 )
                 self.bot.data = self.data
                 self.bot.log = self.data.log
+                if self.args.branch is not None:
+                    self.data.switch_branch(self.bot, self.args.branch)
                 if self.args.erase is not None:
                     self.bot.erase_messages(self.args.erase)
             else:
                 self.bot = None
 
+        if self.args.branches:
+            self.log("Printing branches then exiting")
+            if self.bot is not None:
+                print(self._format_branches())
+            else:
+                print("No chat for which to list branches")
+            return
+
         # Now everything is initialized
 
         # No chat, just print transcripts
         if self.args.transcript_full:
             self.log("Printing transcript then exiting")
             if self.bot is not None:
-                print(self.bot.format_transcript())
+                self._write_transcript()
             else:
                 print("No chat for which to print transcript")
             return
@@ -204,9 +289,15 @@ Loaded previous chat: {getattr(self.bot, "title", "No title")}""",
             self.log(
                 "Invoking the headless DocTest bot on the following code:\n\n{self.args.prompt}"
             )
+            from wigli._wigli_plugins import Doctest
+
             self.log(Doctest(self.args.prompt), v=0)
             return
 
+        if self.args.interactive:
+            self._run_repl()
+            return
+
         prompt = self._bot_from_args()
 
         if self.bot is None:
@@ -229,6 +320,172 @@ Loaded previous chat: {getattr(self.bot, "title", "No title")}""",
 
         return prompt
 
+    def _write_transcript(self):
+        """
+        Writes the transcript one message at a time, so printing even a
+        huge chat starts at once and needs no more memory than a message.
+        """
+        out = None  # print's default, the current stdout
+        if self.args.output is not None:
+            out = open(self.args.output, "w", encoding="utf-8")
+            self.log(("Writing transcript to", self.args.output))
+        try:
+            entries = self.bot.iter_transcript(
+                limit=self.args.limit, since=self.args.since
+            )
+            for n, entry in enumerate(entries):
+                print("\n\n" if n > 0 else "", entry, sep="", end="", file=out)
+            print(file=out)
+        finally:
+            if out is not None:
+                out.close()
+
+    def _run_repl(self):
+        """
+        Starts an interactive session on the loaded or a new chat, with
+        the plugin flags turned on and then the --system prompt added.
+        """
+        from wigli._wigli_repl import WigliRepl
+
+        if self.bot is None:
+            self.bot = WigliBot(data=self.data)
+        repl = WigliRepl(self.bot, self.data, self.plugins)
+        for plugin in self.plugins:
+            if getattr(self.args, plugin_dest(plugin), False) and (
+                plugin["name"] not in repl.enabled
+            ):
+                repl.enable_plugin(plugin["name"])
+        if self.args.system is not None:
+            repl.bot.Inject([WigliMessage(self.args.system, "system")])
+        self.bot = repl.bot
+        repl.run()
+        self.bot = repl.bot
+
+    def _run_batch(self):
+        """
+        Runs the prompts in the --batch file, with the --system prompt and
+        plugin flags given on the command line as defaults for each one.
+        """
+        from wigli._wigli_batch import WigliBatch
+
+        # Looked up now, since the daemon swaps in its client's streams
+        source = sys.stdin if self.args.batch == "-" else open(
+            self.args.batch, encoding="utf-8"
+        )
+        out = sys.stdout
+        if self.args.output is not None:
+            out = open(self.args.output, "w", encoding="utf-8")
+            self.log(("Writing batch results to", self.args.output))
+        try:
+            batch = WigliBatch(
+                self.data,
+                self.plugins,
+                out,
+                concurrency=self.args.concurrency,
+                order=self.args.order,
+                lean=self.args.lean,
+                system=self.args.system,
+                default_plugins=[
+                    plugin["name"]
+                    for plugin in self.plugins
+                    if getattr(self.args, plugin_dest(plugin), False)
+                ],
+            )
+            summary = batch.run(source)
+        finally:
+            if source is not sys.stdin:
+                source.close()
+            if out is not sys.stdout:
+                out.close()
+        print(
+            f"Ran {summary['items']} {plural('prompt', summary['items'])} "
+            f"in {summary['seconds']:g}s, {summary['failed']} failed",
+            file=sys.stderr,
+        )
+
+    def _format_usage(self) -> str:
+        by = self.args.usage
+        summary = self.data.usage_summary(by=by, since=self.args.since)
+        if len(summary) == 0:
+            return "No usage recorded yet"
+        rows = [
+            [str(group[key]) for key in by]
+            + [
+                str(group["requests"]),
+                str(group["prompt_tokens"]),
+                str(group["completion_tokens"]),
+                str(group["tokens"]),
+                f"${group['cost']:.4f}",
+            ]
+            for group in summary
+        ]
+        header = list(by) + ["requests", "prompt", "completion", "total", "cost"]
+        widths = [
+            max(len(row[n]) for row in rows + [header])
+            for n in range(len(header))
+        ]
+        return "\n".join(
+            "  ".join(
+                cell.ljust(width) if n < len(by) else cell.rjust(width)
+                for n, (cell, width) in enumerate(zip(row, widths))
+            )
+            for row in [header] + rows
+        )
+
+    def _format_stats(self) -> str:
+        lines = []
+        for group in self.data.completion_stats(since=self.args.since):
+            lines.append(
+                f"{group['model']}, {group['bot']}: {group['calls']} "
+                f"{plural('call', group['calls'])}, "
+                f"{group['prompt_tokens']} prompt and "
+                f"{group['completion_tokens']} completion tokens"
+            )
+            lines.append(f"  {'':12} {'p50':>9} {'p95':>9} {'p99':>9}")
+            for name, label, scale, unit in (
+                ("first_token", "first token", 1000, "ms"),
+                ("inter_token", "inter-token", 1000, "ms"),
+                ("seconds", "total", 1000, "ms"),
+                ("tokens_per_second", "tokens/s", 1, ""),
+            ):
+                values = [group[name][q] for q in (50, 95, 99)]
+                if values[0] is None:
+                    continue
+                lines.append(
+                    f"  {label:12} "
+                    + " ".join(
+                        f"{value * scale:{9 - len(unit)}.1f}{unit}"
+                        for value in values
+                    )
+                )
+        if len(lines) == 0:
+            return "No completions recorded yet"
+        return "\n".join(lines)
+
+    def _format_branches(self) -> str:
+        lines = []
+        for summary in self.data.list_branches(self.bot):
+            current = (
+                "*"
+                if summary["branch"] == getattr(self.bot, "branch", None)
+                else " "
+            )
+            last = summary["last"]
+            preview = "" if last is None else last.content.strip()
+            preview = preview.splitlines()[0] if preview else ""
+            if len(preview) > 60:
+                preview = preview[:57] + "..."
+            lines.append(
+                f"{current} {summary['branch']}: {summary['length']} "
+                f"{plural('message', summary['length'])}, "
+                f"{summary['shared']} shared"
+                + (f" | {preview}" if preview else "")
+            )
+        if len(lines) == 0:
+            return "No branches saved for this chat yet"
+        return "\n".join(lines)
+
+    @profiled("cli.load_chat")
     def _load_chat(self):
         """
         Searches the archive for a valid chat
@@ -246,26 +503,14 @@ Loaded previous chat: {getattr(self.bot, "title", "No title")}""",
 
         if self.args.resume_last:
             # Load the previous conversation
-            with open(
-                join(
-                    self.data.convos_dir,
-                    logs[len(logs) - 1],
-                )
-            ) as f:
-                return decode(f.read())
+            return self.data.read_chat(logs[len(logs) - 1])
 
         if self.args.index is not None:
             # Load a previous conversation by reverse chronological index
             self.args.index = clamp(
                 self.args.index, 1, len(logs)
             )
-            with open(
-                join(
-                    self.data.convos_dir,
-                    logs[len(logs) - self.args.index],
-                )
-            ) as f:
-                return decode(f.read())
+            return self.data.read_chat(logs[len(logs) - self.args.index])
 
         if self.args.time is not None:
             # Load a previous conversation by timestamp
@@ -273,13 +518,7 @@ Loaded previous chat: {getattr(self.bot, "title", "No title")}""",
                 log for log in logs if self.args.time in log
             ]
             if len(files) > 0:
-                with open(
-                    join(
-                        self.data.convos_dir,
-                        files[len(files) - 1],
-                    )
-                ) as f:
-                    return decode(f.read())
+                return self.data.read_chat(files[len(files) - 1])
 
         if self.args.title is not None:
             # Load a previous conversation by title
@@ -290,13 +529,7 @@ Loaded previous chat: {getattr(self.bot, "title", "No title")}""",
                 in log.replace("_", "").lower()
             ]
             if len(files) > 0:
-                with open(
-                    join(
-                        self.data.convos_dir,
-                        files[len(files) - 1],
-                    )
-                ) as f:
-                    return decode(f.read())
+                return self.data.read_chat(files[len(files) - 1])
 
         # Check for chat in the last 5 minutes
         max_timestamp = floor(float(logs[0].split("_")[1]))
@@ -309,7 +542,4 @@ Loaded previous chat: {getattr(self.bot, "title", "No title")}""",
 
         if self._timestamp - max_timestamp < 300:
             # Time since chat is fewer than 5 minutes
-            with open(
-                join(self.data.convos_dir, logs[max_index])
-            ) as f:
-                return decode(f.read())
+            return self.data.read_chat(logs[max_index])
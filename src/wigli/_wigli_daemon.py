@@ -0,0 +1,380 @@
+# wigli _wigli_daemon.py
+
+# The client in this file runs on every wigli command, so it only imports
+# the standard library at the top level and only loads the rest of Wigli
+# when there's no daemon to hand the command to
+
+import socket
+import sys
+
+from contextlib import contextmanager
+from json import dumps, loads
+from os import chdir, environ, getcwd, remove, umask
+from os.path import exists, join
+from threading import Lock
+from typing import BinaryIO, Callable, List
+
+SOCKET_NAME = "wigli.sock"
+CONNECT_TIMEOUT = 1
+# The most chats the daemon keeps decoded in memory
+DAEMON_CHAT_CACHE = 16
+# The environment variables a client's command runs with in the daemon
+FORWARDED_ENV = (
+    "OPENAI_API_KEY",
+    "OPENAI_API_BASE",
+    "OPENAI_ORGANIZATION",
+    "HTTP_PROXY",
+    "HTTPS_PROXY",
+    "NO_PROXY",
+    "http_proxy",
+    "https_proxy",
+    "no_proxy",
+)
+# The openai settings read from the environment when it's imported
+OPENAI_ENV = {
+    "OPENAI_API_KEY": "api_key",
+    "OPENAI_API_BASE": "api_base",
+    "OPENAI_ORGANIZATION": "organization",
+}
+
+_requests_lock = Lock()
+
+
+def socket_path(data_dir: str | None = None) -> str:
+    """
+    Returns the path of the daemon's socket for a data directory.
+    """
+    if data_dir is None:
+        from wigli._wigli_tools import default_data_dir
+
+        data_dir = default_data_dir()
+    return join(data_dir, SOCKET_NAME)
+
+
+def _connect(path: str) -> socket.socket | None:
+    if not hasattr(socket, "AF_UNIX") or not exists(path):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(CONNECT_TIMEOUT)
+    try:
+        client.connect(path)
+    except OSError:
+        # No daemon is listening, the socket was left behind
+        client.close()
+        return None
+    client.settimeout(None)
+    return client
+
+
+def forward(argv: List[str], data_dir: str | None = None) -> int | None:
+    """
+    Runs a command in the daemon for a data directory, streaming its
+    output here and answering its requests for input from stdin.
+
+    Parameters
+    ----------
+    argv: List[str]
+        The command's arguments, without the program name.
+    data_dir: str, optional
+        The data directory whose daemon to use.
+
+    Returns
+    -------
+    int
+        The command's exit code, or None if no daemon is running.
+    """
+    client = _connect(socket_path(data_dir))
+    if client is None:
+        return None
+    with client, client.makefile("rwb") as stream:
+        _send(
+            stream,
+            {
+                "argv": list(argv),
+                "cwd": getcwd(),
+                "env": {
+                    name: environ[name]
+                    for name in FORWARDED_ENV
+                    if name in environ
+                },
+            },
+        )
+        for line in stream:
+            message = loads(line)
+            if "out" in message:
+                sys.stdout.write(message["out"])
+                sys.stdout.flush()
+            elif "err" in message:
+                sys.stderr.write(message["err"])
+                sys.stderr.flush()
+            elif "read" in message:
+                _send(stream, {"line": sys.stdin.readline()})
+            elif "exit" in message:
+                return message["exit"]
+    print(
+        "[ERROR: THE WIGLI DAEMON STOPPED DURING THE COMMAND]",
+        file=sys.stderr,
+    )
+    return 1
+
+
+def main():
+    """
+    The wigli command. Hands the command to the daemon if one is running
+    and runs it here otherwise.
+    """
+    argv = sys.argv[1:]
+    if "--serve" not in argv:
+        code = forward(argv)
+        if code is not None:
+            sys.exit(code)
+
+    from wigli._wigli_cli import wigli_cli
+
+    sys.exit(wigli_cli(argv_=argv))
+
+
+def serve(data_dir: str | None = None, verbosity: int = 0) -> int:
+    """
+    Runs the daemon for a data directory until it's interrupted or sent
+    SIGTERM.
+
+    The daemon keeps the imported dependencies, the tokenizer, the HTTP
+    connection pool, Python kernels and recently used chats in memory
+    between commands. Commands run one at a time, each with its client's
+    arguments, working directory, environment variables in FORWARDED_ENV,
+    output and input.
+
+    Returns
+    -------
+    int
+        The exit code, 1 if another daemon is already running.
+    """
+    from socketserver import StreamRequestHandler, ThreadingUnixStreamServer
+
+    # Plugins are loaded up front too, which lets each command's
+    # --python-memory be undone once it's done
+    import wigli._wigli_plugins  # noqa: F401
+
+    from wigli._wigli_cli import wigli_cli
+    from wigli._wigli_data import set_chat_cache
+    from wigli._wigli_tools import _encoding
+
+    path = socket_path(data_dir)
+    running = _connect(path)
+    if running is not None:
+        running.close()
+        print(f"A Wigli daemon is already running at {path}")
+        return 1
+    if exists(path):
+        remove(path)
+
+    set_chat_cache(DAEMON_CHAT_CACHE)
+    try:
+        # Loads the tokenizer before the first command needs it
+        _encoding("gpt-3.5-turbo")
+    except Exception:
+        pass  # The encoding couldn't be downloaded, load it on demand
+
+    class Handler(StreamRequestHandler):
+        def handle(self):
+            line = self.rfile.readline()
+            if not line:
+                return
+            request = loads(line)
+            with _requests_lock:
+                _run_request(
+                    lambda argv: wigli_cli(
+                        argv_=argv, data_dir=data_dir, verbosity=verbosity
+                    ),
+                    request,
+                    self.rfile,
+                    self.wfile,
+                )
+
+    # Only this user may run commands through the daemon. The socket is
+    # made without access for anyone else, rather than changed after it
+    # was bound, so no one can connect in between
+    mask = umask(0o077)
+    try:
+        server = ThreadingUnixStreamServer(path, Handler)
+    finally:
+        umask(mask)
+    server.daemon_threads = True
+    _stop_on_sigterm()
+    print(f"Wigli daemon listening at {path}", flush=True)
+    streams = sys.stdin, sys.stdout, sys.stderr
+    sys.stdin = _RoutedStream("stdin", sys.stdin)
+    sys.stdout = _RoutedStream("stdout", sys.stdout)
+    sys.stderr = _RoutedStream("stderr", sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sys.stdin, sys.stdout, sys.stderr = streams
+        server.server_close()
+        if exists(path):
+            remove(path)
+    return 0
+
+
+def _stop_on_sigterm():
+    from signal import SIGTERM, signal
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    try:
+        signal(SIGTERM, stop)
+    except ValueError:
+        pass  # Not the main thread, so it can't take signals
+
+
+def _send(stream: BinaryIO, message: dict):
+    stream.write((dumps(message) + "\n").encode())
+    stream.flush()
+
+
+class _RoutedStream(object):
+    """
+    Stands in for stdin, stdout or stderr in the daemon. Each thread
+    running a client's command, including the WigliWorkerPool threads it
+    starts, uses that client's stream, and every other thread uses the
+    daemon's own.
+    """
+
+    def __init__(self, name: str, default):
+        self.name = name
+        self.default = default
+
+    def __getattr__(self, attr: str):
+        from wigli._wigli_usage import current_usage
+
+        client = current_usage().get("client")
+        stream = self.default if client is None else client[self.name]
+        return getattr(stream, attr)
+
+
+@contextmanager
+def _client_environment(env: dict):
+    """
+    Sets the client's FORWARDED_ENV variables while its command runs,
+    putting the daemon's own back afterwards.
+    """
+    import openai
+
+    env = {name: env[name] for name in FORWARDED_ENV if name in env}
+    saved = {name: environ.get(name) for name in env}
+    settings = {
+        attr: getattr(openai, attr, None) for attr in OPENAI_ENV.values()
+    }
+    environ.update(env)
+    for name, attr in OPENAI_ENV.items():
+        if name in env:
+            setattr(openai, attr, env[name])
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                environ.pop(name, None)
+            else:
+                environ[name] = value
+        for attr, value in settings.items():
+            setattr(openai, attr, value)
+
+
+class _ClientOutput(object):
+    """
+    Stands in for stdout or stderr while a command runs, sending what's
+    written to the client. Output is dropped once the client is gone, so
+    the command still finishes and saves the chat.
+    """
+
+    def __init__(self, send: Callable[[dict], None], key: str):
+        self.send = send
+        self.key = key
+
+    def write(self, text: str) -> int:
+        if text:
+            self.send({self.key: text})
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self) -> bool:
+        return False
+
+
+class _ClientInput(object):
+    """
+    Stands in for stdin while a command runs, asking the client for each
+    line the command reads.
+    """
+
+    def __init__(self, send: Callable[[dict], None], rfile: BinaryIO):
+        self.send = send
+        self.rfile = rfile
+
+    def readline(self, size: int = -1) -> str:
+        self.send({"read": True})
+        line = self.rfile.readline()
+        if not line:
+            return ""
+        return loads(line).get("line", "")
+
+    def read(self, size: int = -1) -> str:
+        return self.readline()
+
+    def isatty(self) -> bool:
+        return False
+
+
+def _run_request(
+    run: Callable[[List[str]], None],
+    request: dict,
+    rfile: BinaryIO,
+    wfile: BinaryIO,
+):
+    connected = [True]
+
+    def send(message: dict):
+        if not connected[0]:
+            return
+        try:
+            _send(wfile, message)
+        except OSError:
+            connected[0] = False
+
+    from wigli._wigli_usage import usage_context
+
+    # Only this request's threads see the client's streams, through the
+    # _RoutedStream serve puts in place of sys.stdin, stdout and stderr
+    client = {
+        "stdin": _ClientInput(send, rfile),
+        "stdout": _ClientOutput(send, "out"),
+        "stderr": _ClientOutput(send, "err"),
+    }
+    cwd = getcwd()
+    code = 0
+    with usage_context(client=client):
+        try:
+            chdir(request.get("cwd", cwd))
+            with _client_environment(request.get("env", {})):
+                run(request.get("argv", []))
+        except SystemExit as e:
+            if isinstance(e.code, int) or e.code is None:
+                code = e.code or 0
+            else:
+                print(e.code, file=sys.stderr)
+                code = 1
+        except Exception:
+            from traceback import print_exc
+
+            print_exc()
+            code = 1
+        finally:
+            chdir(cwd)
+    send({"exit": code})
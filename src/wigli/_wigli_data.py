@@ -1,18 +1,152 @@
 # wigli _wigli_data.py
 
-from appdirs import user_data_dir
-from jsonpickle import encode, decode
-from os.path import abspath, join
-from time import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from json import dumps, loads
+from os import replace, stat
+from os.path import abspath, exists, getsize, join
+from threading import Condition, Lock, Thread
+from time import localtime, strftime, time
 from typing import Callable
 
 from wigli import WigliBot, OneShotBot
 
+from wigli._wigli_bots import WigliHistory, WigliMessageStore
+from wigli._wigli_http import set_http_cache_dir
+from wigli._wigli_profile import profiled, span
 from wigli._wigli_tools import (
+    default_data_dir,
     list_dir,
     make_dir,
+    percentile,
     remove_file,
 )
+from wigli._wigli_tree import WigliChatTree, get_tree
+from wigli._wigli_usage import USAGE_FILE, USAGE_KEYS, usage_context
+
+# Decoded chats and archive listings kept between commands by the
+# daemon, keyed by path. Off unless set_chat_cache is called.
+_chat_cache = OrderedDict()
+_chat_cache_size = 0
+_listings = {}
+_cache_lock = Lock()
+
+# Every completion's metrics are appended to this file in the data
+# directory, one JSON object per line
+METRICS_FILE = "metrics.jsonl"
+_metrics_lock = Lock()
+_usage_lock = Lock()
+
+
+def set_chat_cache(size: int):
+    """
+    Keeps up to size decoded chats in memory, along with the archive's
+    file listing, reusing them until their files change. 0 turns the
+    cache off.
+    """
+    global _chat_cache_size
+    with _cache_lock:
+        _chat_cache_size = size
+        while len(_chat_cache) > size:
+            _chat_cache.popitem(last=False)
+        if size <= 0:
+            _listings.clear()
+
+
+def _transcript_key(message) -> list:
+    # Tells the last message written to a transcript apart without
+    # archiving its content again
+    return [message.role, message.timestamp]
+
+
+def _decode_chat(path: str):
+    # Imported here so commands that never read a chat skip it
+    from jsonpickle import decode
+
+    with open(path) as f:
+        return decode(f.read())
+
+
+class WigliArchiver(object):
+    """
+    Saves chats on a background thread, so an interactive session never
+    waits on the disk or on auto-titling between turns.
+
+    Saves asked for while a bot is waiting to be saved are merged into
+    one save of its latest state. While the archiver is held, for
+    example during a turn that's still changing the bot, saves wait and
+    run once it's released. A save that fails is logged, and the chat's
+    next save writes everything it missed.
+    """
+
+    def __init__(self, save: Callable[[WigliBot], None], log: Callable):
+        self.save = save
+        self.log = log
+        self.changed = Condition()
+        self.waiting = {}
+        self.saving = False
+        self.held = 0
+        self.closed = False
+        self.thread = Thread(target=self._work, daemon=True)
+        self.thread.start()
+
+    def request(self, bot: WigliBot):
+        with self.changed:
+            self.waiting[id(bot)] = bot
+            self.changed.notify_all()
+
+    def flush(self):
+        """
+        Waits until every chat asked for has been saved, or while the
+        archiver is held, until the save in progress is done.
+        """
+        with self.changed:
+            while (len(self.waiting) > 0 and self.held == 0) or self.saving:
+                self.changed.wait()
+
+    def hold(self):
+        """
+        Keeps chats from being saved until release is called, waiting
+        for the save in progress first.
+        """
+        with self.changed:
+            self.held += 1
+            while self.saving:
+                self.changed.wait()
+
+    def release(self):
+        with self.changed:
+            self.held -= 1
+            self.changed.notify_all()
+
+    def close(self):
+        """
+        Saves the chats still waiting, then stops the thread.
+        """
+        with self.changed:
+            self.closed = True
+            self.changed.notify_all()
+        self.thread.join()
+
+    def _work(self):
+        while True:
+            with self.changed:
+                while (
+                    len(self.waiting) == 0 or self.held > 0
+                ) and not self.closed:
+                    self.changed.wait()
+                if len(self.waiting) == 0:
+                    return
+                bot = self.waiting.pop(next(iter(self.waiting)))
+                self.saving = True
+            try:
+                self.save(bot)
+            except Exception as e:
+                self.log(f"[ERROR: COULDN'T SAVE THE CHAT: {e}]", v=0)
+            finally:
+                with self.changed:
+                    self.saving = False
+                    self.changed.notify_all()
 
 
 class WigliData(object):
@@ -31,6 +165,10 @@ class WigliData(object):
         Beneath data_dir, stores pretty human-readable transcripts of chats.
     logs_dir: str
         Beneath data_dir, stores event log files.
+    web_cache_dir: str
+        Beneath data_dir, caches downloaded webpages.
+    trees_dir: str
+        Beneath data_dir, stores every branch of each chat as a tree.
     verbosity: int, optional
         Level of verbosity at which to log events.
 
@@ -42,6 +180,24 @@ class WigliData(object):
         Returns all files in the
     print_chat_history_oneline()
         Prints a numbered list of conversations in the archive.
+    list_branches()
+        Returns a summary of each branch of a chat.
+    switch_branch()
+        Replaces a bot's messages with those of another branch.
+    record_completion()
+        Appends a completion's metrics to the metrics file.
+    completion_stats()
+        Summarizes the metrics file by model and bot class.
+    record_usage()
+        Appends a request's tokens to the usage ledger.
+    usage_summary()
+        Adds up the usage ledger by day, model, chat, bot or command.
+    archive_in_background()
+        Saves chats on a background thread from now on, or stops.
+    flush_archive()
+        Waits for chats being saved in the background.
+    holding_archive()
+        Holds background saves until the with block ends.
     log()
         Event logger with a range of verbosities.
         Always log to file and sometimes log to console too.
@@ -71,19 +227,30 @@ class WigliData(object):
         if data_dir is not None:
             self.data_dir = data_dir
         else:
-            self.data_dir = user_data_dir(
-                appname="Wigli", appauthor="VulcanicAI"
-            )
+            self.data_dir = default_data_dir()
 
         self.convos_dir = join(self.data_dir, "Wigli Files")
         self.scripts_dir = join(self.data_dir, "Pretty Chats")
         self.logs_dir = join(self.data_dir, "Debug Logs")
+        self.web_cache_dir = join(self.data_dir, "Web Cache")
+        self.trees_dir = join(self.data_dir, "Chat Trees")
 
         make_dir(self.data_dir)
         make_dir(self.convos_dir)
         make_dir(self.scripts_dir)
         make_dir(self.logs_dir)
+        make_dir(self.trees_dir)
+
+        # Every fetch in this process shares one pooled, cached client
+        set_http_cache_dir(self.web_cache_dir)
 
+    def __getstate__(self):
+        # The background archiver's thread can't be archived with a chat
+        state = dict(self.__dict__)
+        state.pop("_archiver", None)
+        return state
+
+    @profiled("data.list_chats")
     def list_chats(self, suffix=".json"):
         """
         Returns a list of all chats in the archive.
@@ -100,13 +267,27 @@ class WigliData(object):
             Data directory, in chronological order
             (because the filenames start with their touchstamps)
         """
-        return sorted(
+        if _chat_cache_size > 0 and exists(self.convos_dir):
+            # A directory's mtime changes whenever a file is added or
+            # removed, which is all archiving does to it
+            key = (self.convos_dir, suffix)
+            mtime = stat(self.convos_dir).st_mtime_ns
+            with _cache_lock:
+                cached = _listings.get(key)
+            if cached is not None and cached[0] == mtime:
+                return list(cached[1])
+        logs = sorted(
             [
                 log
                 for log in list_dir(self.convos_dir)
                 if suffix in log
             ]
         )
+        if _chat_cache_size > 0 and exists(self.convos_dir):
+            with _cache_lock:
+                _listings[key] = (mtime, logs)
+            return list(logs)
+        return logs
 
     def print_chat_history_oneline(self, begin=0, end=None):
         """
@@ -126,41 +307,409 @@ class WigliData(object):
             end = len(logs)
 
         for n in range(end, begin, -1):
+            chat = self.read_chat(logs[len(logs) - n], messages=False)
+            if (
+                len(getattr(chat, "messages", [])) > 0
+                or getattr(chat, "_tree_node", None) is not None
+            ):
+                print(
+                    f"{n}: {getattr(chat, 'title', 'No Title')}\n",
+                    sep="",
+                    end="",
+                )
+
+    @profiled("data.read_chat")
+    def read_chat(self, filename: str, messages: bool = True):
+        """
+        Loads a chat from a JSON file in the archive.
+
+        Parameters
+        ----------
+        filename: str
+            The file's name within convos_dir.
+        messages: bool, optional
+            Whether to read the chat's messages back from its tree, if
+            they were left out of the JSON file. Without them, the bot's
+            _tree_node says whether it has any.
+
+        Returns
+        -------
+        WigliBot
+            The archived bot.
+        """
+        path = join(self.convos_dir, filename)
+        if _chat_cache_size <= 0:
+            chat = _decode_chat(path)
+            if messages:
+                self._restore_messages(chat)
+            return chat
+
+        info = stat(path)
+        version = (info.st_mtime_ns, info.st_size)
+        with _cache_lock:
+            cached = _chat_cache.get(path)
+            if cached is not None and cached[0] == version:
+                _chat_cache.move_to_end(path)
+        if cached is None or cached[0] != version:
+            cached = (version, _decode_chat(path))
+            with _cache_lock:
+                _chat_cache[path] = cached
+                while len(_chat_cache) > _chat_cache_size:
+                    _chat_cache.popitem(last=False)
+        chat = cached[1]
+        if isinstance(chat, WigliBot):
+            # Each command gets a fork, leaving the cached chat as it is
+            # on disk. It's given no data so forking never archives it.
+            archived = {
+                name: chat.__dict__[name]
+                for name in ("_tree_node", "_transcript")
+                if chat.__dict__.get(name) is not None
+            }
+            chat = type(chat).FromBot(chat, data=None)
+            chat.__dict__.update(archived)
+            if messages:
+                self._restore_messages(chat)
+        return chat
+
+    def _restore_messages(self, chat):
+        """
+        Gives a chat read from the archive the messages that were left
+        in its tree, unless the JSON file had them.
+        """
+        if not isinstance(chat, WigliBot):
+            return
+        node = chat.__dict__.pop("_tree_node", None)
+        if node is None:
+            return
+        if len(chat.messages) > 0:
+            # The next sync checks that the node still ends them
+            chat._tree_sync = (len(chat.messages), node, chat.messages[-1])
+            return
+        tree = self.chat_tree(chat)
+        if node not in tree.nodes:
+            self.log(
+                "[ERROR: THIS CHAT'S MESSAGES ARE MISSING FROM ITS TREE]",
+                v=0,
+            )
+            return
+        messages = tree.messages_to(node)
+        chat.messages = (
+            WigliMessageStore(messages)
+            if getattr(chat, "compact", False)
+            else WigliHistory(messages)
+        )
+        chat._tree_sync = (len(messages), node, messages[-1])
+
+    def chat_tree(self, bot: WigliBot) -> WigliChatTree:
+        """
+        Returns the tree holding every branch of a bot's chat.
+        """
+        return get_tree(
+            join(self.trees_dir, f"tree_{bot.birthstamp}.jsonl")
+        )
+
+    def list_branches(self, bot: WigliBot) -> list:
+        """
+        Returns a summary of each branch of a bot's chat, as described
+        in WigliChatTree.list_branches.
+        """
+        return self.chat_tree(bot).list_branches()
+
+    def switch_branch(self, bot: WigliBot, branch: int) -> bool:
+        """
+        Replaces a bot's messages with those of another branch of its
+        chat, so chatting resumes from there.
+
+        Returns
+        -------
+        bool
+            Whether the branch exists.
+        """
+        tree = self.chat_tree(bot)
+        if branch not in tree.branches:
+            self.log(f"[ERROR: NO BRANCH {branch} IN THIS CHAT]", v=0)
+            return False
+        messages = tree.messages(branch)
+        bot.messages = (
+            WigliMessageStore(messages)
+            if getattr(bot, "compact", False)
+            else WigliHistory(messages)
+        )
+        bot.branch = branch
+        if len(messages) > 0:
+            bot._tree_sync = (
+                len(messages),
+                tree.branches[branch],
+                messages[-1],
+            )
+        self.log(f"Switched to branch {branch}")
+        return True
+
+    def record_completion(self, metrics: dict):
+        """
+        Appends a completion's metrics, as described in
+        WigliBot._record_completion, to the metrics file.
+        """
+        line = dumps(metrics) + "\n"
+        with _metrics_lock:
             with open(
-                join(
-                    self.convos_dir,
-                    logs[len(logs) - n],
+                join(self.data_dir, METRICS_FILE), "a", encoding="utf-8"
+            ) as f:
+                f.write(line)
+
+    def completion_stats(self, since: float | None = None) -> list:
+        """
+        Summarizes the completions in the metrics file by model and bot
+        class, which tells plugins like PythonBot apart.
+
+        Parameters
+        ----------
+        since: float, optional
+            Leave out completions from before this timestamp.
+
+        Returns
+        -------
+        list
+            A dict for each model and bot class, busiest first, with the
+            "model", "bot", number of "calls", total "prompt_tokens" and
+            "completion_tokens", and dicts of the 50th, 95th and 99th
+            percentile "first_token", "inter_token" and "seconds" times,
+            and "tokens_per_second" rates, keyed by 50, 95 and 99. Only
+            streamed completions have first token and inter-token times,
+            and the inter-token percentiles are taken across each
+            completion's median.
+        """
+        groups = {}
+        try:
+            f = open(join(self.data_dir, METRICS_FILE), encoding="utf-8")
+        except OSError:
+            return []
+        with f:
+            for line in f:
+                try:
+                    metrics = loads(line)
+                except ValueError:
+                    continue  # A write interrupted part way
+                if since is not None and metrics["timestamp"] < since:
+                    continue
+                key = (metrics["model"], metrics["bot"])
+                group = groups.setdefault(
+                    key,
+                    {
+                        "calls": 0,
+                        "prompt_tokens": 0,
+                        "completion_tokens": 0,
+                        "first_token": [],
+                        "inter_token": [],
+                        "seconds": [],
+                        "tokens_per_second": [],
+                    },
+                )
+                group["calls"] += 1
+                group["prompt_tokens"] += metrics["prompt_tokens"] or 0
+                group["completion_tokens"] += (
+                    metrics["completion_tokens"] or 0
                 )
-            ) as json_file:
-                chat = decode(json_file.read())
-                if len(getattr(chat, "messages", [])) > 0:
-                    print(
-                        f"{n}: {getattr(chat, 'title', 'No Title')}\n",
-                        sep="",
-                        end="",
+                group["seconds"].append(metrics["seconds"])
+                if metrics["first_token"] is not None:
+                    group["first_token"].append(metrics["first_token"])
+                if metrics["inter_token_p50"] is not None:
+                    group["inter_token"].append(metrics["inter_token_p50"])
+                if metrics["completion_tokens"] and metrics["seconds"] > 0:
+                    group["tokens_per_second"].append(
+                        metrics["completion_tokens"] / metrics["seconds"]
                     )
 
+        stats = []
+        for (model, bot), group in groups.items():
+            for name in (
+                "first_token",
+                "inter_token",
+                "seconds",
+                "tokens_per_second",
+            ):
+                group[name] = {
+                    q: percentile(group[name], q) for q in (50, 95, 99)
+                }
+            stats.append({"model": model, "bot": bot, **group})
+        stats.sort(key=lambda group: -group["calls"])
+        return stats
+
+    def record_usage(self, entry: dict):
+        """
+        Appends a request's entry, as described in WigliBot._record_usage,
+        to the usage ledger.
+        """
+        line = dumps(entry) + "\n"
+        with _usage_lock:
+            with open(
+                join(self.data_dir, USAGE_FILE), "a", encoding="utf-8"
+            ) as f:
+                f.write(line)
+
+    def usage_summary(
+        self, by: tuple = ("day", "model"), since: float | None = None
+    ) -> list:
+        """
+        Adds up the tokens in the usage ledger.
+
+        Parameters
+        ----------
+        by: tuple, optional
+            What to group the entries by, any of USAGE_KEYS. "day" is
+            the local date, like 2023-04-03.
+        since: float, optional
+            Leave out entries from before this timestamp.
+
+        Returns
+        -------
+        list
+            A dict for each group, in order, with its keys and the number
+            of "requests", their "prompt_tokens", "completion_tokens",
+            total "tokens" and estimated "cost" in US dollars. The cost
+            leaves out requests to models without a known price. A
+            chat's group is given the filename it had at its latest
+            request.
+        """
+        for key in by:
+            if key not in USAGE_KEYS:
+                raise ValueError(f"can't group usage by {key!r}")
+        groups = {}
+        try:
+            f = open(join(self.data_dir, USAGE_FILE), encoding="utf-8")
+        except OSError:
+            return []
+        with f:
+            for line in f:
+                try:
+                    entry = loads(line)
+                except ValueError:
+                    continue  # A write interrupted part way
+                if since is not None and entry["timestamp"] < since:
+                    continue
+                entry["day"] = strftime(
+                    "%Y-%m-%d", localtime(entry["timestamp"])
+                )
+                # A chat's filename changes each time it's saved, so its
+                # entries are grouped by its birthstamp instead
+                values = tuple(
+                    entry.get("birthstamp", entry["chat"])
+                    if key == "chat"
+                    else entry.get(key)
+                    for key in by
+                )
+                group = groups.setdefault(
+                    values,
+                    {
+                        "requests": 0,
+                        "prompt_tokens": 0,
+                        "completion_tokens": 0,
+                        "tokens": 0,
+                        "cost": 0.0,
+                    },
+                )
+                prompt_tokens = entry["prompt_tokens"] or 0
+                completion_tokens = entry["completion_tokens"] or 0
+                group["requests"] += 1
+                group["prompt_tokens"] += prompt_tokens
+                group["completion_tokens"] += completion_tokens
+                group["tokens"] += prompt_tokens + completion_tokens
+                group["cost"] += entry["cost"] or 0.0
+                if "chat" in by and entry["chat"] is not None:
+                    group["chat"] = entry["chat"]
+
+        return [
+            {
+                **dict(zip(by, values)),
+                **group,
+                "cost": round(group["cost"], 6),
+            }
+            for values, group in sorted(
+                groups.items(), key=lambda item: [str(v) for v in item[0]]
+            )
+        ]
+
+    def archive_in_background(self, enabled: bool = True):
+        """
+        Makes archive_chat hand chats to a background thread to save, or
+        with enabled=False, saves what's waiting and goes back to saving
+        chats as they change.
+        """
+        archiver = self.__dict__.get("_archiver")
+        if enabled and archiver is None:
+            self._archiver = WigliArchiver(self._archive_chat, self.log)
+        elif not enabled and archiver is not None:
+            del self._archiver
+            archiver.close()
+
+    def flush_archive(self):
+        """
+        Waits until the chats handed to the background thread are saved.
+        """
+        archiver = self.__dict__.get("_archiver")
+        if archiver is not None:
+            archiver.flush()
+
+    @contextmanager
+    def holding_archive(self):
+        """
+        Holds the chats handed to the background thread in the with
+        block, so a bot isn't saved while it's still changing. They're
+        saved once, in their final state, after the block.
+        """
+        archiver = self.__dict__.get("_archiver")
+        if archiver is None:
+            yield
+            return
+        archiver.hold()
+        try:
+            yield
+        finally:
+            archiver.release()
+
     def archive_chat(self, bot: WigliBot):
+        archiver = self.__dict__.get("_archiver")
+        if archiver is not None:
+            archiver.request(bot)
+            return
+        self._archive_chat(bot)
+
+    @profiled("data.archive")
+    def _archive_chat(self, bot: WigliBot):
         if len(bot.messages) <= 0:
             return
 
+        # Only the messages since the last sync are looked at, and only
+        # those the tree hasn't seen yet are written to it
+        with span("data.tree"):
+            tree = self.chat_tree(bot)
+            synced = bot.__dict__.pop("_tree_sync", None)
+            try:
+                with tree.locked():
+                    bot.branch, synced = tree.sync(
+                        bot.messages,
+                        getattr(bot, "branch", None),
+                        synced=None if synced is None else synced[:2],
+                    )
+                    tree.save()
+                bot._tree_sync = (*synced, bot.messages[-1])
+            except OSError as e:
+                # The JSON file keeps the messages instead
+                self.log(f"[ERROR: COULDN'T SAVE THE CHAT'S TREE: {e}]", v=0)
+
         old_filename = bot.filename
         overwrite = False
         if old_filename is not None:
-            with open(
-                join(
-                    self.convos_dir,
-                    "chat_" + old_filename + ".json",
-                )
-            ) as f:
-                old_archive = decode(f.read())
-                assert isinstance(old_archive, WigliBot)
-                if old_archive.birthstamp == bot.birthstamp:
-                    overwrite = True
+            old_archive = self.read_chat(
+                "chat_" + old_filename + ".json", messages=False
+            )
+            assert isinstance(old_archive, WigliBot)
+            if old_archive.birthstamp == bot.birthstamp:
+                overwrite = True
 
         bot.touchstamp = time()
-        self.write_files(bot)
-        if overwrite:
+        self.write_files(bot, previous=old_filename if overwrite else None)
+        if overwrite and old_filename != bot.filename:
             remove_file(
                 join(
                     self.convos_dir,
@@ -183,6 +732,7 @@ class WigliData(object):
             self.log(("Couldn't open file:", filepath))
             pass
 
+    @profiled("data.title")
     def title_transcript(self, transcript):
         injection_transcript_titler_bot = [
             {
@@ -205,13 +755,59 @@ Here is the transcript I would like you to title. Please just respond with the m
             messages=injection_transcript_titler_bot,
         )
 
-    def write_files(self, bot: WigliBot):
-        script = bot.format_transcript_markdown()
+    @profiled("data.write")
+    def write_files(self, bot: WigliBot, previous: str | None = None):
+        """
+        Saves a bot's chat JSON file and its Markdown transcript.
+
+        Parameters
+        ----------
+        bot: WigliBot
+            The bot whose chat to save.
+        previous: str, optional
+            The filename the chat was last saved under, if these files
+            replace those. The old transcript is then moved and only the
+            new messages are appended to it.
+        """
+        from jsonpickle import encode
+
         if bot.title is None:
             self.log("Auto-titling transcript")
-            bot.title = self.title_transcript(script)
+            # The titler's request is put in the ledger under the chat
+            with usage_context(
+                data=self, birthstamp=bot.birthstamp, command="title"
+            ):
+                bot.title = self.title_transcript(
+                    "\n\n".join(bot.markdown_fragments())
+                )
             self.log(("Auto-titled:", bot.title))
         bot.make_filename()
+        txt_filename = "transcript_" + bot.filename + ".md"
+        txt_filepath = join(self.scripts_dir, txt_filename)
+        encoding = self._append_transcript(bot, previous, txt_filepath)
+        if encoding is None:
+            encoding = self._write_transcript(
+                "\n\n".join(bot.markdown_fragments()), txt_filepath
+            )
+        # Archived with the bot, so a later process resuming the chat can
+        # append too. The file's encoding is kept so appends match what's
+        # there, and its size to tell if anything else changed it
+        try:
+            size = getsize(txt_filepath)
+        except OSError:
+            size = None
+        bot._transcript = (
+            txt_filepath,
+            len(bot.messages),
+            (
+                _transcript_key(bot.messages[-1])
+                if len(bot.messages) > 0
+                else None
+            ),
+            size,
+            encoding,
+        )
+        # The transcript is written first, so the JSON file records it
         json_filename = "chat_" + bot.filename + ".json"
         json_filepath = join(self.convos_dir, json_filename)
         abspath_json_filepath = abspath(json_filepath)
@@ -225,15 +821,81 @@ Here is the transcript I would like you to title. Please just respond with the m
                     abspath_json_filepath,
                 )
             )
-            f.write(encode(bot, f, indent=4))
-        txt_filename = "transcript_" + bot.filename + ".md"
-        txt_filepath = join(self.scripts_dir, txt_filename)
+            # The messages are left out if the chat's tree has them all,
+            # as it does once the chat was synced to it
+            with WigliBot.archiving_in_tree():
+                f.write(encode(bot, f, indent=4))
+
+    def _append_transcript(
+        self,
+        bot: WigliBot,
+        previous: str | None,
+        txt_filepath: str,
+    ) -> str | None:
+        """
+        Moves the previous transcript to txt_filepath and appends the
+        messages it's missing.
+
+        Returns
+        -------
+        str
+            The transcript's encoding, or None if it has to be written
+            in full instead.
+        """
+        written = bot.__dict__.get("_transcript")
+        if previous is None or written is None:
+            return None
+        try:
+            old_filepath, count, last, size, encoding = written
+        except (TypeError, ValueError):
+            return None
+        if (
+            encoding is None
+            or old_filepath
+            != join(self.scripts_dir, "transcript_" + previous + ".md")
+            or not exists(old_filepath)
+            or getsize(old_filepath) != size
+        ):
+            return None
+        # The file still matches if the last message written is still in
+        # its place, which it isn't after an erase
+        if (
+            count == 0
+            or count > len(bot.messages)
+            or last is None
+            or list(last) != _transcript_key(bot.messages[count - 1])
+        ):
+            return None
+        try:
+            replace(old_filepath, txt_filepath)
+            with open(txt_filepath, "a", encoding=encoding) as f:
+                self.log(
+                    ("Appending to transcript text file at", txt_filepath)
+                )
+                f.write(
+                    "".join(
+                        "\n\n" + fragment
+                        for fragment in bot.markdown_fragments(count)
+                    )
+                )
+        except (OSError, UnicodeError):
+            return None
+        return encoding
+
+    def _write_transcript(
+        self, script: str, txt_filepath: str
+    ) -> str | None:
+        """
+        Writes a whole transcript, returning the encoding it was written
+        in or None if it couldn't be.
+        """
         with self.open_file(txt_filepath, open_type="w") as f:
             self.log(
                 ("Saving transcript text file at", txt_filepath)
             )
             try:
                 f.writelines([script])
+                return "utf-16"
             except BaseException:
                 with self.open_file(
                     txt_filepath,
@@ -242,6 +904,7 @@ Here is the transcript I would like you to title. Please just respond with the m
                 ) as f:
                     try:
                         f.writelines([script])
+                        return "utf-32"
                     except BaseException:
                         self.log(
                             (
@@ -0,0 +1,384 @@
+# wigli _wigli_http.py
+
+from email.utils import formatdate, parsedate_to_datetime
+from hashlib import sha256
+from json import dump, load
+from os import replace, scandir, utime
+from os.path import join
+from threading import Lock
+from time import time
+from typing import TYPE_CHECKING
+
+from wigli._wigli_tools import make_dir, remove_file
+
+if TYPE_CHECKING:
+    from urllib3 import PoolManager
+
+HTTP_CACHE_SIZE = 64 * 2**20
+HTTP_TIMEOUT = 30
+# Pages are cut off after this many bytes, which is already far more
+# text than fits in a summarization prompt
+MAX_PAGE_BYTES = 2 * 2**20
+HTTP_CHUNK_SIZE = 64 * 2**10
+HTTP_HEADERS = {"User-Agent": "Mozilla/5.0 (compatible; Wigli)"}
+# Fraction of a page's age since Last-Modified it is assumed to stay
+# fresh for when the server doesn't say (RFC 9111 section 4.2.2)
+HEURISTIC_FRESHNESS = 0.1
+
+_http = None
+_http_lock = Lock()
+
+
+def parse_cache_control(value: str | None) -> dict:
+    """
+    Parses a Cache-Control header into a dict of lowercase directives.
+    Directives without a value map to True.
+    """
+    directives = {}
+    for directive in (value or "").split(","):
+        name, _, arg = directive.strip().partition("=")
+        if name:
+            directives[name.lower()] = arg.strip('"') if arg else True
+    return directives
+
+
+def freshness_lifetime(headers: dict, stored_at: float) -> float:
+    """
+    Returns how many seconds after stored_at a response stays fresh.
+    """
+    directives = parse_cache_control(headers.get("cache-control"))
+    if "no-cache" in directives:
+        return 0
+    try:
+        return float(directives["max-age"])
+    except (KeyError, ValueError):
+        pass
+    try:
+        if "expires" in headers:
+            expires = parsedate_to_datetime(headers["expires"]).timestamp()
+            return max(0, expires - stored_at)
+        if "last-modified" in headers:
+            modified = parsedate_to_datetime(
+                headers["last-modified"]
+            ).timestamp()
+            return max(0, (stored_at - modified) * HEURISTIC_FRESHNESS)
+    except (TypeError, ValueError):
+        pass
+    return 0
+
+
+def read_capped(response, max_bytes: int | None) -> tuple:
+    """
+    Streams a response body in chunks, stopping after max_bytes.
+
+    Returns
+    -------
+    tuple
+        The body and whether it was cut off.
+    """
+    chunks = []
+    size = 0
+    for chunk in response.stream(HTTP_CHUNK_SIZE):
+        chunks.append(chunk)
+        size += len(chunk)
+        if max_bytes is not None and size >= max_bytes:
+            body = b"".join(chunks)
+            return body[:max_bytes], size > max_bytes or not _at_end(response)
+    return b"".join(chunks), False
+
+
+def _at_end(response) -> bool:
+    try:
+        return len(response.read(1)) == 0
+    except Exception:
+        return False
+
+
+class WigliHTTPCache(object):
+    """
+    An on-disk cache of HTTP responses, evicted least-recently-used
+    once it grows past max_size bytes.
+
+    Each entry is a JSON metadata file and a body file named after the
+    hash of the URL. Hit and miss counters are kept in stats.json so
+    they survive between CLI invocations.
+
+    Attributes
+    ----------
+    cache_dir: str
+        Where the cached responses are stored.
+    max_size: int
+        The maximum total size of the cached bodies in bytes.
+    """
+
+    STAT_NAMES = ["hits", "revalidated", "misses", "stored", "evicted"]
+
+    def __init__(self, cache_dir: str, max_size: int = HTTP_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self._lock = Lock()
+        make_dir(self.cache_dir)
+
+    def _path(self, url: str) -> str:
+        return join(self.cache_dir, sha256(url.encode()).hexdigest())
+
+    def get(self, url: str) -> dict | None:
+        """
+        Returns the cached entry for a URL, with its body, or None.
+        """
+        path = self._path(url)
+        try:
+            with open(path + ".json") as f:
+                entry = load(f)
+            with open(path + ".body", "rb") as f:
+                entry["body"] = f.read()
+        except (OSError, ValueError):
+            return None
+        if entry.get("url") != url:
+            return None
+        # Mark as recently used for eviction
+        try:
+            utime(path + ".body")
+        except OSError:
+            pass
+        return entry
+
+    def _write(
+        self,
+        url: str,
+        status: int,
+        headers: dict,
+        body: bytes,
+        truncated: bool = False,
+    ):
+        path = self._path(url)
+        entry = {
+            "url": url,
+            "status": status,
+            "headers": headers,
+            "stored_at": time(),
+            "truncated": truncated,
+        }
+        with self._lock:
+            with open(path + ".body.tmp", "wb") as f:
+                f.write(body)
+            with open(path + ".json.tmp", "w") as f:
+                dump(entry, f)
+            replace(path + ".body.tmp", path + ".body")
+            replace(path + ".json.tmp", path + ".json")
+
+    def put(
+        self,
+        url: str,
+        status: int,
+        headers: dict,
+        body: bytes,
+        truncated: bool = False,
+    ):
+        self._write(url, status, headers, body, truncated=truncated)
+        self.count("stored")
+        self.evict()
+
+    def refresh(self, url: str, entry: dict, headers: dict):
+        """
+        Restarts an entry's freshness after a 304 Not Modified.
+        """
+        entry["headers"].update(headers)
+        self._write(
+            url,
+            entry["status"],
+            entry["headers"],
+            entry["body"],
+            truncated=entry.get("truncated", False),
+        )
+
+    def _bodies(self) -> list:
+        return [
+            e
+            for e in scandir(self.cache_dir)
+            if e.is_file() and e.name.endswith(".body")
+        ]
+
+    def evict(self):
+        with self._lock:
+            bodies = sorted(self._bodies(), key=lambda e: e.stat().st_mtime)
+            total = sum(e.stat().st_size for e in bodies)
+            for body in bodies:
+                if total <= self.max_size:
+                    break
+                total -= body.stat().st_size
+                remove_file(body.path)
+                remove_file(body.path[: -len(".body")] + ".json")
+                self._count("evicted")
+
+    def _count(self, stat: str):
+        stats = self._load_stats()
+        stats[stat] = stats.get(stat, 0) + 1
+        try:
+            with open(join(self.cache_dir, "stats.json"), "w") as f:
+                dump(stats, f)
+        except OSError:
+            pass
+
+    def count(self, stat: str):
+        with self._lock:
+            self._count(stat)
+
+    def _load_stats(self) -> dict:
+        try:
+            with open(join(self.cache_dir, "stats.json")) as f:
+                return load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def stats(self) -> dict:
+        """
+        Returns the hit, miss and eviction counters along with the
+        number of entries and bytes currently cached.
+        """
+        with self._lock:
+            stats = {name: 0 for name in self.STAT_NAMES}
+            stats.update(self._load_stats())
+            bodies = self._bodies()
+        stats["entries"] = len(bodies)
+        stats["bytes"] = sum(e.stat().st_size for e in bodies)
+        return stats
+
+    def clear(self):
+        with self._lock:
+            for e in scandir(self.cache_dir):
+                remove_file(e.path)
+
+
+class WigliHTTP(object):
+    """
+    The HTTP client shared by every Wigli fetch. Connections are pooled
+    and kept alive between requests, and responses are cached on disk
+    when a cache is configured, revalidating stale entries with
+    conditional requests.
+
+    Attributes
+    ----------
+    pool: PoolManager
+        The connection pool, created on the first request.
+    cache: WigliHTTPCache
+        The response cache, or None to always download.
+    """
+
+    def __init__(self, cache: WigliHTTPCache | None = None):
+        self._pool = None
+        self.cache = cache
+
+    @property
+    def pool(self) -> "PoolManager":
+        # urllib3 is only imported once something is downloaded
+        if self._pool is None:
+            from urllib3 import PoolManager
+
+            self._pool = PoolManager(headers=HTTP_HEADERS)
+        return self._pool
+
+    def get(
+        self,
+        url: str,
+        timeout: float | None = HTTP_TIMEOUT,
+        max_bytes: int | None = MAX_PAGE_BYTES,
+    ):
+        """
+        Downloads a URL, using the cache where the server allows it.
+
+        Parameters
+        ----------
+        url: str
+            The URL to download. Plain hostnames are fetched over http.
+        timeout: float, optional
+            Seconds to allow for the whole request.
+        max_bytes: int, optional
+            Stop reading the body after this many bytes, or None to read
+            all of it.
+
+        Returns
+        -------
+        tuple
+            The status code, a dict of lowercase headers and the body.
+        """
+        if "://" not in url:
+            url = "http://" + url
+        request_headers = {}
+        entry = self.cache.get(url) if self.cache is not None else None
+
+        if entry is not None and entry.get("truncated"):
+            # A body cut off shorter than this caller wants is no use
+            if max_bytes is None or len(entry["body"]) < max_bytes:
+                entry = None
+
+        if entry is not None:
+            lifetime = freshness_lifetime(
+                entry["headers"], entry["stored_at"]
+            )
+            if time() - entry["stored_at"] < lifetime:
+                self.cache.count("hits")
+                return entry["status"], entry["headers"], entry["body"]
+            if "etag" in entry["headers"]:
+                request_headers["If-None-Match"] = entry["headers"]["etag"]
+            if "last-modified" in entry["headers"]:
+                request_headers["If-Modified-Since"] = entry["headers"][
+                    "last-modified"
+                ]
+            elif "date" in entry["headers"]:
+                request_headers["If-Modified-Since"] = entry["headers"]["date"]
+
+        from urllib3 import Timeout
+
+        response = self.pool.request(
+            "GET",
+            url,
+            headers=request_headers or None,
+            timeout=Timeout(total=timeout) if timeout else None,
+            preload_content=False,
+        )
+        try:
+            headers = {k.lower(): v for k, v in response.headers.items()}
+            if response.status == 304 and entry is not None:
+                self.cache.count("revalidated")
+                self.cache.refresh(url, entry, headers)
+                return entry["status"], entry["headers"], entry["body"]
+            body, truncated = read_capped(response, max_bytes)
+            if truncated:
+                # Don't hand a half-read connection back to the pool
+                response.close()
+        finally:
+            response.release_conn()
+
+        if self.cache is not None:
+            self.cache.count("misses")
+            directives = parse_cache_control(headers.get("cache-control"))
+            if response.status == 200 and "no-store" not in directives:
+                headers.setdefault("date", formatdate(usegmt=True))
+                self.cache.put(
+                    url, response.status, headers, body, truncated=truncated
+                )
+        return response.status, headers, body
+
+
+def get_http() -> WigliHTTP:
+    """
+    Returns the shared WigliHTTP client, creating it on first use.
+    """
+    global _http
+    with _http_lock:
+        if _http is None:
+            _http = WigliHTTP()
+        return _http
+
+
+def set_http_cache_dir(cache_dir: str | None, max_size: int = HTTP_CACHE_SIZE):
+    """
+    Points the shared client's response cache at a directory, or turns
+    caching off when cache_dir is None.
+    """
+    http = get_http()
+    if cache_dir is None:
+        http.cache = None
+    elif http.cache is None or http.cache.cache_dir != cache_dir:
+        http.cache = WigliHTTPCache(cache_dir, max_size=max_size)
@@ -0,0 +1,508 @@
+# wigli _wigli_kernel.py
+
+# This file is also the worker's script, so it only imports the standard
+# library at the top level
+
+from atexit import register
+from collections import OrderedDict, deque
+from json import dumps, loads
+from os import dup, dup2, fdopen, write
+from queue import Empty, Queue
+from shutil import rmtree
+from subprocess import PIPE, Popen, TimeoutExpired
+from sys import executable
+from tempfile import mkdtemp
+from threading import Lock, Thread
+from time import time
+from typing import Callable, Generator
+from uuid import uuid4
+
+KERNEL_CHUNK_SIZE = 2**12
+KERNEL_SHUTDOWN_TIMEOUT = 2
+# The most output kept from one cell, half from its start and half from
+# its end, so a runaway print can't fill up memory
+KERNEL_OUTPUT_CHARS = 2**16
+# The most kernels kept running, least recently used first, so a
+# long-lived process like the daemon doesn't keep one for every chat
+KERNEL_CACHE_SIZE = 8
+
+_kernels = OrderedDict()
+_kernels_lock = Lock()
+
+
+class WigliKernel(object):
+    """
+    A long-lived Python worker process that runs code cells one at a
+    time, keeping variables and imports between them like a notebook.
+
+    Cells are sent to the worker as JSON lines over its stdin. The worker
+    sends back what each cell prints as JSON lines over its stdout,
+    followed by a message saying how the cell ended. Output written
+    straight to the file descriptors, by subprocesses for example, goes
+    to the worker's stderr and is added to the running cell's output.
+    Stderr is read separately, so after each cell the worker writes a
+    marker to it, and the cell only ends once everything before the
+    marker has been read.
+
+    A worker that crashes or runs past a cell's timeout is killed and
+    started again for the next cell, losing its variables. Cells sent
+    from several threads at once run one after another.
+
+    Attributes
+    ----------
+    process: Popen
+        The worker process, or None before the first cell and after it
+        has been killed.
+    temp_dir: str
+        A scratch directory that is deleted on shutdown.
+    cells: int
+        How many cells have been sent to this kernel.
+    restarts: int
+        How many times the worker has been started after the first.
+    """
+
+    def __init__(self):
+        self.process = None
+        self.events = None
+        self.temp_dir = mkdtemp(prefix="wigli_kernel_")
+        self.cells = 0
+        self.restarts = 0
+        self.lock = Lock()
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        if self.events is not None:
+            self.restarts += 1
+        self.kill()
+        self.process = Popen(
+            [executable, "-u", __file__],
+            stdin=PIPE,
+            stdout=PIPE,
+            stderr=PIPE,
+        )
+        # Each worker gets its own queue so a killed worker's leftover
+        # output never reaches the next one's cells
+        self.events = Queue()
+        # Unguessable, so no cell prints it by accident
+        self.marker = f"\0wigli-cell-end-{uuid4().hex}\0"
+        Thread(
+            target=_read_messages,
+            args=(self.process, self.events),
+            daemon=True,
+        ).start()
+        Thread(
+            target=_read_stderr,
+            args=(self.process, self.events, self.marker.encode()),
+            daemon=True,
+        ).start()
+
+    def execute(
+        self,
+        code: str,
+        timeout: float | None = None,
+        on_output: Callable[[str], None] | None = None,
+        cpu_limit: float | None = None,
+        memory_limit: int | None = None,
+        max_output: int = KERNEL_OUTPUT_CHARS,
+    ) -> tuple:
+        """
+        Runs a cell, starting the worker first if necessary.
+
+        Parameters
+        ----------
+        code: str
+            The Python source of the cell.
+        timeout: float, optional
+            Seconds to let the cell run before killing the worker.
+        on_output: Callable, optional
+            Called with each piece of output as the cell prints it.
+        cpu_limit: float, optional
+            Seconds of CPU time the cell may use. Only enforced where the
+            resource module is available.
+        memory_limit: int, optional
+            Bytes of data memory, the heap and private mappings, the
+            worker may use while the cell runs. Only enforced where the
+            resource module is available.
+        max_output: int, optional
+            The most characters of output to keep. Past that, the middle
+            of the output is dropped.
+
+        Returns
+        -------
+        tuple
+            The cell's combined stdout and stderr, and how it ended:
+            "ok", "error" for an uncaught exception, "exit" for a call to
+            sys.exit(), "cpu" or "memory" for hitting a limit, "timeout"
+            or "crashed".
+        """
+        cell = self.stream(
+            code,
+            timeout=timeout,
+            cpu_limit=cpu_limit,
+            memory_limit=memory_limit,
+            max_output=max_output,
+        )
+        while True:
+            try:
+                text = next(cell)
+            except StopIteration as result:
+                return result.value
+            if on_output is not None:
+                on_output(text)
+
+    def stream(
+        self,
+        code: str,
+        timeout: float | None = None,
+        cpu_limit: float | None = None,
+        memory_limit: int | None = None,
+        max_output: int = KERNEL_OUTPUT_CHARS,
+    ) -> Generator[str, None, tuple]:
+        """
+        Runs a cell like execute, yielding its output as it is printed.
+        The generator returns the same tuple as execute. Closing it
+        before the cell finishes kills the worker. Only one cell runs at
+        a time, and others wait for it to finish.
+        """
+        # Bots forked from one chat share its kernel, so cells that run
+        # at once take turns rather than mixing up each other's output
+        with self.lock:
+            if not self.alive:
+                self.start()
+            self.cells += 1
+            request = {
+                "code": code,
+                "filename": f"<cell {self.cells}>",
+                "cpu_limit": cpu_limit,
+                "memory_limit": memory_limit,
+                "marker": self.marker,
+            }
+            deadline = None if timeout is None else time() + timeout
+            output = _CappedOutput(max_output)
+
+            try:
+                self.process.stdin.write((dumps(request) + "\n").encode())
+                self.process.stdin.flush()
+            except OSError:
+                pass  # The worker is gone, its exit message is queued
+
+            finished = False
+            # The cell ends once both its status and its stderr marker are
+            # in, which are read on separate threads and can come either way
+            status = None
+            marked = False
+            try:
+                while True:
+                    remaining = None if deadline is None else deadline - time()
+                    try:
+                        if remaining is not None and remaining <= 0:
+                            raise Empty
+                        event = self.events.get(timeout=remaining)
+                    except Empty:
+                        return output.text(), "timeout"
+                    if "text" in event:
+                        output.append(event["text"])
+                        yield event["text"]
+                    elif "status" in event or "marker" in event:
+                        status = event.get("status", status)
+                        marked = marked or "marker" in event
+                        if status is not None and marked:
+                            finished = True
+                            return output.text(), status
+                    elif "exit" in event:
+                        return output.text(), status or "crashed"
+            finally:
+                if not finished:
+                    self.kill()
+
+    def restart(self):
+        """
+        Starts a fresh worker, discarding every variable.
+        """
+        with self.lock:
+            self.start()
+
+    def kill(self):
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        for pipe in (self.process.stdin, self.process.stdout):
+            try:
+                pipe.close()
+            except OSError:
+                pass
+        self.process = None
+
+    def shutdown(self):
+        """
+        Stops the worker, letting it exit on its own if it's idle, and
+        deletes the scratch directory.
+        """
+        if self.alive:
+            try:
+                self.process.stdin.close()
+                self.process.wait(KERNEL_SHUTDOWN_TIMEOUT)
+            except (OSError, TimeoutExpired):
+                pass
+        self.kill()
+        rmtree(self.temp_dir, ignore_errors=True)
+
+
+class _CappedOutput(object):
+    """
+    Collects a cell's output, keeping only its first and last
+    max_chars // 2 characters. The end is kept in a ring buffer of the
+    chunks as they arrive, so memory stays flat however much a cell
+    prints.
+    """
+
+    def __init__(self, max_chars: int):
+        self.head_chars = max_chars // 2
+        self.tail_chars = max_chars - self.head_chars
+        self.head = []
+        self.head_size = 0
+        self.tail = deque()
+        self.tail_size = 0
+        self.omitted = 0
+
+    def append(self, text: str):
+        room = self.head_chars - self.head_size
+        if room > 0:
+            self.head.append(text[:room])
+            self.head_size += len(self.head[-1])
+            text = text[room:]
+        if not text:
+            return
+        self.tail.append(text)
+        self.tail_size += len(text)
+        while self.tail_size > self.tail_chars:
+            extra = self.tail_size - self.tail_chars
+            if len(self.tail[0]) <= extra:
+                dropped = len(self.tail.popleft())
+            else:
+                self.tail[0] = self.tail[0][extra:]
+                dropped = extra
+            self.tail_size -= dropped
+            self.omitted += dropped
+
+    def text(self) -> str:
+        head, tail = "".join(self.head), "".join(self.tail)
+        if self.omitted == 0:
+            return head + tail
+        return (
+            head
+            + f"\n[... {self.omitted} CHARACTERS OF OUTPUT OMITTED ...]\n"
+            + tail
+        )
+
+
+def _read_messages(process: Popen, events: Queue):
+    for line in process.stdout:
+        try:
+            events.put(loads(line))
+        except ValueError:
+            events.put({"text": line.decode(errors="replace")})
+    events.put({"exit": process.wait()})
+
+
+def _read_stderr(process: Popen, events: Queue, marker: bytes):
+    pending = b""
+    while True:
+        chunk = process.stderr.read1(KERNEL_CHUNK_SIZE)
+        if not chunk:
+            break
+        pending += chunk
+        while marker in pending:
+            text, _, pending = pending.partition(marker)
+            if text:
+                events.put({"text": text.decode(errors="replace")})
+            events.put({"marker": True})
+        # Hold back what could be the start of a marker split across reads
+        keep = next(
+            (
+                n
+                for n in range(min(len(marker) - 1, len(pending)), 0, -1)
+                if pending.endswith(marker[:n])
+            ),
+            0,
+        )
+        if len(pending) > keep:
+            text = pending[: len(pending) - keep]
+            events.put({"text": text.decode(errors="replace")})
+            pending = pending[len(text) :]
+    if pending:
+        events.put({"text": pending.decode(errors="replace")})
+    process.stderr.close()
+
+
+def get_kernel(session: str | None = None) -> WigliKernel:
+    """
+    Returns the kernel for a chat session, creating it on first use.
+    Past KERNEL_CACHE_SIZE kernels, the least recently used one is shut
+    down, losing its variables.
+    """
+    evicted = []
+    with _kernels_lock:
+        kernel = _kernels.get(session)
+        if kernel is None:
+            kernel = _kernels[session] = WigliKernel()
+        else:
+            _kernels.move_to_end(session)
+        while len(_kernels) > KERNEL_CACHE_SIZE:
+            evicted.append(_kernels.popitem(last=False)[1])
+    for old in evicted:
+        old.shutdown()
+    return kernel
+
+
+def close_kernel(session: str | None = None):
+    """
+    Shuts down a chat session's kernel, if it has one.
+    """
+    with _kernels_lock:
+        kernel = _kernels.pop(session, None)
+    if kernel is not None:
+        kernel.shutdown()
+
+
+@register
+def shutdown_kernels():
+    with _kernels_lock:
+        kernels = list(_kernels.values())
+        _kernels.clear()
+    for kernel in kernels:
+        kernel.shutdown()
+
+
+def _serve():
+    """
+    The worker's main loop. Runs each cell read from stdin in one shared
+    namespace until stdin is closed.
+    """
+    import linecache
+    import sys
+    from io import StringIO, TextIOBase
+    from math import ceil
+    from traceback import print_exception
+
+    try:
+        import resource
+    except ImportError:
+        # Not available on Windows, where limits aren't enforced
+        resource = None
+
+    class CPULimitExceeded(BaseException):
+        # Not an Exception, so a cell's own error handling won't catch it
+        pass
+
+    def on_cpu_limit(signum, frame):
+        raise CPULimitExceeded()
+
+    def set_limits(cpu_limit: float | None, memory_limit: int | None):
+        if resource is None:
+            return
+        # Only the soft limits change, since lowering a hard limit can't
+        # be undone
+        hard = resource.getrlimit(resource.RLIMIT_CPU)[1]
+        soft = hard
+        if cpu_limit is not None:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            soft = ceil(usage.ru_utime + usage.ru_stime + cpu_limit)
+            if hard != resource.RLIM_INFINITY:
+                soft = min(soft, hard)
+        resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+        hard = resource.getrlimit(memory_rlimit)[1]
+        soft = hard
+        if memory_limit is not None:
+            soft = memory_limit
+            if hard != resource.RLIM_INFINITY:
+                soft = min(soft, hard)
+        resource.setrlimit(memory_rlimit, (soft, hard))
+
+    if resource is not None:
+        from signal import SIGXCPU, signal
+
+        # Limiting the address space would also count memory that's only
+        # reserved, like the thread stacks and arenas numpy's BLAS sets
+        # up on import, so the heap and private mappings are limited
+        # instead where the platform can
+        memory_rlimit = getattr(resource, "RLIMIT_DATA", resource.RLIMIT_AS)
+
+        signal(SIGXCPU, on_cpu_limit)
+
+    # Behave like "python -c", not like a script in this directory
+    sys.path[0] = ""
+    # Keep the real stdout for messages, and send anything else written
+    # to file descriptor 1 to stderr where the client still collects it
+    messages = fdopen(dup(1), "w")
+    dup2(2, 1)
+    requests = sys.stdin
+    sys.stdin = StringIO()
+    lock = Lock()
+
+    def send(message: dict):
+        with lock:
+            messages.write(dumps(message) + "\n")
+            messages.flush()
+
+    class Stream(TextIOBase):
+        def writable(self) -> bool:
+            return True
+
+        def write(self, text: str) -> int:
+            if text:
+                send({"text": text})
+            return len(text)
+
+    sys.stdout = sys.stderr = Stream()
+    namespace = {"__name__": "__main__", "__builtins__": __builtins__}
+
+    def end_output(marker: str):
+        # Anything the cell wrote to the file descriptors is read before
+        # the marker, and the marker before the status
+        for stream in (sys.__stdout__, sys.__stderr__):
+            try:
+                stream.flush()
+            except (OSError, ValueError):
+                pass
+        data = marker.encode()
+        while data:
+            data = data[write(2, data) :]
+
+    for line in requests:
+        request = loads(line)
+        code, filename = request["code"], request["filename"]
+        # Lets tracebacks quote the cell's source
+        linecache.cache[filename] = (
+            len(code),
+            None,
+            code.splitlines(True),
+            filename,
+        )
+        status = "ok"
+        try:
+            set_limits(request.get("cpu_limit"), request.get("memory_limit"))
+            exec(compile(code, filename, "exec"), namespace)
+        except SystemExit:
+            status = "exit"
+        except CPULimitExceeded:
+            status = "cpu"
+        except BaseException as e:
+            # Lift the limits first, formatting the traceback needs memory
+            set_limits(None, None)
+            status = "memory" if isinstance(e, MemoryError) else "error"
+            # Leave this loop's frame out of the traceback
+            tb = e.__traceback__
+            print_exception(type(e), e, tb.tb_next if tb else None)
+        set_limits(None, None)
+        end_output(request["marker"])
+        send({"status": status})
+
+
+if __name__ == "__main__":
+    _serve()
@@ -1,13 +1,22 @@
 # wigli _wigli_plugins.py
 
-from duckduckgo_search import ddg
 from os.path import join
 from subprocess import run
-from sys import executable
+from sys import platform
+from threading import Event
+from time import time
 from typing import List
 
-from wigli._wigli_tools import scrape_html_text, count_tokens
-from wigli._wigli_bots import CH_PER_TOK, MAX_TOKENS
+from wigli._wigli_tools import (
+    SCRAPE_ERR_MSG,
+    count_tokens,
+    scrape_html_text,
+    split_tokens,
+    truncate_tokens,
+)
+from wigli._wigli_bots import MAX_TOKENS, WigliWorkerPool, query_cache_key
+from wigli._wigli_kernel import get_kernel
+from wigli._wigli_profile import profiled
 
 from wigli import (
     WigliMessage,
@@ -18,6 +27,28 @@ from wigli import (
 )
 
 NUM_RESULTS = 3
+DIGEST_WORKERS = 3
+PAGE_TIMEOUT = 30
+# Pages too long for one prompt are summarized in up to SUMMARY_CHUNKS
+# parts, SUMMARY_WORKERS at a time, and the parts are then combined
+SUMMARY_CHUNKS = 4
+SUMMARY_WORKERS = 4
+# Limits on each PythonBot code block, on top of the command's timeout
+PYTHON_CPU_LIMIT = 60
+# Bytes of data memory, which can be changed with --python-memory
+PYTHON_MEMORY_LIMIT = 2**32
+PYTHON_OUTPUT_TOKENS = 2**10
+
+
+def ddg(query: str) -> list:
+    """
+    Searches DuckDuckGo. duckduckgo_search is imported on the first
+    search, since loading a chat can import this module.
+    """
+    from duckduckgo_search import ddg
+
+    return ddg(query)
+
 
 # Simple Behavioral Injections
 
@@ -94,7 +125,7 @@ injection_python = [
     {
         "role": "system",
         "content": """\
-You are a very advanced assistant with expert-level knowledge of Python programming, and a Python interpreter at your fingertips! A parser is now running which will extract any code formatted in Python markdown style (```python\\n<your_code>\\n```) and ask if you want to run it. Simply surround your code with "```python" and "```", say yes to the confirmation, and your code will be written to a .py file and executed with a python 3.10 interpreter! You use this tool creatively to perform tasks for the user. Your code is always self-explaining or well-commented, and you always prefer to use type hints and Sphinx docstrings. In addition, you know that all code as bugs the first time, and you build this assumption into your code. You always put lots of print statements in your code to tell stdout what's going on. The interpreter and parser have been enabled! Go ahead and verify that it's working! Feel free to explain your reasoning afterward.""",
+You are a very advanced assistant with expert-level knowledge of Python programming, and a Python interpreter at your fingertips! A parser is now running which will extract any code formatted in Python markdown style (```python\\n<your_code>\\n```) and ask if you want to run it. Simply surround your code with "```python" and "```", say yes to the confirmation, and your code will be run in a persistent Python interpreter, like a notebook, where the variables and imports from your earlier code blocks are still available! You use this tool creatively to perform tasks for the user. Your code is always self-explaining or well-commented, and you always prefer to use type hints and Sphinx docstrings. In addition, you know that all code as bugs the first time, and you build this assumption into your code. You always put lots of print statements in your code to tell stdout what's going on. The interpreter and parser have been enabled! Go ahead and verify that it's working! Feel free to explain your reasoning afterward.""",
     },
     {
         "role": "assistant",
@@ -183,8 +214,10 @@ You can even search the news for current events! Do you understand?""",
         "content": """\
 You may be creative in how you use these tools, and experiment with \
 new ways to use them. Sometimes it's better not to use them and to go \
-off of intuition instead. Your 'summarize_url' and 'search_web' \
-commands have just been enabled. Feel free to use \
+off of intuition instead. When you need more than search snippets, \
+'search_digest' works like 'search_web' but also summarizes every \
+result page for you in one step. Your 'summarize_url', 'search_web' \
+and 'search_digest' commands have just been enabled. Feel free to use \
 them as appropriate.""",
     },
 ]
@@ -196,7 +229,8 @@ reminder_search = [
 Remember,  you can always use summarize_url(<url>) to learn about \
 a web URL, and search_web(<query>) to get the top\
 {(' ' if NUM_RESULTS <= 1 else ' ' + str(NUM_RESULTS) + ' ')}\
- result{'' if NUM_RESULTS <= 1 else 's'} from DuckDuckGo""",
+ result{'' if NUM_RESULTS <= 1 else 's'} from DuckDuckGo, or \
+search_digest(<query>) to get a summary of each of those pages at once""",
     },
 ]
 
@@ -286,11 +320,23 @@ def get_user_input(prompt: str) -> str:
     return input(prompt).lower()[:1]
 
 
+def _open_file(filepath: str):
+    if platform == "win32":
+        run(["explorer.exe", filepath])
+    elif platform == "darwin":
+        run(["open", filepath])
+    else:
+        run(["xdg-open", filepath])
+
+
+@profiled("plugin.python")
 def _cmd_run_python(arg: List[str]) -> List["WigliMessage"]:
     script = arg.get("messages", "")[0].strip() + "\n"
     num_lines = script.count("\n")
-    filename = "temp.py"  # = "transcript_" + self.filename + "_pyscript_" + str(time()) + ".py"
-    filepath = join("C:\\VulcanicAI\\FracTLDR", filename)
+    # Each chat has its own interpreter, so variables and imports carry
+    # over from one code block to the next
+    kernel = get_kernel(arg.get("session"))
+    filepath = join(kernel.temp_dir, "pyscript.py")
 
     with open(filepath, "w") as f:
         f.write(script)
@@ -308,8 +354,7 @@ Will you allow Wigli to execute this code?
         if user_input == "p":
             print("\n" + script + "\n")
         if user_input == "x":
-            # p = run(["open", filepath], check=True)
-            p = run(["explorer.exe", filepath])
+            _open_file(filepath)
         if user_input == "n":
             return [WigliMessage("", "quit")]
 
@@ -318,19 +363,41 @@ Will you allow Wigli to execute this code?
         if new_script:
             script = new_script
 
-    num_lines = script.count("\n")
-
-    p = run(
-        [executable, filepath],
-        capture_output=True,
-        text=True,
-    )
-
-    output = (p.stdout + p.stderr).replace(
-        filename, "pyscript.py"
+    timeout = arg.get("timeout")
+    stream = arg.get("stream", False)
+    # Show the output as the script prints it rather than when it ends
+    output, status = kernel.execute(
+        script,
+        timeout=timeout,
+        on_output=(
+            (lambda text: print(text, end="", flush=True)) if stream else None
+        ),
+        cpu_limit=PYTHON_CPU_LIMIT,
+        memory_limit=PYTHON_MEMORY_LIMIT,
     )
+    error = ""
+    if status == "timeout":
+        error = f"""\
+[ERROR: PYTHON SCRIPT TIMED OUT AFTER {timeout:g} SECONDS, \
+THE INTERPRETER WAS RESTARTED AND ALL VARIABLES WERE LOST]\n"""
+    elif status == "crashed":
+        error = """\
+[ERROR: PYTHON INTERPRETER CRASHED, IT WAS RESTARTED AND ALL \
+VARIABLES WERE LOST]\n"""
+    elif status == "cpu":
+        error = f"""\
+[ERROR: PYTHON SCRIPT STOPPED AFTER USING {PYTHON_CPU_LIMIT:g} SECONDS \
+OF CPU TIME]\n"""
+    elif status == "memory":
+        error = f"""\
+[ERROR: PYTHON SCRIPT RAN OUT OF MEMORY, THE LIMIT IS \
+{PYTHON_MEMORY_LIMIT // 2**20} MB]\n"""
 
-    print(output)
+    if stream:
+        print("\n" + error if error else "")
+    output += error
+    # Only the start and end of a long output go back to the bot
+    output = truncate_tokens(output, PYTHON_OUTPUT_TOKENS)
     return [WigliMessage(output, "system")]
 
 
@@ -347,6 +414,10 @@ cmd_python = {
     "run_function": _cmd_run_python,
     "parse_function": _cmd_parse_python,
     "injection_messages": injection_python,
+    "concurrent": False,
+    "terminator": "```",
+    "batch": True,
+    "timeout": 2 * 60,
 }
 
 
@@ -356,6 +427,29 @@ class PythonBot(CommandBot):
         self.And(cmd_python)
 
 
+def _parse_call_args(span: str, cmd: str) -> dict:
+    """
+    Parses the argument of a call of the form "cmd(args)".
+
+    Parameters
+    ----------
+    span: str
+        The text of the invocation, starting with the keyword.
+    cmd: str
+        The command keyword including its opening parenthesis.
+
+    Returns
+    -------
+    dict
+        The parsed argument dict.
+    """
+    query = span[len(cmd) :].strip()
+    if ")" in query:
+        query = query[: query.index(")")]
+    return {"messages": [query]}
+
+
+@profiled("plugin.search_web")
 def _cmd_run_search_web(arg: dict) -> List["WigliMessage"]:
     query = arg.get("messages", "")[0].strip('"').strip("'")
     summary = f"""Search results for "{query}":\n\n"""
@@ -364,24 +458,20 @@ def _cmd_run_search_web(arg: dict) -> List["WigliMessage"]:
 Title: {result["title"]}\nURL: {result["href"]}\n{result["body"]}\n\n"""
     summary += """\
 Here are your search results. Use summarize_url to learn more"""
-    print(summary)
+    if arg.get("stream", False):
+        print(summary)
     return [WigliMessage(summary, "system")]
 
 
-def _cmd_parse_search_web(msg: str) -> List[str]:
-    cmd = "search_web("
-    for line in msg.split("\n"):
-        if cmd in line.lower():
-            query = line[
-                line.lower().index(cmd) + len(cmd) :
-            ].strip()
-            if ")" in query:
-                query = query[: query.index(")")]
-            return {"messages": [query]}
+def _cmd_parse_search_web(span: str) -> dict:
+    return _parse_call_args(span, "search_web(")
 
 
 cmd_search_web = {
     "keyword": "search_web(",
+    "terminator": (")", "\n"),
+    "cacheable": True,
+    "cache_key": query_cache_key,
     "run_function": _cmd_run_search_web,
     "parse_function": _cmd_parse_search_web,
     "injection_messages": injection_search,
@@ -389,29 +479,13 @@ cmd_search_web = {
 }
 
 
-def _cmd_run_summarize_url(
-    arg: dict,
-) -> List["WigliMessage"]:
-    query = arg.get("messages", "")[0]
-    # The URL is the first token
-    url = query.split()[0]
-    stream = arg.get("stream", False)
-    # The rest is a question to ask the summarization bot
-    query = (
-        query[len(url) :]
-        .replace(",", "")
-        .strip()
-        .strip('"')
-        .strip("'")
-    )
-    url = url.replace(",", "").strip().strip('"').strip("'")
-    page_text = scrape_html_text(url)
-
-    def gen_prompt(page_text):
-        return [
-            {
-                "role": "system",
-                "content": f"""\
+def _summary_prompt(
+    page_text: str, query: str = "", part: str = ""
+) -> List[dict]:
+    return [
+        {
+            "role": "system",
+            "content": f"""\
 You are an expert at summarizing webpages and \
 articles. You've studied every page on the internet, you \
 have an intimate understanding of webpage layouts, and you \
@@ -434,69 +508,268 @@ broad knowledge of all subjects. Your summary will be \
 around 2 to 5 paragraphs long. The next message will \
 contain the text of your webpage to analyze and summarize. \
 Are you ready?""",
-            },
-            {
-                "role": "assistant",
-                "content": "Yes! I am ready.",
-            },
-            {
-                "role": "user",
-                "content": (
-                    f"""\
+        },
+        {
+            "role": "assistant",
+            "content": "Yes! I am ready.",
+        },
+        {
+            "role": "user",
+            "content": (
+                f"""\
 When summarizing this page, please focus on \
 the following subject: {query}\n\n"""
-                    if query != ""
-                    else ""
-                )
-                + f"Here is the text of the page to summarize:\n\n{page_text}",
-            },
-        ]
+                if query != ""
+                else ""
+            )
+            + (
+                f"This is only {part} of the page, so summarize just this "
+                "part. Your summary will be combined with the others.\n\n"
+                if part != ""
+                else ""
+            )
+            + f"Here is the text of the page to summarize:\n\n{page_text}",
+        },
+    ]
 
-    prompt = gen_prompt(page_text)
-    tokens = count_tokens(prompt)
-    
-    near_tokens = round(MAX_TOKENS * 0.8)
 
-    while tokens > near_tokens:
-        chop_num = round(
-            0.6 * (tokens - (near_tokens * 0.99)) / CH_PER_TOK
-        )
-        if chop_num == 0:
-            break
-        page_text = page_text[:-chop_num]
-        prompt = gen_prompt(page_text)
-        tokens = count_tokens(prompt)
+def _combine_prompt(summaries: List[str], query: str = "") -> List[dict]:
+    parts = "\n\n".join(
+        f"Summary of part {n + 1}:\n{summary}"
+        for n, summary in enumerate(summaries)
+    )
+    return _summary_prompt(
+        f"""\
+The page was too long to read at once, so it was split into \
+{len(summaries)} parts and each part was summarized separately. \
+Combine these partial summaries into one summary of the whole page, \
+merging repeated points{" and keeping everything relevant to the subject" if query != "" else ""}.
+
+{parts}""",
+        query,
+    )
+
 
+def summarize_page(
+    url: str,
+    query: str = "",
+    stream: bool = False,
+    timeout: float | None = None,
+    cancel: Event | None = None,
+    max_chunks: int = SUMMARY_CHUNKS,
+    max_workers: int = SUMMARY_WORKERS,
+) -> str | None:
+    """
+    Downloads a webpage and summarizes it with summarize_text.
+
+    Parameters
+    ----------
+    url: str
+        The page to summarize.
+    query: str, optional
+        A question the summary should address.
+    stream: bool, optional
+        Whether to print the summary as it is generated.
+    timeout: float, optional
+        Seconds to allow for the download.
+    cancel: Event, optional
+        Once set, no more requests are made for the summary.
+    max_chunks: int, optional
+        The most chunks to split a long page into. 1 just cuts the page
+        off where the prompt is full.
+    max_workers: int, optional
+        How many chunks to summarize at once.
+
+    Returns
+    -------
+    str
+        The summary, or None if it was cancelled.
+
+    Raises
+    ------
+    OSError
+        If the page couldn't be downloaded or read, rather than
+        summarizing the error.
+    """
+    page_text = download_page(url, timeout=timeout)
     if stream:
         print(f"Summary of {url}:\n")
+    return summarize_text(
+        page_text,
+        query,
+        stream=stream,
+        cancel=cancel,
+        max_chunks=max_chunks,
+        max_workers=max_workers,
+    )
+
+
+def download_page(url: str, timeout: float | None = None) -> str:
+    """
+    Returns the text of a webpage.
+
+    Raises
+    ------
+    OSError
+        If the page couldn't be downloaded or read.
+    """
+    page_text = scrape_html_text(url, timeout=timeout)
+    if page_text == SCRAPE_ERR_MSG:
+        raise OSError(f"couldn't read {url}")
+    return page_text
+
+
+def summarize_text(
+    page_text: str,
+    query: str = "",
+    stream: bool = False,
+    cancel: Event | None = None,
+    max_chunks: int = SUMMARY_CHUNKS,
+    max_workers: int = SUMMARY_WORKERS,
+) -> str | None:
+    """
+    Summarizes the text of a webpage with a OneShotBot.
+
+    A page too long for one prompt is split into chunks that are
+    summarized concurrently, and the partial summaries are combined in
+    one final call. Whatever doesn't fit in max_chunks chunks is cut off.
+    If cancel is set, the summary stops before its next request, so an
+    abandoned summary doesn't keep spending tokens.
+
+    Returns
+    -------
+    str
+        The summary, or None if it was cancelled.
+    """
+    if cancel is not None and cancel.is_set():
+        return None
+
+    near_tokens = round(MAX_TOKENS * 0.8)
+    # Room left for page text once the instructions are in the prompt
+    chunk_tokens = near_tokens - count_tokens(
+        _summary_prompt("", query, part=f"part {max_chunks} of {max_chunks}")
+    )
+    chunks = split_tokens(page_text, chunk_tokens)[: max(1, max_chunks)]
+
+    if len(chunks) > 1:
+        summaries = _summarize_chunks(
+            chunks, query, max_workers=max_workers, cancel=cancel
+        )
+        if summaries is None:
+            return None
+        # Keep the combining prompt within the same budget
+        summary_tokens = chunk_tokens // len(summaries)
+        summaries = [
+            split_tokens(summary, summary_tokens)[0] if summary else ""
+            for summary in summaries
+        ]
+        prompt = _combine_prompt(summaries, query)
+    else:
+        prompt = _summary_prompt("".join(chunks), query)
+
+    if cancel is not None and cancel.is_set():
+        return None
+    return OneShotBot(prompt, stream=stream).strip()
+
+
+def _summarize_chunks(
+    chunks: List[str],
+    query: str = "",
+    max_workers: int = SUMMARY_WORKERS,
+    cancel: Event | None = None,
+) -> List[str] | None:
+    """
+    Summarizes the chunks of a page concurrently, in order. Chunks that
+    fail are left out, unless every chunk fails.
+    """
+    def summarize_chunk(part: dict) -> str | None:
+        if cancel is not None and cancel.is_set():
+            return None
+        return OneShotBot(
+            _summary_prompt(part["text"], query, part=part["part"])
+        ).strip()
+
+    pool = WigliWorkerPool(max_workers=max_workers)
+    for n, chunk in enumerate(chunks):
+        pool.submit(
+            n,
+            summarize_chunk,
+            {
+                "text": chunk,
+                "part": f"part {n + 1} of {len(chunks)}",
+                "timeout": None,
+                "cancel": Event(),
+            },
+        )
+    results = pool.join()
+    if cancel is not None and cancel.is_set():
+        return None
+
+    summaries = [
+        results[n][0] for n in range(len(chunks)) if results[n][1] is None
+    ]
+    if len(summaries) == 0:
+        raise results[0][1]
+    return summaries
+
+
+def _split_url_query(arg: dict) -> tuple:
+    """
+    Splits a summarize_url argument into the URL, its first token, and
+    the question to ask the summarization bot, the rest.
+    """
+    query = arg.get("messages", "")[0]
+    url = query.split()[0]
+    query = (
+        query[len(url) :]
+        .replace(",", "")
+        .strip()
+        .strip('"')
+        .strip("'")
+    )
+    url = url.replace(",", "").strip().strip('"').strip("'")
+    return url, query
+
+
+def _summarize_url_cache_key(arg: dict) -> list:
+    # URLs can be case sensitive, so only the question is normalized
+    url, query = _split_url_query(arg)
+    return [url, query_cache_key({"messages": [query]})]
+
+
+@profiled("plugin.summarize_url")
+def _cmd_run_summarize_url(
+    arg: dict,
+) -> List["WigliMessage"]:
+    url, query = _split_url_query(arg)
+    stream = arg.get("stream", False)
+    summary = summarize_page(
+        url,
+        query,
+        stream=stream,
+        timeout=arg.get("timeout"),
+        cancel=arg.get("cancel"),
+    )
+    if summary is None:
+        return []
 
     result = f"""\
 Summary of {url}:
 
-{
-    OneShotBot(
-        prompt,
-        stream=stream,
-    ).strip()
-}
+{summary}
 """
     return [WigliMessage(result, "system")]
 
 
-def _cmd_parse_summarize_url(msg: str) -> List[str]:
-    cmd = "summarize_url("
-    for line in msg.split("\n"):
-        if cmd in line.lower():
-            query = line[
-                line.lower().index(cmd) + len(cmd) :
-            ].strip()
-            if ")" in query:
-                query = query[: query.index(")")]
-            return {"messages": [query]}
+def _cmd_parse_summarize_url(span: str) -> dict:
+    return _parse_call_args(span, "summarize_url(")
 
 
 cmd_summarize_url = {
     "keyword": "summarize_url(",
+    "terminator": (")", "\n"),
+    "cacheable": True,
+    "cache_key": _summarize_url_cache_key,
     "run_function": _cmd_run_summarize_url,
     "parse_function": _cmd_parse_summarize_url,
     "injection_messages": [],
@@ -504,7 +777,108 @@ cmd_summarize_url = {
 }
 
 
+@profiled("plugin.search_digest")
+def _cmd_run_search_digest(arg: dict) -> List["WigliMessage"]:
+    query = arg.get("messages", "")[0].strip('"').strip("'")
+    timeout = arg.get("timeout")
+    deadline = None if timeout is None else time() + timeout
+    command_cancel = arg.get("cancel") or Event()
+    results = ddg(query)[:NUM_RESULTS]
+
+    # Download every result page at once, giving up on any page that
+    # takes longer than PAGE_TIMEOUT, and summarize each page as soon as
+    # it's downloaded. Only downloads are timed out by PAGE_TIMEOUT, so
+    # a slow summary of a page that came in time still gets used.
+    summaries = WigliWorkerPool(max_workers=DIGEST_WORKERS)
+
+    def summarize(page: dict) -> str | None:
+        if command_cancel.is_set():
+            return None
+        return summarize_text(
+            page["text"],
+            query,
+            cancel=page["cancel"],
+            # One call per page, the digest is only an overview
+            max_chunks=1,
+        )
+
+    def on_download(n: int, result: tuple):
+        text, error = result
+        if error is not None:
+            outcomes[n] = result
+            return
+        summaries.submit(
+            n,
+            summarize,
+            {
+                "text": text,
+                "timeout": None if deadline is None else deadline - time(),
+                "cancel": Event(),
+            },
+        )
+
+    outcomes = {}
+    pool = WigliWorkerPool(max_workers=DIGEST_WORKERS, on_result=on_download)
+    for n, result in enumerate(results):
+        page_timeout = PAGE_TIMEOUT
+        if timeout is not None:
+            page_timeout = min(page_timeout, timeout)
+        pool.submit(
+            n,
+            lambda page: download_page(page["url"], timeout=page["timeout"]),
+            {
+                "url": result["href"],
+                "timeout": page_timeout,
+                "cancel": Event(),
+            },
+        )
+    pool.join()
+    outcomes.update(summaries.join())
+
+    digest = f"""Digest of search results for "{query}":\n\n"""
+    for n, result in enumerate(results):
+        summary, error = outcomes.get(n, (None, None))
+        if summary is None:
+            # Try the page again next time rather than caching its snippet
+            arg["cacheable"] = False
+            if isinstance(error, TimeoutError):
+                summary = f"""\
+[This page took longer than {PAGE_TIMEOUT} seconds, here is its snippet]
+{result["body"]}"""
+            else:
+                summary = f"""\
+[This page couldn't be summarized, here is its snippet]
+{result["body"]}"""
+        digest += f"""\
+Title: {result["title"]}\nURL: {result["href"]}\n{summary.strip()}\n\n"""
+    digest += """\
+Here is your digest. Use summarize_url with a question to learn more \
+about any one page."""
+    if arg.get("stream", False):
+        print(digest)
+    return [WigliMessage(digest, "system")]
+
+
+def _cmd_parse_search_digest(span: str) -> dict:
+    return _parse_call_args(span, "search_digest(")
+
+
+cmd_search_digest = {
+    "keyword": "search_digest(",
+    "terminator": (")", "\n"),
+    "cacheable": True,
+    "cache_key": query_cache_key,
+    "timeout": 3 * 60,
+    "run_function": _cmd_run_search_digest,
+    "parse_function": _cmd_parse_search_digest,
+    "injection_messages": [],
+    "reminder_messages": [],
+}
+
+
 class SearchBot(CommandBot):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.Inject(cmd_search_web).And(cmd_summarize_url)
+        self.Inject(cmd_search_web).And(cmd_summarize_url).And(
+            cmd_search_digest
+        )
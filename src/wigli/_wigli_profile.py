@@ -0,0 +1,156 @@
+# wigli _wigli_profile.py
+
+from functools import wraps
+from threading import Lock
+from time import perf_counter
+from typing import Callable
+
+# Called with (name, seconds, attrs) as each span ends. While there are
+# no hooks, spans do nothing but check that this list is empty. It's
+# replaced rather than changed, so it can be read without the lock.
+_hooks = []
+_hooks_lock = Lock()
+
+
+def add_hook(hook: Callable[[str, float, dict], None]):
+    """
+    Calls hook(name, seconds, attrs) for every span that ends from now
+    on, in the thread that ran it. Spans are named after the phase they
+    time, like "bot.count_tokens" or "data.archive", and attrs holds
+    details some spans add, like the model.
+    """
+    global _hooks
+    with _hooks_lock:
+        _hooks = _hooks + [hook]
+
+
+def remove_hook(hook: Callable[[str, float, dict], None]):
+    global _hooks
+    with _hooks_lock:
+        _hooks = [other for other in _hooks if other is not hook]
+
+
+def record(name: str, seconds: float, **attrs):
+    """
+    Reports a span timed some other way, like the wait for a streamed
+    response's first token.
+    """
+    for hook in _hooks:
+        hook(name, seconds, attrs)
+
+
+class _Span(object):
+    __slots__ = ("name", "attrs", "started")
+
+    def __init__(self, name: str, attrs: dict):
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self) -> "_Span":
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> bool:
+        seconds = perf_counter() - self.started
+        for hook in _hooks:
+            hook(self.name, seconds, self.attrs)
+        return False
+
+
+class _NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self) -> "_NullSpan":
+        return self
+
+    def __exit__(self, *exc_info) -> bool:
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name: str, **attrs):
+    """
+    Times a with block as a span, if any hooks are listening.
+    """
+    if not _hooks:
+        return _NULL_SPAN
+    return _Span(name, attrs)
+
+
+def profiled(name: str) -> Callable:
+    """
+    Decorates a function so each call is timed as a span.
+    """
+
+    def decorate(function: Callable) -> Callable:
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _hooks:
+                return function(*args, **kwargs)
+            with _Span(name, {}):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+class WigliProfile(object):
+    """
+    Adds up the spans that end while it's active, for wigli --profile.
+
+    Spans nest, so a phase's time is also counted in the phases that
+    contain it, and the shares of the total add up to more than 100%.
+
+        with WigliProfile() as profile:
+            bot.Chat("Hello!")
+        print(profile.format())
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.phases = {}
+        self.started = None
+        self.seconds = None
+
+    def __enter__(self) -> "WigliProfile":
+        self.started = perf_counter()
+        add_hook(self)
+        return self
+
+    def __exit__(self, *exc_info) -> bool:
+        remove_hook(self)
+        self.seconds = perf_counter() - self.started
+        return False
+
+    def __call__(self, name: str, seconds: float, attrs: dict):
+        with self.lock:
+            phase = self.phases.setdefault(name, [0, 0.0, 0.0])
+            phase[0] += 1
+            phase[1] += seconds
+            phase[2] = max(phase[2], seconds)
+
+    def format(self) -> str:
+        """
+        Returns a table of the phases, slowest first, with how many
+        times each ran, their total, mean and longest time, and their
+        share of the whole run.
+        """
+        total = self.seconds
+        if total is None:
+            total = perf_counter() - self.started
+        lines = [
+            f"{'phase':28} {'calls':>5} {'total':>10} {'mean':>10} "
+            f"{'max':>10} {'share':>6}"
+        ]
+        phases = sorted(self.phases.items(), key=lambda item: -item[1][1])
+        for name, (calls, seconds, longest) in phases:
+            lines.append(
+                f"{name:28} {calls:5} {seconds * 1000:8.1f}ms "
+                f"{seconds / calls * 1000:8.1f}ms {longest * 1000:8.1f}ms "
+                f"{seconds / total:6.0%}"
+            )
+        lines.append(f"{'whole run':28} {'':5} {total * 1000:8.1f}ms")
+        return "\n".join(lines)
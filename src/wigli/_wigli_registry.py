@@ -0,0 +1,225 @@
+# wigli _wigli_registry.py
+
+from importlib import import_module
+from json import dump, load
+from os import stat
+from os.path import isdir
+from sys import path as sys_path
+from typing import Any, List
+
+from wigli._wigli_tools import remove_file
+
+PLUGIN_GROUP = "wigli.plugins"
+
+# Wigli's own plugins, described here so that listing them and building
+# their CLI flags never imports _wigli_plugins
+BUILTIN_PLUGINS = [
+    {
+        "name": "professor",
+        "flags": ["-P", "--professor"],
+        "target": "wigli._wigli_plugins:HistoryProfessor",
+        "description": "summon the professor",
+        "keywords": [],
+        "message": "Summoning Professor Wigli",
+    },
+    {
+        "name": "python",
+        "flags": ["-x", "--python"],
+        "target": "wigli._wigli_plugins:PythonBot",
+        "description": "enable python interpreter",
+        "keywords": ["```python"],
+        "message": "Injecting Python capabilities",
+    },
+    {
+        "name": "search",
+        "flags": ["-s", "--search"],
+        "target": "wigli._wigli_plugins:SearchBot",
+        "description": "enable assistant to use search commands",
+        "keywords": ["search_web(", "summarize_url(", "search_digest("],
+        "message": "Injecting web search capabilities",
+    },
+]
+
+
+def plugin_dest(plugin: dict) -> str:
+    """
+    Returns the argparse attribute name for a plugin's flag. It's made
+    from the plugin's unique name, under a prefix no core option uses,
+    so a plugin's flag can never set a core option or another plugin.
+    Names needn't be identifiers, so read it with getattr.
+    """
+    return "plugin_" + plugin["name"]
+
+
+def _entry_points(group: str) -> List[Any]:
+    # Imported here because scanning is only needed on a cache miss
+    from importlib.metadata import entry_points
+
+    eps = entry_points()
+    if hasattr(eps, "select"):
+        return list(eps.select(group=group))
+    return list(eps.get(group, []))
+
+
+def _fingerprint() -> List[list]:
+    """
+    Summarizes the import path cheaply. Installing or removing a package
+    touches its site-packages directory, which changes the fingerprint.
+    """
+    fingerprint = []
+    for path in sys_path:
+        if isdir(path):
+            fingerprint.append([path, stat(path).st_mtime])
+    return fingerprint
+
+
+class WigliPluginRegistry(object):
+    """
+    Knows about every installed Wigli plugin without importing any of them.
+
+    Third-party packages register plugins under the "wigli.plugins"
+    entry point group, pointing at a WigliBot subclass, a WigliCommand
+    or command dict, or a WigliInjection. The result of scanning the
+    entry points is cached on disk and reused until the set of installed
+    packages changes.
+
+    Attributes
+    ----------
+    cache_path: str
+        Where to cache the entry point scan, or None to always rescan.
+    plugins: dict
+        Maps plugin names to metadata dicts with "name", "flags",
+        "target", "description" and "keywords" keys, in the order the
+        plugins are applied.
+    """
+
+    def __init__(self, cache_path: str | None = None):
+        self.cache_path = cache_path
+        self.plugins = {
+            plugin["name"]: dict(plugin) for plugin in BUILTIN_PLUGINS
+        }
+        self._loaded = {}
+        for plugin in self._scan():
+            self.plugins.setdefault(plugin["name"], plugin)
+
+    def __iter__(self):
+        return iter(self.plugins.values())
+
+    def _scan(self) -> List[dict]:
+        fingerprint = _fingerprint()
+        if self.cache_path is not None:
+            try:
+                with open(self.cache_path) as f:
+                    cache = load(f)
+                if cache.get("fingerprint") == fingerprint:
+                    return cache.get("plugins", [])
+            except (OSError, ValueError):
+                pass
+
+        plugins = []
+        for ep in _entry_points(PLUGIN_GROUP):
+            dist = getattr(ep, "dist", None)
+            metadata = dist.metadata if dist is not None else {}
+            plugins.append(
+                {
+                    "name": ep.name,
+                    "flags": ["--" + ep.name.replace("_", "-")],
+                    "target": ep.value,
+                    "description": metadata.get("Summary")
+                    or f"enable the {ep.name} plugin",
+                    "keywords": None,
+                    "distribution": metadata.get("Name"),
+                    "version": metadata.get("Version"),
+                }
+            )
+        self._save(fingerprint, plugins)
+        return plugins
+
+    def _save(self, fingerprint: List[list], plugins: List[dict]):
+        if self.cache_path is None:
+            return
+        try:
+            with open(self.cache_path, "w") as f:
+                dump({"fingerprint": fingerprint, "plugins": plugins}, f)
+        except OSError:
+            remove_file(self.cache_path)
+
+    def find(self, name_or_flag: str) -> str | None:
+        """
+        Returns the name of the plugin with a name or flag, like "search"
+        or "-s", or None if no plugin has it.
+        """
+        if name_or_flag in self.plugins:
+            return name_or_flag
+        for plugin in self:
+            if name_or_flag in plugin["flags"]:
+                return plugin["name"]
+        return None
+
+    def load(self, name: str) -> Any:
+        """
+        Imports a plugin's module and returns the plugin object.
+        """
+        if name not in self._loaded:
+            module, _, attr = self.plugins[name]["target"].partition(":")
+            obj = import_module(module)
+            for part in attr.split("."):
+                if part:
+                    obj = getattr(obj, part)
+            self._loaded[name] = obj
+        return self._loaded[name]
+
+    def apply(self, name: str, bot: Any) -> Any:
+        """
+        Adds a plugin to a bot, returning the bot to use from now on.
+
+        Bot classes are applied with FromBot, and commands or injections
+        are injected, upgrading the bot to a CommandBot if necessary. The
+        keywords a third-party plugin adds are recorded in the cache so
+        later listings can show them without importing it.
+        """
+        from wigli._wigli_bots import CommandBot, WigliCommand
+
+        plugin = self.load(name)
+        before = {cmd.keyword for cmd in getattr(bot, "active_cmds", [])}
+
+        if isinstance(plugin, type):
+            bot = plugin.FromBot(bot)
+        elif isinstance(plugin, WigliCommand) or (
+            isinstance(plugin, dict) and "parse_function" in plugin
+        ):
+            if not isinstance(bot, CommandBot):
+                bot = CommandBot.FromBot(bot)
+            bot.And(plugin)
+        else:
+            bot.Inject(plugin)
+
+        metadata = self.plugins[name]
+        if metadata.get("keywords") is None:
+            after = {cmd.keyword for cmd in getattr(bot, "active_cmds", [])}
+            metadata["keywords"] = sorted(after - before)
+            self._save(
+                _fingerprint(),
+                [
+                    plugin
+                    for plugin in self.plugins.values()
+                    if plugin["name"]
+                    not in [builtin["name"] for builtin in BUILTIN_PLUGINS]
+                ],
+            )
+        return bot
+
+    def format_listing(self) -> str:
+        """
+        Returns a human-readable list of the installed plugins.
+        """
+        lines = []
+        for plugin in self:
+            keywords = plugin.get("keywords")
+            lines.append(
+                f"""\
+    {", ".join(plugin["flags"])}: {plugin["description"]}\
+{f" [{', '.join(keywords)}]" if keywords else ""}\
+{f" ({plugin['distribution']} {plugin['version']})" if plugin.get("distribution") else ""}"""
+            )
+        return "\n".join(lines)
@@ -0,0 +1,204 @@
+# wigli _wigli_repl.py
+
+from typing import Any, Callable, TYPE_CHECKING
+
+from wigli._wigli_bots import WigliBot, WigliMessage
+from wigli._wigli_registry import WigliPluginRegistry
+
+if TYPE_CHECKING:
+    from wigli._wigli_data import WigliData
+
+PROMPT = "> "
+HELP = """\
+Type a message to chat, or one of these commands:
+  /erase [N]        erase the last N messages, 1 by default
+  /transcript [N]   print the chat, or only its last N messages
+  /plugins          list the plugins, marking those that are on
+  /plugin NAME      turn a plugin on or off, by name or flag
+  /system TEXT      add a system message
+  /help             print this help
+  /quit             save the chat and leave"""
+
+
+class WigliRepl(object):
+    """
+    An interactive chat that keeps one bot in memory across turns.
+
+    The chat is saved on a background thread once each turn is done,
+    instead of being loaded and saved again by a new wigli command for
+    every turn.
+
+    Attributes
+    ----------
+    bot: WigliBot
+        The bot being chatted with. Turning plugins on can replace it
+        with a bot of another class that continues the same chat.
+    data: WigliData
+        Where the chat is saved.
+    plugins: WigliPluginRegistry
+        The installed plugins that can be turned on and off.
+    enabled: dict
+        Maps the names of the plugins that are on to the commands and
+        reminders they added, so they can be taken away again.
+    """
+
+    def __init__(
+        self,
+        bot: WigliBot,
+        data: "WigliData",
+        plugins: WigliPluginRegistry,
+        read: Callable[[str], str] = input,
+    ):
+        self.bot = bot
+        self.data = data
+        self.plugins = plugins
+        self.read = read
+        self.enabled = {}
+        self.commands = {
+            "erase": self.erase,
+            "transcript": self.transcript,
+            "plugins": self.list_plugins,
+            "plugin": self.toggle_plugin,
+            "system": self.system,
+            "help": lambda arg: print(HELP),
+        }
+        # Plugins the chat already had, like a resumed chat's commands
+        active = _keywords(bot)
+        for plugin in plugins:
+            keywords = set(plugin.get("keywords") or ())
+            if len(keywords) > 0 and keywords <= active:
+                self.enabled[plugin["name"]] = (keywords, set())
+
+    def run(self):
+        """
+        Chats until /quit, end of input or Ctrl-C at the prompt, then
+        waits for the chat to be saved.
+        """
+        self.data.archive_in_background()
+        print(
+            f"Chatting with {getattr(self.bot, 'title', None) or 'a new chat'}, "
+            "/help for commands"
+        )
+        try:
+            while True:
+                try:
+                    line = self.read(PROMPT)
+                except (EOFError, KeyboardInterrupt):
+                    print()
+                    break
+                # The turn's saves wait until it's done changing the bot,
+                # then run while the next line is typed
+                with self.data.holding_archive():
+                    if not self.handle(line):
+                        break
+        finally:
+            self.data.archive_in_background(False)
+
+    def handle(self, line: str) -> bool:
+        """
+        Runs a slash command or sends a message.
+
+        Returns
+        -------
+        bool
+            False once the session should end.
+        """
+        line = line.strip()
+        if not line:
+            return True
+        if not line.startswith("/"):
+            try:
+                self.bot.Chat(line)
+            except KeyboardInterrupt:
+                print("\n[ERROR: INTERRUPTED]")
+            return True
+        name, _, arg = line[1:].partition(" ")
+        if name in ("quit", "exit", "q"):
+            return False
+        command = self.commands.get(name)
+        if command is None:
+            print(f"[ERROR: UNKNOWN COMMAND /{name}, TRY /help]")
+        else:
+            command(arg.strip())
+        return True
+
+    def erase(self, arg: str):
+        count = _int_arg(arg, 1)
+        if count is None:
+            return
+        self.bot.erase_messages(count)
+        self.data.archive_chat(self.bot)
+
+    def transcript(self, arg: str):
+        limit = _int_arg(arg, None)
+        if limit is None and arg:
+            return
+        print("\n\n".join(self.bot.iter_transcript(limit=limit)))
+
+    def system(self, arg: str):
+        if not arg:
+            print("[ERROR: /system NEEDS A MESSAGE]")
+            return
+        self.bot.Inject([WigliMessage(arg, "system")])
+
+    def list_plugins(self, arg: str):
+        for plugin in self.plugins:
+            on = "*" if plugin["name"] in self.enabled else " "
+            print(
+                f"{on} {plugin['name']} ({', '.join(plugin['flags'])}): "
+                f"{plugin['description']}"
+            )
+
+    def toggle_plugin(self, arg: str):
+        name = self.plugins.find(arg)
+        if name is None:
+            print(f"[ERROR: NO PLUGIN NAMED {arg}]")
+        elif name in self.enabled:
+            self.disable_plugin(name)
+            print(f"Turned {name} off")
+        else:
+            self.enable_plugin(name)
+            print(f"Turned {name} on")
+
+    def enable_plugin(self, name: str):
+        """
+        Adds a plugin to the bot, remembering the commands and reminders
+        it added.
+        """
+        cmds = _keywords(self.bot)
+        reminders = set(self.bot.reminders or ())
+        self.bot = self.plugins.apply(name, self.bot)
+        self.enabled[name] = (
+            _keywords(self.bot) - cmds,
+            set(self.bot.reminders or ()) - reminders,
+        )
+
+    def disable_plugin(self, name: str):
+        """
+        Takes away the commands and reminders a plugin added. What it
+        already said in the chat stays there.
+        """
+        cmds, reminders = self.enabled.pop(name)
+        if hasattr(self.bot, "active_cmds"):
+            self.bot.active_cmds = {
+                cmd
+                for cmd in self.bot.active_cmds
+                if cmd.keyword not in cmds
+            }
+        # A new set, since bots can share their reminders set
+        self.bot.reminders = set(self.bot.reminders or ()) - reminders
+        self.data.archive_chat(self.bot)
+
+
+def _keywords(bot: Any) -> set:
+    return {cmd.keyword for cmd in getattr(bot, "active_cmds", [])}
+
+
+def _int_arg(arg: str, default: int | None) -> int | None:
+    if not arg:
+        return default
+    try:
+        return int(arg)
+    except ValueError:
+        print(f"[ERROR: EXPECTED A NUMBER, NOT {arg}]")
+        return None
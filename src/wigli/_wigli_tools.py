@@ -1,13 +1,42 @@
 # wigli _wigli_tools.py
 
-from bs4 import BeautifulSoup
+from importlib.util import find_spec
 from os import listdir, makedirs, remove
 from os.path import exists, splitext
 from shutil import copy2
-from tiktoken import get_encoding, encoding_for_model
 from time import localtime, strftime
 from typing import Iterable
-from urllib3 import PoolManager
+
+# bs4 and tiktoken are imported where they're used, since importing them
+# takes longer than commands like "wigli -V" take to run
+
+# lxml is an optional, much faster tree builder for BeautifulSoup
+HTML_PARSER = "lxml" if find_spec("lxml") is not None else "html.parser"
+BOILERPLATE_TAGS = [
+    "script",
+    "style",
+    "noscript",
+    "template",
+    "svg",
+    "nav",
+    "aside",
+    "iframe",
+]
+# Only dropped outside of the page's main content, where they usually
+# hold site-wide banners rather than an article's byline
+PAGE_CHROME_TAGS = ["header", "footer"]
+# What scrape_html_text returns for a page it couldn't download or read
+SCRAPE_ERR_MSG = "Error parsing URL\n"
+
+
+def default_data_dir() -> str:
+    """
+    Returns the directory Wigli keeps its chats and settings in when no
+    other is given.
+    """
+    from appdirs import user_data_dir
+
+    return user_data_dir(appname="Wigli", appauthor="VulcanicAI")
 
 
 def backup_file(filepath: str) -> None:
@@ -198,17 +227,83 @@ def plural(word, num, plural=None):
     return pluralize(word)
 
 
-def scrape_html_text(url):
-    http = PoolManager()
+def percentile(values: Iterable[float], q: float) -> float | None:
+    """
+    Returns the q-th percentile of some values by the nearest-rank
+    method, so it's always one of the values, or None if there are none.
+    """
+    values = sorted(values)
+    if len(values) == 0:
+        return None
+    rank = max(1, -(-q * len(values) // 100))
+    return values[int(rank) - 1]
+
+
+def extract_text(html: bytes | str, parser: str | None = None) -> str:
+    """
+    Extracts the readable text of a webpage, leaving out scripts, styles,
+    navigation and other page furniture.
+
+    Parameters
+    ----------
+    html: bytes or str
+        The page to extract text from.
+    parser: str, optional
+        The BeautifulSoup tree builder, which defaults to lxml when it is
+        installed and the pure-Python html.parser otherwise.
+
+    Returns
+    -------
+    str
+        The page's main text with whitespace collapsed, one block per line.
+    """
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, parser or HTML_PARSER)
+    for tag in soup(BOILERPLATE_TAGS):
+        tag.decompose()
+    for tag in soup(PAGE_CHROME_TAGS):
+        if tag.find_parent(["main", "article"]) is None:
+            tag.decompose()
+
+    # Prefer the element that holds the page's content, if it says so
+    candidates = soup.find_all(["main", "article"]) + soup.find_all(
+        attrs={"role": "main"}
+    )
+    root = max(candidates, key=lambda tag: len(tag.get_text()), default=None)
+    if root is None or not root.get_text().strip():
+        root = soup.body or soup
+
+    lines = []
+    for line in root.get_text(separator="\n").splitlines():
+        line = " ".join(line.split())
+        if line:
+            lines.append(line)
+    return "\n".join(lines)
+
+
+def scrape_html_text(url, timeout=None, max_bytes=None):
+    # Imported here because _wigli_http depends on this module
+    from wigli._wigli_http import HTTP_TIMEOUT, MAX_PAGE_BYTES, get_http
+
     try:
-        response = http.request("GET", url)
-        soup = BeautifulSoup(
-            response.data,
-            "html.parser",
+        status, headers, body = get_http().get(
+            url,
+            timeout=timeout or HTTP_TIMEOUT,
+            max_bytes=max_bytes or MAX_PAGE_BYTES,
         )
-        return soup.get_text()
+        return extract_text(body)
     except BaseException:
-        return "Error parsing URL\n"
+        return SCRAPE_ERR_MSG
+
+
+def _encoding(model):
+    from tiktoken import get_encoding, encoding_for_model
+
+    try:
+        return encoding_for_model(model)
+    except KeyError:
+        return get_encoding("cl100k_base")
 
 
 def count_tokens(messages, model="gpt-3.5-turbo-0301"):
@@ -221,10 +316,7 @@ def count_tokens(messages, model="gpt-3.5-turbo-0301"):
         ]
     if not isinstance(messages, Iterable):
         return 0
-    try:
-        encoding = encoding_for_model(model)
-    except KeyError:
-        encoding = get_encoding("cl100k_base")
+    encoding = _encoding(model)
     if (
         model == "gpt-3.5-turbo-0301"
         or model == "gpt-3.5-turbo"
@@ -254,3 +346,61 @@ num_tokens_from_messages() is not presently implemented for model {model}. \
 See https://github.com/openai/openai-python/blob/main/chatml.md \
 for information on how messages are converted to tokens."""
         )
+
+
+def count_text_tokens(text: str, model="gpt-3.5-turbo-0301") -> int:
+    """
+    Returns how many tokens a text encodes to, without the tokens
+    count_tokens adds around each message.
+    """
+    return len(_encoding(model).encode(text))
+
+
+def split_tokens(text: str, max_tokens: int, model="gpt-3.5-turbo-0301"):
+    """
+    Splits text into chunks of at most max_tokens tokens each, preferring
+    to cut at the last line break within a chunk.
+
+    Returns
+    -------
+    list
+        The chunks, in order, covering the whole text.
+    """
+    encoding = _encoding(model)
+    tokens = encoding.encode(text)
+    newline = encoding.encode("\n")
+    chunks = []
+    start = 0
+    while start < len(tokens):
+        end = min(start + max_tokens, len(tokens))
+        if end < len(tokens):
+            # Back up to a line break in the second half of the chunk
+            for cut in range(end, start + max_tokens // 2, -1):
+                if tokens[cut - 1 : cut] == newline:
+                    end = cut
+                    break
+        chunks.append(encoding.decode(tokens[start:end]))
+        start = end
+    return chunks
+
+
+def truncate_tokens(text: str, max_tokens: int, model="gpt-3.5-turbo-0301"):
+    """
+    Shortens text to about max_tokens tokens by dropping its middle, so
+    both how it starts and how it ends are kept.
+    """
+    # A character, like an emoji, can take several tokens, but no more
+    # than the four bytes it's encoded to in UTF-8
+    if len(text) <= max_tokens // 4:
+        return text
+    encoding = _encoding(model)
+    tokens = encoding.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    head = max_tokens // 2
+    tail = max_tokens - head
+    return (
+        encoding.decode(tokens[:head])
+        + f"\n[... {len(tokens) - max_tokens} TOKENS OMITTED ...]\n"
+        + encoding.decode(tokens[-tail:])
+    )
@@ -0,0 +1,325 @@
+# wigli _wigli_tree.py
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from json import dumps, loads
+from threading import RLock
+from typing import List, Sequence
+
+from wigli._wigli_bots import WigliMessage
+
+try:
+    from fcntl import LOCK_EX, LOCK_UN, flock
+except ImportError:
+    # Not available on Windows, where trees are only locked per process
+    flock = None
+
+# The most trees get_tree keeps loaded, least recently used first
+TREE_CACHE_SIZE = 32
+
+_trees = OrderedDict()
+_trees_lock = RLock()
+
+
+class WigliChatTree(object):
+    """
+    Every version of one chat, stored as a tree of messages.
+
+    Each branch is a path from the first message to its head. Erasing
+    messages and chatting again starts a new branch that shares the
+    messages before the edit, so no version of the chat is ever lost
+    and no message is stored twice.
+
+    The tree is saved to a JSON lines file that is only ever appended
+    to. Each line is a new message node or a branch's new head. Several
+    processes can share a tree, since each one reads what the others
+    appended before adding to it, while holding a lock on the file.
+
+    Attributes
+    ----------
+    path: str
+        The file the tree is saved to, or None to keep it in memory.
+    nodes: dict
+        Maps node ids to (parent id, WigliMessage) pairs.
+    branches: dict
+        Maps branch numbers to the id of their head node, in the order
+        the branches were made.
+    """
+
+    def __init__(self, path: str | None = None):
+        self.path = path
+        self.nodes = {}
+        self.branches = {}
+        self.lock = RLock()
+        self._children = {}
+        self._unsaved = []
+        # How much of the file has been read, up to its last full line
+        self._offset = 0
+        self._next_node = 1
+        if path is not None:
+            self.refresh()
+
+    def refresh(self):
+        """
+        Reads the records other processes appended to the file since it
+        was last read.
+        """
+        if self.path is None:
+            return
+        with self.lock:
+            try:
+                with open(self.path, "rb") as f:
+                    f.seek(self._offset)
+                    data = f.read()
+            except OSError:
+                return
+            # A line without its newline is still being written, or was
+            # cut short, and is read again next time
+            end = data.rfind(b"\n") + 1
+            self._offset += end
+            for line in data[:end].splitlines():
+                try:
+                    record = loads(line)
+                except ValueError:
+                    # A write interrupted part way leaves a partial line
+                    continue
+                self._add_record(record)
+
+    def _add_record(self, record: dict):
+        if "node" in record:
+            self._add_node(
+                record["node"],
+                record["parent"],
+                WigliMessage(
+                    record["content"],
+                    record["role"],
+                    record["timestamp"],
+                ),
+            )
+        elif "branch" in record:
+            self.branches[record["branch"]] = record["head"]
+
+    @contextmanager
+    def locked(self):
+        """
+        Holds the tree, and its file where the platform allows, so a
+        sync and save aren't interleaved with another thread's or
+        process's. The tree is brought up to date with the file first.
+        """
+        with self.lock:
+            if self.path is None:
+                yield self
+                return
+            try:
+                f = open(self.path, "ab")
+            except OSError:
+                f = None
+            try:
+                if f is not None and flock is not None:
+                    flock(f.fileno(), LOCK_EX)
+                self.refresh()
+                yield self
+            finally:
+                if f is not None:
+                    if flock is not None:
+                        flock(f.fileno(), LOCK_UN)
+                    f.close()
+
+    @staticmethod
+    def _key(message: WigliMessage) -> tuple:
+        return (message.role, message.content, message.timestamp)
+
+    def _add_node(
+        self, node: int, parent: int | None, message: WigliMessage
+    ):
+        self.nodes[node] = (parent, message)
+        self._children[(parent, self._key(message))] = node
+        self._next_node = max(self._next_node, node + 1)
+
+    def path_to(self, node: int | None) -> List[int]:
+        """
+        Returns the ids of the nodes from the first message to a node.
+        """
+        path = []
+        while node is not None:
+            path.append(node)
+            node = self.nodes[node][0]
+        return path[::-1]
+
+    def messages(self, branch: int) -> List[WigliMessage]:
+        """
+        Returns the messages of a branch, oldest first.
+        """
+        return self.messages_to(self.branches[branch])
+
+    def messages_to(self, node: int | None) -> List[WigliMessage]:
+        """
+        Returns the messages from the first message to a node.
+        """
+        return [self.nodes[n][1] for n in self.path_to(node)]
+
+    def _resume(
+        self, messages: Sequence[WigliMessage], synced: tuple
+    ) -> tuple:
+        """
+        Finds where a bot's last sync left off, as a number of messages
+        the tree already has and the node of the last of them, checking
+        that the bot still has that message. Falls back to (0, None).
+        """
+        count, node = synced
+        # Erased messages are walked back over, one node each
+        while node is not None and count > len(messages):
+            node = self.nodes[node][0] if node in self.nodes else None
+            count -= 1
+        if (
+            node is None
+            or node not in self.nodes
+            or count < 1
+            or self._key(self.nodes[node][1])
+            != self._key(messages[count - 1])
+        ):
+            return 0, None
+        return count, node
+
+    def sync(
+        self,
+        messages: Sequence[WigliMessage],
+        branch: int | None = None,
+        synced: tuple | None = None,
+    ) -> tuple:
+        """
+        Records a bot's messages in the tree, adding nodes only for the
+        messages the tree doesn't have yet.
+
+        Parameters
+        ----------
+        messages: Sequence[WigliMessage]
+            The bot's messages, oldest first.
+        branch: int, optional
+            The branch the bot is on. Its head moves to the last message
+            if the messages continue the branch. Otherwise, for example
+            after messages were erased, a new branch is started.
+        synced: tuple, optional
+            What the last sync of these messages returned. Only the
+            messages after it are looked at, as long as the message it
+            ended on is still in place.
+
+        Returns
+        -------
+        tuple
+            The branch the messages are now on, and (the number of
+            messages, the node of the last one) to pass as synced next
+            time.
+        """
+        count, node = 0, None
+        if synced is not None:
+            count, node = self._resume(messages, synced)
+        start = node
+        added = set()
+        for n in range(count, len(messages)):
+            message = messages[n]
+            child = self._children.get((node, self._key(message)))
+            if child is None:
+                child = self._next_node
+                self._add_node(child, node, message)
+                self._unsaved.append(
+                    {
+                        "node": child,
+                        "parent": node,
+                        "role": message.role,
+                        "content": message.content,
+                        "timestamp": message.timestamp,
+                    }
+                )
+            added.add(child)
+            node = child
+        synced = (len(messages), node)
+
+        if branch not in self.branches:
+            branch = None
+        else:
+            head = self.branches[branch]
+            if (
+                head is not None
+                and head != start
+                and head not in added
+                and head not in self.path_to(start)
+            ):
+                # The messages left this branch, keep it as it was
+                branch = None
+        if branch is None:
+            # Reuse a branch that ends where the messages do
+            for other, head in self.branches.items():
+                if head == node:
+                    return other, synced
+            branch = max(self.branches, default=0) + 1
+        if self.branches.get(branch, -1) != node:
+            self.branches[branch] = node
+            self._unsaved.append({"branch": branch, "head": node})
+        return branch, synced
+
+    def save(self):
+        """
+        Appends the nodes and branch heads changed since the last save.
+        """
+        if self.path is None or len(self._unsaved) == 0:
+            return
+        with self.lock:
+            text = "".join(dumps(record) + "\n" for record in self._unsaved)
+            with open(self.path, "ab") as f:
+                size = f.seek(0, 2)
+                if size > self._offset:
+                    # Finish a line cut short, so ours start on their own
+                    text = "\n" + text
+                data = text.encode("utf-8")
+                f.write(data)
+            self._offset = size + len(data)
+            self._unsaved = []
+
+    def list_branches(self) -> List[dict]:
+        """
+        Returns a summary of each branch: its number, how many messages
+        it has, how many of them it shares with the branches made before
+        it, and its last message.
+        """
+        summaries = []
+        earlier = []
+        for branch, head in self.branches.items():
+            path = self.path_to(head)
+            shared = 0
+            for other in earlier:
+                n = 0
+                while (
+                    n < min(len(path), len(other))
+                    and path[n] == other[n]
+                ):
+                    n += 1
+                shared = max(shared, n)
+            summaries.append(
+                {
+                    "branch": branch,
+                    "length": len(path),
+                    "shared": shared,
+                    "last": self.nodes[head][1] if head is not None else None,
+                }
+            )
+            earlier.append(path)
+        return summaries
+
+
+def get_tree(path: str) -> WigliChatTree:
+    """
+    Returns the tree saved at a path, loading it on first use so later
+    saves only have to append. Up to TREE_CACHE_SIZE trees are kept
+    loaded, and each is brought up to date with its file when returned.
+    """
+    with _trees_lock:
+        tree = _trees.get(path)
+        if tree is None:
+            tree = _trees[path] = WigliChatTree(path)
+        else:
+            _trees.move_to_end(path)
+            tree.refresh()
+        while len(_trees) > TREE_CACHE_SIZE:
+            _trees.popitem(last=False)
+        return tree
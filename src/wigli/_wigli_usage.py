@@ -0,0 +1,131 @@
+# wigli _wigli_usage.py
+
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock, local
+from typing import Callable
+
+# Which file in the data directory the usage ledger is appended to
+USAGE_FILE = "usage.jsonl"
+# What the ledger's entries can be grouped by
+USAGE_KEYS = ("day", "model", "chat", "bot", "command")
+# US dollars per 1000 prompt and completion tokens, for estimating what
+# the ledger's entries cost. Models not listed aren't given a cost.
+PRICES = {
+    "gpt-3.5-turbo": (0.002, 0.002),
+    "gpt-3.5-turbo-0301": (0.002, 0.002),
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-0314": (0.03, 0.06),
+    "gpt-4-32k": (0.06, 0.12),
+    "gpt-4-32k-0314": (0.06, 0.12),
+}
+
+_context = local()
+_budget = None
+
+
+def estimate_cost(
+    model: str, prompt_tokens: int | None, completion_tokens: int | None
+) -> float | None:
+    """
+    Returns what a request cost in US dollars, or None if the model's
+    price isn't in PRICES.
+    """
+    if model not in PRICES:
+        return None
+    prompt_price, completion_price = PRICES[model]
+    return round(
+        (prompt_tokens or 0) * prompt_price / 1000
+        + (completion_tokens or 0) * completion_price / 1000,
+        6,
+    )
+
+
+class WigliTokenBudget(object):
+    """
+    A number of tokens a run may spend across all its requests, counting
+    both prompt and completion tokens. Spending from a budget also spends
+    from the budget it was made inside of, if any.
+    """
+
+    def __init__(self, limit: int, parent: "WigliTokenBudget | None" = None):
+        self.limit = limit
+        self.parent = parent
+        self.used = 0
+        self.lock = Lock()
+
+    def remaining(self) -> int:
+        remaining = self.limit - self.used
+        if self.parent is not None:
+            remaining = min(remaining, self.parent.remaining())
+        return remaining
+
+    def allows(self, tokens: int) -> bool:
+        """
+        Whether a request expected to use this many tokens fits.
+        """
+        return tokens <= self.remaining()
+
+    def charge(self, tokens: int):
+        with self.lock:
+            self.used += tokens
+        if self.parent is not None:
+            self.parent.charge(tokens)
+
+
+def current_usage() -> dict:
+    """
+    Returns what the requests made in this thread right now are
+    attributed to. It can hold the "data" whose ledger to record them
+    in, the "chat" filename and "birthstamp", the "command" keyword and
+    a token "budget". In the daemon it also holds the "client" whose
+    command the thread is running.
+    """
+    return getattr(_context, "attrs", {})
+
+
+@contextmanager
+def usage_context(**attrs):
+    """
+    Attributes the requests made in the with block, in this thread and
+    on WigliWorkerPool threads it starts, as described in current_usage.
+    """
+    previous = current_usage()
+    _context.attrs = {**previous, **attrs}
+    try:
+        yield
+    finally:
+        _context.attrs = previous
+
+
+def bind_usage(function: Callable, **attrs) -> Callable:
+    """
+    Returns a function that runs in this thread's usage context, with
+    attrs added, whichever thread calls it.
+    """
+    bound = {**current_usage(), **attrs}
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        with usage_context(**bound):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def get_token_budget() -> WigliTokenBudget | None:
+    """
+    Returns the budget requests in this thread spend from: the one set
+    for the current usage context, or else the one for the whole run.
+    """
+    budget = current_usage().get("budget")
+    return _budget if budget is None else budget
+
+
+def set_token_budget(limit: int | None):
+    """
+    Limits the tokens every request from now on may spend in total, or
+    lifts the limit when limit is None.
+    """
+    global _budget
+    _budget = None if limit is None else WigliTokenBudget(limit)
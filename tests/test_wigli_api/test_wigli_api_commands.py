@@ -0,0 +1,260 @@
+from threading import Barrier
+from typing import List
+
+import openai
+
+from wigli import CommandBot, WigliCommand, WigliMessage
+from wigli._wigli_bots import WigliCommandMatcher, query_cache_key
+
+# These tests exercise the CommandBot command loop without calling the
+# OpenAI API by parsing messages with nochat=True and reprompt=False
+
+
+def make_cmd(keyword: str, log: List[str], barrier: Barrier = None):
+    def run(arg: dict) -> List[WigliMessage]:
+        if barrier is not None:
+            barrier.wait(timeout=5)
+        log.append(arg["messages"][0])
+        return [WigliMessage(f"{keyword}{arg['messages'][0]}", "system")]
+
+    def parse(msg: str) -> List[dict]:
+        calls = []
+        for line in msg.split("\n"):
+            if line.startswith(keyword):
+                calls.append({"messages": [line[len(keyword) :]]})
+        return calls
+
+    return {
+        "keyword": keyword,
+        "run_function": run,
+        "parse_function": parse,
+        "injection_messages": f"You can use {keyword}",
+    }
+
+
+def test_command_bot_runs_all_commands_in_order(monkeypatch):
+    monkeypatch.setattr(openai, "api_key", "test")
+    log = []
+    bot = CommandBot(stream=False)
+    bot.And(make_cmd("alpha:", log)).And(make_cmd("beta:", log))
+
+    invocations = bot.parse_commands("beta:1\nalpha:2\nbeta:3")
+    assert [arg["messages"][0] for _, arg in invocations] == [
+        "1",
+        "2",
+        "3",
+    ]
+
+    results = bot.run_commands(invocations)
+    assert [result[0].content for result in results] == [
+        "beta:1",
+        "alpha:2",
+        "beta:3",
+    ]
+
+
+def test_command_bot_runs_commands_concurrently(monkeypatch):
+    monkeypatch.setattr(openai, "api_key", "test")
+    log = []
+    # Every invocation blocks until all of them are running at once
+    barrier = Barrier(3)
+    bot = CommandBot(stream=False).And(
+        make_cmd("gamma:", log, barrier=barrier)
+    )
+
+    bot.Chat("gamma:a\ngamma:b\ngamma:c", nochat=True, reprompt=False)
+    assert sorted(log) == ["a", "b", "c"]
+
+
+def test_command_matcher_spans():
+    fenced = WigliCommand(
+        {
+            "keyword": "```python",
+            "run_function": lambda arg: [],
+            "parse_function": lambda span: {"messages": [span]},
+            "terminator": "```",
+            "batch": True,
+        },
+        [],
+    )
+    called = WigliCommand(
+        {
+            "keyword": "search_web(",
+            "run_function": lambda arg: [],
+            "parse_function": lambda span: {"messages": [span]},
+            "terminator": (")", "\n"),
+        },
+        [],
+    )
+    matcher = WigliCommandMatcher([fenced, called])
+    msg = """search_web(a) then
+```python
+search_web(b)
+```
+and search_web(c"""
+    spans = matcher.find(msg)
+    assert [msg[start:end] for start, end, _ in spans] == [
+        "search_web(a)",
+        "```python\nsearch_web(b)\n```",
+        "search_web(c",
+    ]
+
+
+def test_command_bot_caches_results(monkeypatch):
+    monkeypatch.setattr(openai, "api_key", "test")
+    log = []
+    cmd = make_cmd("delta:", log)
+    cmd["cacheable"] = True
+    cmd["cache_key"] = query_cache_key
+    bot = CommandBot(stream=False).And(cmd)
+
+    bot.Chat("delta:x\ndelta: X", nochat=True, reprompt=False)
+    assert log == ["x"]
+    bot.Chat("delta:x", nochat=True, reprompt=False)
+    assert log == ["x"]
+    bot.Chat("delta:x", nochat=True, reprompt=False, refresh=True)
+    assert log == ["x", "x"]
+
+    bot.cmd_cache.ttl = -1
+    bot.Chat("delta:x", nochat=True, reprompt=False)
+    assert log == ["x", "x", "x"]
+
+    # A call with no messages is a cache miss, not a failure
+    assert query_cache_key({"messages": []}) == ""
+
+
+def test_command_bot_abandons_hung_commands(monkeypatch):
+    monkeypatch.setattr(openai, "api_key", "test")
+    log = []
+    hung = make_cmd("hang:", log)
+    # Blocks until the bot gives up on it
+    hung["run_function"] = lambda arg: [] if arg["cancel"].wait(10) else []
+    hung["timeout"] = 0.2
+    bot = CommandBot(stream=False).And(hung).And(make_cmd("ok:", log))
+
+    results = bot.run_commands(bot.parse_commands("hang:a\nok:b"))
+    assert "TIMED OUT" in results[0][0].content
+    assert results[1][0].content == "ok:b"
+
+
+def test_usage_ledger_and_token_budget(monkeypatch, tmp_path):
+    import wigli._wigli_bots as bots
+    from wigli import WigliBot
+    from wigli._wigli_data import WigliData
+    from wigli._wigli_usage import set_token_budget
+
+    class Attrs(dict):
+        __getattr__ = dict.__getitem__
+
+    requests = []
+
+    def create(**kwargs):
+        # Every request uses 10 prompt and 2 completion tokens
+        requests.append(kwargs["messages"][-1]["content"])
+        return Attrs(
+            choices=[
+                Attrs(
+                    finish_reason="stop",
+                    message={
+                        "role": "assistant",
+                        "content": f"quack:{len(requests)}",
+                    },
+                )
+            ],
+            usage={"prompt_tokens": 10, "completion_tokens": 2},
+        )
+
+    def run(arg: dict) -> List[WigliMessage]:
+        # A command that asks another bot, like the summarizer does
+        reply = WigliBot(stream=False).Chat(f"sub{arg['messages'][0]}")
+        return [WigliMessage(reply, "system")]
+
+    cmd = make_cmd("quack:", [])
+    cmd["run_function"] = run
+    monkeypatch.setattr(openai, "api_key", "test")
+    monkeypatch.setattr(openai.ChatCompletion, "create", create)
+    monkeypatch.setattr(bots, "count_tokens", lambda messages, model: 10)
+    data = WigliData(lambda: 0, data_dir=str(tmp_path))
+
+    bot = CommandBot(data=data, title="Ducks", stream=False).And(cmd)
+    bot.Chat("Quack?")
+    # Each reply is a command, so only MAX_COMMANDS stops the loop
+    assert len(requests) > 4
+    ledger = data.usage_summary(by=("chat", "bot", "command"))
+    assert {(group["bot"], group["command"]) for group in ledger} == {
+        ("CommandBot", None),
+        ("WigliBot", "quack:"),
+    }
+    # Requests from the chat and its commands are all put under the chat
+    (chat,) = data.usage_summary(by=("chat",))
+    assert chat["chat"].endswith("_Ducks")
+    assert sum(group["tokens"] for group in ledger) == 12 * len(requests)
+    (day,) = data.usage_summary()
+    assert day["model"] == "gpt-3.5-turbo" and day["requests"] == len(requests)
+    assert day["cost"] == round(12 * len(requests) * 0.002 / 1000, 6)
+
+    # The budget stops the loop before a request could overspend it
+    requests.clear()
+    bot.Chat("Quack?", token_budget=40)
+    assert len(requests) == 3
+
+    set_token_budget(15)
+    try:
+        assert WigliBot(stream=False).Chat("Quack") == "quack:4"
+        assert WigliBot(stream=False).Chat("Quack") == (
+            WigliBot.BUDGET_MSG.format(limit=15)
+        )
+    finally:
+        set_token_budget(None)
+    assert len(requests) == 4
+
+
+def test_command_bot_reports_failed_commands(monkeypatch):
+    monkeypatch.setattr(openai, "api_key", "test")
+    log = []
+    broken = make_cmd("boom:", log)
+    broken["cacheable"] = True
+
+    def run(arg: dict) -> List[WigliMessage]:
+        log.append(arg["messages"][0])
+        raise ConnectionError("no route to host")
+
+    broken["run_function"] = run
+    bot = CommandBot(stream=False).And(broken).And(make_cmd("ok:", log))
+
+    results = bot.run_commands(bot.parse_commands("boom:a\nok:b"))
+    assert results[0][0].content == CommandBot.CMD_ERROR_MSG.format(
+        keyword="boom:", error="no route to host"
+    )
+    assert results[1][0].content == "ok:b"
+    # Failures aren't cached, so the next call tries again
+    bot.run_commands(bot.parse_commands("boom:a"))
+    assert log.count("a") == 2
+
+
+def test_streamed_replies_count_their_tokens(monkeypatch, tmp_path):
+    import wigli._wigli_bots as bots
+    from wigli import WigliBot
+    from wigli._wigli_data import WigliData
+
+    class Attrs(dict):
+        __getattr__ = dict.__getitem__
+
+    def create(**kwargs):
+        # Pieces of a stream can hold several tokens, or part of one
+        for piece in ["Quack quack", " qu", "ack!"]:
+            delta = Attrs(content=piece)
+            yield Attrs(choices=[Attrs(delta=delta, finish_reason=None)])
+
+    monkeypatch.setattr(openai, "api_key", "test")
+    monkeypatch.setattr(openai.ChatCompletion, "create", create)
+    monkeypatch.setattr(bots, "count_tokens", lambda messages, model: 10)
+    monkeypatch.setattr(
+        bots, "count_text_tokens", lambda text, model: len(text.split())
+    )
+    data = WigliData(lambda: 0, data_dir=str(tmp_path))
+
+    bot = WigliBot(data=data, title="Ducks", stream=True)
+    assert bot.Chat("Quack?") == "Quack quack quack!"
+    (day,) = data.usage_summary()
+    assert day["tokens"] == 10 + 3
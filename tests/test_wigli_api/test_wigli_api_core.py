@@ -90,3 +90,400 @@ def test_bot_from_file():
 #     response = file_bot.Chat("Hi what can I call you?")
 #     # file_bot says: "You can call me Wigli, what can I help you with?"
 #     assert "Wigli" in response
+
+
+def test_http_cache_revalidates_with_etag(tmp_path):
+    # Webpages are cached on disk and revalidated with conditional GETs
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from threading import Thread
+
+    from wigli._wigli_http import WigliHTTP, WigliHTTPCache
+
+    requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests.append(self.headers.get("If-None-Match"))
+            if self.headers.get("If-None-Match") == '"v1"':
+                self.send_response(304)
+                self.end_headers()
+                return
+            body = b"<html><body>Hello</body></html>"
+            self.send_response(200)
+            self.send_header("ETag", '"v1"')
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/"
+
+    try:
+        http = WigliHTTP(cache=WigliHTTPCache(str(tmp_path)))
+        assert http.get(url)[2] == b"<html><body>Hello</body></html>"
+        assert http.get(url)[2] == b"<html><body>Hello</body></html>"
+    finally:
+        server.shutdown()
+
+    assert requests == [None, '"v1"']
+    stats = http.cache.stats()
+    assert stats["misses"] == 1 and stats["revalidated"] == 1
+    assert stats["entries"] == 1
+
+
+def test_extract_text_keeps_main_content():
+    # Page chrome and scripts are dropped before text reaches the model
+    from wigli._wigli_tools import extract_text
+
+    html = """<html><head><style>p {}</style></head><body>
+    <nav>Home | About</nav><header>Site</header>
+    <main><h1>Title</h1><p>Hello   world</p><script>x = 1</script></main>
+    <footer>Copyright</footer></body></html>"""
+
+    assert extract_text(html) == "Title\nHello world"
+    assert extract_text(html, "html.parser") == "Title\nHello world"
+
+
+def test_compact_message_store(monkeypatch):
+    # compact=True keeps the chat history in a WigliMessageStore, which
+    # holds long chats in parallel arrays but reads like a list
+    import openai
+    from jsonpickle import decode, encode
+
+    from wigli._wigli_bots import WigliMessageStore
+
+    monkeypatch.setattr(openai, "api_key", "test")
+    bot = WigliBot.With("You are a duck.", compact=True)
+    bot.Chat("Quack?", nochat=True)
+    bot.And({"role": "assistant", "content": "Quack! 🦆"})
+    assert isinstance(bot.messages, WigliMessageStore)
+    assert [m.role for m in bot.messages] == ["system", "user", "assistant"]
+    assert bot.messages[-1].content == "Quack! 🦆"
+
+    bot.erase_messages(1)
+    assert isinstance(bot.messages, WigliMessageStore)
+    assert [m.content for m in bot.messages] == ["You are a duck.", "Quack?"]
+
+    copy_bot = WigliBot.FromBot(bot)
+    assert isinstance(copy_bot.messages, WigliMessageStore)
+    assert [m.content for m in copy_bot.messages] == ["You are a duck.", "Quack?"]
+
+    # Archived as plain messages
+    restored = decode(encode(bot))
+    assert [m.content for m in restored.messages] == ["You are a duck.", "Quack?"]
+
+
+def test_equal_injections_dedupe():
+    # Injections are equal when their messages' roles and contents are,
+    # whenever they were made, so adding one twice only keeps one
+    from wigli import WigliInjection
+
+    first = WigliInjection("Quack.", reminder_messages="Remember to quack.")
+    second = WigliInjection("Quack.", reminder_messages="Remember to quack.")
+    second.injection_messages[0].timestamp += 60
+
+    assert first == second and hash(first) == hash(second)
+    assert first != WigliInjection("Quack.")
+    assert first != WigliInjection("Quack.", role="user")
+    assert len({first, second, WigliInjection("Quack.")}) == 2
+
+
+def test_from_bot_forks_history(monkeypatch):
+    # FromBot shares the history up to the fork instead of copying it,
+    # and each bot's new messages only go to that bot
+    import openai
+
+    from wigli import CommandBot
+
+    monkeypatch.setattr(openai, "api_key", "test")
+    primed = CommandBot.With("You are a duck.")
+    for n in range(1000):
+        primed.And({"role": "user", "content": f"Quack {n}"})
+
+    # A plain WigliBot can't take a CommandBot's commands, so they stay
+    fork = WigliBot.FromBot(primed)
+    assert fork.messages[0] is primed.messages[0]
+    assert fork.messages[-1] is primed.messages[-1]
+
+    fork.Chat("Fork", nochat=True)
+    primed.Chat("Primed", nochat=True)
+    assert fork.messages[-1].content == "Fork"
+    assert primed.messages[-1].content == "Primed"
+    assert len(fork.messages) == len(primed.messages) == 1002
+
+    primed.erase_messages(500)
+    assert len(fork.messages) == 1002
+    assert fork.messages[900].content == "Quack 899"
+
+
+def test_erase_and_retry_branches_chat(monkeypatch, tmp_path):
+    # Erasing and chatting again starts a new branch of the chat's tree,
+    # which shares the messages before the edit and only saves new ones
+    import openai
+    from time import time
+
+    from wigli._wigli_data import WigliData
+    from wigli._wigli_tree import WigliChatTree
+
+    monkeypatch.setattr(openai, "api_key", "test")
+    data = WigliData(time, data_dir=str(tmp_path))
+    bot = WigliBot.With("You are a duck.", data=data, title="Duck")
+    bot.And({"role": "user", "content": "Quack?"})
+    bot.And({"role": "assistant", "content": "Quack!"})
+    assert bot.branch == 1
+
+    bot.erase_messages(1)
+    bot.And({"role": "assistant", "content": "Honk!"})
+    assert bot.branch == 2
+    assert len(data.list_chats()) == 1
+
+    tree = WigliChatTree(data.chat_tree(bot).path)
+    assert len(tree.nodes) == 4
+    assert [m.content for m in tree.messages(1)][-1] == "Quack!"
+    assert [m.content for m in tree.messages(2)][-1] == "Honk!"
+    assert [(b["length"], b["shared"]) for b in tree.list_branches()] == [
+        (3, 0),
+        (3, 2),
+    ]
+
+    # Resuming a branch carries on from where it ended
+    assert data.switch_branch(bot, 1)
+    bot.And({"role": "user", "content": "Again?"})
+    assert bot.branch == 1 and len(data.chat_tree(bot).nodes) == 5
+    assert [m.content for m in bot.messages][-2:] == ["Quack!", "Again?"]
+    assert not data.switch_branch(bot, 3)
+
+
+def test_archive_leaves_messages_in_the_tree(monkeypatch, tmp_path):
+    # The JSON archive only records where the chat is in its tree, and
+    # reading it back restores the messages from there
+    import openai
+    from time import time
+
+    from copy import deepcopy
+
+    from jsonpickle import decode, encode
+
+    from wigli import WigliMessage
+    from wigli._wigli_data import WigliData
+    from wigli._wigli_tree import WigliChatTree
+
+    monkeypatch.setattr(openai, "api_key", "test")
+    data = WigliData(time, data_dir=str(tmp_path))
+    bot = WigliBot.With("You are a duck.", data=data, title="Duck")
+    bot.And({"role": "user", "content": "Quack?"})
+    bot.And({"role": "assistant", "content": "Quack!"})
+
+    (filename,) = data.list_chats()
+    with open(join(data.convos_dir, filename)) as f:
+        assert "Quack!" not in f.read()
+    # Copies made outside the archive keep the messages
+    contents = ["You are a duck.", "Quack?", "Quack!"]
+    assert [m.content for m in deepcopy(bot).messages] == contents
+    assert [m.content for m in decode(encode(bot)).messages] == contents
+    chat = data.read_chat(filename)
+    assert [m.content for m in chat.messages] == contents
+
+    # Trees sharing a file read each other's nodes before adding their own
+    path = data.chat_tree(bot).path
+    first, second = WigliChatTree(path), WigliChatTree(path)
+    messages = list(chat.messages)
+    for tree, content in ((first, "Honk!"), (second, "Hiss!")):
+        with tree.locked():
+            tree.sync(messages[:2] + [WigliMessage(content, "assistant")])
+            tree.save()
+    tree = WigliChatTree(path)
+    assert len(tree.nodes) == 5
+    assert [m.content for m in tree.messages(max(tree.branches))] == [
+        "You are a duck.",
+        "Quack?",
+        "Hiss!",
+    ]
+
+
+def test_transcript_appends_new_messages(monkeypatch, tmp_path):
+    # Each message is formatted once, and saving the chat only appends
+    # the new messages to its transcript until messages are erased
+    import openai
+    from time import time
+
+    from wigli import WigliMessage
+    from wigli._wigli_data import WigliData
+    from wigli._wigli_tools import list_dir
+
+    formatted = []
+    md = WigliMessage.md
+
+    def counting_md(self, *args, **kwargs):
+        formatted.append(self.content)
+        return md(self, *args, **kwargs)
+
+    monkeypatch.setattr(openai, "api_key", "test")
+    monkeypatch.setattr(WigliMessage, "md", counting_md)
+    data = WigliData(time, data_dir=str(tmp_path))
+    bot = WigliBot.With("You are a duck.", data=data, title="Duck")
+    for n in range(3):
+        bot.And({"role": "user", "content": f"Quack {n}"})
+    assert formatted == ["You are a duck.", "Quack 0", "Quack 1", "Quack 2"]
+
+    def transcript():
+        (filename,) = list_dir(data.scripts_dir)
+        with open(join(data.scripts_dir, filename), encoding="utf-16") as f:
+            return f.read()
+
+    assert transcript() == bot.format_transcript_markdown()
+    assert transcript().count("Quack 2") == 1
+
+    bot.erase_messages(2)
+    formatted.clear()
+    bot.And({"role": "user", "content": "Honk"})
+    assert formatted == ["You are a duck.", "Quack 0", "Honk"]
+    assert transcript() == bot.format_transcript_markdown()
+    assert "Quack 1" not in transcript()
+    assert bot.format_transcript_markdown(limit=1).endswith("> Honk")
+
+    # A later process resuming the chat only appends to the transcript
+    (filename,) = data.list_chats()
+    resumed = WigliData(time, data_dir=str(tmp_path)).read_chat(filename)
+    resumed.data = data
+    formatted.clear()
+    resumed.And({"role": "user", "content": "Hiss"})
+    assert formatted == ["Hiss"]
+    assert transcript() == resumed.format_transcript_markdown()
+
+
+def test_archiver_holds_saves_until_released():
+    # Saves asked for during a turn wait for it, then run once
+    from threading import Event
+
+    from wigli._wigli_data import WigliArchiver
+
+    saved = []
+    done = Event()
+
+    def save(bot):
+        saved.append(list(bot))
+        done.set()
+
+    archiver = WigliArchiver(save, print)
+    bot = ["Quack?"]
+    archiver.hold()
+    archiver.request(bot)
+    bot.append("Quack!")
+    archiver.request(bot)
+    assert not done.wait(0.2)
+    archiver.release()
+    archiver.flush()
+    archiver.close()
+    assert saved == [["Quack?", "Quack!"]]
+
+
+def test_rate_limiter_spaces_requests():
+    from time import monotonic
+
+    from wigli._wigli_bots import WigliRateLimiter
+
+    limiter = WigliRateLimiter(per_minute=600, burst=2)
+    started = monotonic()
+    for _ in range(4):
+        limiter.acquire()
+    # Two go through at once, then one every tenth of a second
+    assert 0.15 < monotonic() - started < 1
+
+    # Without a limit nothing waits
+    limiter = WigliRateLimiter()
+    started = monotonic()
+    for _ in range(100):
+        limiter.acquire()
+    assert monotonic() - started < 0.1
+
+
+def test_profile_hooks(monkeypatch, tmp_path):
+    import openai
+
+    from wigli._wigli_data import WigliData
+    from wigli._wigli_profile import WigliProfile, add_hook, remove_hook
+
+    monkeypatch.setattr(openai, "api_key", "test")
+    data = WigliData(lambda: 0, data_dir=str(tmp_path))
+    bot = WigliBot(data=data, title="Ducks")
+
+    spans = []
+    hook = lambda name, seconds, attrs: spans.append((name, seconds))
+    add_hook(hook)
+    with WigliProfile() as profile:
+        bot.And({"role": "user", "content": "Quack"})
+    remove_hook(hook)
+    names = [name for name, _ in spans]
+    assert {"data.archive", "data.tree", "data.write"} <= set(names)
+    assert all(seconds >= 0 for _, seconds in spans)
+    assert "data.archive" in profile.format()
+
+    # Without hooks, nothing is recorded
+    bot.And({"role": "user", "content": "Quack again"})
+    assert len(spans) == len(names)
+
+
+def test_completion_metrics(monkeypatch, tmp_path):
+    import openai
+
+    import wigli._wigli_bots as bots
+    from wigli._wigli_data import WigliData
+
+    class Attrs(dict):
+        __getattr__ = dict.__getitem__
+
+    def create(stream=False, **kwargs):
+        if not stream:
+            return Attrs(
+                choices=[
+                    Attrs(
+                        finish_reason="stop",
+                        message={"role": "assistant", "content": "Quack"},
+                    )
+                ],
+                usage={"prompt_tokens": 12, "completion_tokens": 1},
+            )
+        pieces = ["Qu", "ack", " quack"]
+        return [
+            Attrs(
+                choices=[
+                    Attrs(
+                        delta=Attrs(content=piece),
+                        finish_reason="stop" if n == len(pieces) - 1 else None,
+                    )
+                ]
+            )
+            for n, piece in enumerate(pieces)
+        ]
+
+    monkeypatch.setattr(openai, "api_key", "test")
+    monkeypatch.setattr(openai.ChatCompletion, "create", create)
+    monkeypatch.setattr(bots, "count_tokens", lambda messages, model: 10)
+    monkeypatch.setattr(
+        bots, "count_text_tokens", lambda text, model: len(text.split())
+    )
+    data = WigliData(lambda: 0, data_dir=str(tmp_path))
+    bot = WigliBot(data=data, title="Ducks")
+
+    assert bot.Chat("Quack?", stream=True) == "Quack quack"
+    assert bot.Chat("Quack?", stream=False) == "Quack"
+    streamed, whole = bot.completions
+    # The streamed reply is counted, not its pieces
+    assert streamed["stream"] and streamed["completion_tokens"] == 2
+    assert streamed["prompt_tokens"] == 10
+    assert streamed["first_token"] <= streamed["seconds"]
+    assert streamed["inter_token_p50"] is not None
+    assert not whole["stream"] and whole["first_token"] is None
+    assert whole["prompt_tokens"] == 12 and whole["finish_reason"] == "stop"
+
+    (stats,) = data.completion_stats()
+    assert stats["model"] == "gpt-3.5-turbo" and stats["bot"] == "WigliBot"
+    assert stats["calls"] == 2 and stats["completion_tokens"] == 3
+    assert stats["seconds"][99] >= stats["seconds"][50]
+    assert data.completion_stats(since=whole["timestamp"] + 1) == []
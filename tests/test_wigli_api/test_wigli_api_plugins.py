@@ -187,3 +187,307 @@ def test_python_bot():
         "print(" in python_wiglibot.messages[7].content
         and "WigliBot" in python_wiglibot.messages[7].content
     )
+
+
+def test_search_digest_summarizes_pages_in_parallel(monkeypatch):
+    # search_digest downloads and summarizes every result page at once.
+    # A slow download falls back to its search snippet instead of
+    # stalling the rest, but a slow summary doesn't.
+    from threading import Barrier
+    from time import sleep
+
+    from wigli import _wigli_plugins
+
+    results = [
+        {"title": f"Page {n}", "href": f"page{n}.com", "body": f"Snippet {n}"}
+        for n in range(3)
+    ]
+    barrier = Barrier(2)
+    summarized = []
+
+    def download_page(url, timeout=None):
+        if url == "page2.com":
+            sleep(2)
+        return url
+
+    def summarize_text(text, query, cancel=None, **kwargs):
+        # Both fast pages must be in flight at the same time
+        barrier.wait(timeout=5)
+        sleep(0.5)
+        summarized.append(text)
+        return f"Summary of {text}"
+
+    monkeypatch.setattr(_wigli_plugins, "ddg", lambda query: results)
+    monkeypatch.setattr(_wigli_plugins, "download_page", download_page)
+    monkeypatch.setattr(_wigli_plugins, "summarize_text", summarize_text)
+    monkeypatch.setattr(_wigli_plugins, "PAGE_TIMEOUT", 0.3)
+
+    arg = {"messages": ['"wigli"']}
+    digest = _wigli_plugins._cmd_run_search_digest(arg)[0].content
+    assert "Summary of page0.com" in digest
+    assert "Summary of page1.com" in digest
+    assert "Snippet 2" in digest and "Snippet 0" not in digest
+    # The snippet fallback keeps the digest out of the cache
+    assert arg["cacheable"] is False
+    sleep(2)
+    assert sorted(summarized) == ["page0.com", "page1.com"]
+
+
+def test_cancelled_summaries_make_no_requests(monkeypatch):
+    from threading import Event
+
+    from wigli import _wigli_plugins
+
+    requests = []
+    monkeypatch.setattr(_wigli_plugins, "count_tokens", lambda prompt: 0)
+    monkeypatch.setattr(
+        _wigli_plugins,
+        "OneShotBot",
+        lambda prompt, stream=False: requests.append(prompt) or "",
+    )
+    cancel = Event()
+    cancel.set()
+    assert _wigli_plugins.summarize_text("text", cancel=cancel) is None
+    assert requests == []
+
+
+def test_summarize_long_page_in_chunks(monkeypatch):
+    # A page too long for one prompt is summarized in parts concurrently,
+    # and the partial summaries are combined in a final call
+    from threading import Barrier
+
+    from wigli import _wigli_plugins
+
+    barrier = Barrier(3)
+    prompts = []
+
+    def one_shot_bot(prompt, stream=False):
+        text = prompt[-1]["content"]
+        prompts.append(text)
+        if "partial summaries" in text:
+            return "Combined summary"
+        if "This is only part" in text:
+            # Every chunk must be in flight at the same time
+            barrier.wait(timeout=5)
+        return f"Summary of {text.split()[-1]}"
+
+    monkeypatch.setattr(
+        _wigli_plugins, "scrape_html_text", lambda url, timeout: "a|b|c"
+    )
+    monkeypatch.setattr(_wigli_plugins, "count_tokens", lambda prompt: 0)
+    monkeypatch.setattr(
+        _wigli_plugins,
+        "split_tokens",
+        lambda text, max_tokens: text.split("|"),
+    )
+    monkeypatch.setattr(_wigli_plugins, "OneShotBot", one_shot_bot)
+
+    summary = _wigli_plugins.summarize_page("long.com", "ducks")
+    assert summary == "Combined summary"
+    assert len(prompts) == 4
+    combined = prompts[-1]
+    assert combined.index("Summary of a") < combined.index("Summary of b")
+    assert combined.index("Summary of b") < combined.index("Summary of c")
+
+    # With a single chunk the rest of the page is cut off
+    prompts.clear()
+    _wigli_plugins.summarize_page("long.com", "ducks", max_chunks=1)
+    assert len(prompts) == 1 and prompts[0].endswith("\n\na")
+
+
+def test_summarize_url_cache_keys(monkeypatch):
+    # Questions are normalized but URLs are kept exactly, and pages that
+    # can't be read fail instead of being summarized and cached
+    from wigli import _wigli_plugins
+    from wigli._wigli_bots import WigliCommandCache
+    from wigli._wigli_tools import SCRAPE_ERR_MSG
+
+    bot = CommandBot(stream=False).And(_wigli_plugins.cmd_summarize_url)
+    (cmd,) = bot.active_cmds
+
+    def key(call):
+        (invocation,) = bot.parse_commands(call)
+        return WigliCommandCache.make_key(cmd, invocation[1])
+
+    assert key("summarize_url(x.com/Foo ducks)") == key(
+        "summarize_url(x.com/Foo,  DUCKS)"
+    )
+    assert key("summarize_url(x.com/Foo)") != key("summarize_url(x.com/foo)")
+
+    monkeypatch.setattr(
+        _wigli_plugins,
+        "scrape_html_text",
+        lambda url, timeout: SCRAPE_ERR_MSG,
+    )
+    (result,) = bot.run_commands(bot.parse_commands("summarize_url(x.com)"))
+    assert result[0].content.startswith("[ERROR: COMMAND summarize_url(")
+    assert len(bot.cmd_cache.entries) == 0
+
+
+def test_python_kernel_keeps_state_between_blocks(monkeypatch):
+    # PythonBot runs code blocks in one interpreter per chat session, so
+    # later blocks can use earlier variables, and a hung block only
+    # costs a restart
+    from wigli import _wigli_plugins
+    from wigli._wigli_kernel import close_kernel, get_kernel
+
+    monkeypatch.setattr(_wigli_plugins, "get_user_input", lambda prompt: "y")
+
+    def run_block(code, timeout=None):
+        return _wigli_plugins._cmd_run_python(
+            {"messages": [code], "session": "test", "timeout": timeout}
+        )[0].content
+
+    try:
+        assert run_block("import math\nx = math.pi") == ""
+        assert run_block("print(round(x, 2))") == "3.14\n"
+        assert "ZeroDivisionError" in run_block("print(1 / 0)")
+        assert run_block("print(x > 3)") == "True\n"
+
+        output = run_block("while True: pass", timeout=0.5)
+        assert "TIMED OUT AFTER 0.5 SECONDS" in output
+        assert "NameError" in run_block("print(x)")
+        assert get_kernel("test").restarts == 1
+    finally:
+        close_kernel("test")
+
+
+def test_least_recently_used_kernels_are_shut_down(monkeypatch):
+    # A long-lived process keeps at most KERNEL_CACHE_SIZE interpreters
+    from wigli import _wigli_kernel
+    from wigli._wigli_kernel import close_kernel, get_kernel
+
+    monkeypatch.setattr(_wigli_kernel, "KERNEL_CACHE_SIZE", 2)
+    try:
+        first = get_kernel("first")
+        assert first.execute("x = 1") == ("", "ok")
+        get_kernel("second")
+        assert get_kernel("first") is first
+        # "second" was used longer ago, so it goes first
+        get_kernel("third")
+        assert first.alive
+        get_kernel("second")
+        assert not first.alive
+    finally:
+        for session in ("first", "second", "third"):
+            close_kernel(session)
+
+
+def test_python_cells_from_forked_bots_take_turns():
+    # Bots forked from one chat share its kernel, and cells sent at once
+    # each get back only their own output
+    from threading import Thread
+
+    from wigli._wigli_kernel import WigliKernel
+
+    kernel = WigliKernel()
+    results = {}
+
+    def run(tag):
+        code = f"import time\nfor _ in range(5):\n    print({tag!r})\n"
+        code += "    time.sleep(0.01)"
+        results[tag] = kernel.execute(code, timeout=30)
+
+    try:
+        threads = [Thread(target=run, args=(tag,)) for tag in "ab"]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        kernel.shutdown()
+    assert results == {tag: (f"{tag}\n" * 5, "ok") for tag in "ab"}
+
+
+def test_python_limits_are_reported(monkeypatch):
+    # Code blocks that use too much CPU time or memory are stopped, and
+    # the bot is told which limit it hit
+    import pytest
+
+    pytest.importorskip("resource")
+    from wigli import _wigli_plugins
+    from wigli._wigli_kernel import close_kernel
+
+    monkeypatch.setattr(_wigli_plugins, "get_user_input", lambda prompt: "y")
+    monkeypatch.setattr(_wigli_plugins, "PYTHON_CPU_LIMIT", 1)
+    monkeypatch.setattr(_wigli_plugins, "PYTHON_MEMORY_LIMIT", 2**30)
+
+    def run_block(code):
+        return _wigli_plugins._cmd_run_python(
+            {"messages": [code], "session": "limits", "timeout": 30}
+        )[0].content
+
+    try:
+        run_block("x = 1")
+        assert "1 SECONDS OF CPU TIME" in run_block("while True: pass")
+        assert "RAN OUT OF MEMORY" in run_block("y = bytearray(2**31)")
+        # Neither limit costs the interpreter its variables
+        assert run_block("print(x)") == "1\n"
+    finally:
+        close_kernel("limits")
+
+
+def test_python_output_streams_while_running(capsys):
+    # Output reaches the terminal as the code prints it, not when it ends
+    from time import time
+
+    from wigli._wigli_kernel import WigliKernel
+
+    kernel = WigliKernel()
+    try:
+        cell = kernel.stream("print('started')\nimport time\ntime.sleep(30)")
+        started = time()
+        assert next(cell) == "started"
+        assert time() - started < 10
+        # Abandoning a running cell stops the worker
+        cell.close()
+        assert not kernel.alive
+
+        # Only the start and end of a chatty cell are kept
+        output, status = kernel.execute(
+            "for i in range(10**5): print(i)",
+            on_output=lambda text: print(text, end=""),
+            max_output=100,
+        )
+        assert status == "ok"
+        assert output.startswith("0\n1\n2\n")
+        assert output.endswith("99998\n99999\n")
+        assert "CHARACTERS OF OUTPUT OMITTED" in output
+        assert capsys.readouterr().out.endswith("99998\n99999\n")
+    finally:
+        kernel.shutdown()
+
+
+def test_python_fd_output_stays_with_its_cell():
+    # Output written straight to the file descriptors is read on another
+    # thread, but still arrives before its cell ends
+    from wigli._wigli_kernel import WigliKernel
+
+    kernel = WigliKernel()
+    try:
+        for n in range(20):
+            output, status = kernel.execute(
+                f"import os\nos.write(2, b'err{n}' * 1000)\nos.write(1, b'out{n}')"
+            )
+            assert status == "ok"
+            assert output == f"err{n}" * 1000 + f"out{n}"
+    finally:
+        kernel.shutdown()
+
+
+def test_truncate_tokens_counts_short_text_with_wide_characters(monkeypatch):
+    # A handful of emoji can be many more tokens than characters
+    from wigli import _wigli_tools
+
+    class Bytes(object):
+        # One token per UTF-8 byte, the most any text can take
+        def encode(self, text):
+            return list(text.encode())
+
+        def decode(self, tokens):
+            return bytes(tokens).decode(errors="ignore")
+
+    monkeypatch.setattr(_wigli_tools, "_encoding", lambda model: Bytes())
+    assert _wigli_tools.truncate_tokens("ok", 8) == "ok"
+    truncated = _wigli_tools.truncate_tokens("🦆" * 5, 8)
+    assert truncated.count("🦆") == 2 and "12 TOKENS OMITTED" in truncated
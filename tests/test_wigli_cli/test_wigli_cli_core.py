@@ -1,4 +1,5 @@
-from os.path import join
+from os import stat
+from os.path import exists, join
 from shutil import copy2, move
 from unittest.mock import MagicMock
 
@@ -140,3 +141,375 @@ def test_cli_system(capsys):
         out_assert="Wigli",
         capsys=capsys,
     )
+
+
+def test_cli_transcript_limit_since_output(capsys, monkeypatch, tmp_path):
+    # --limit N             only print the last N messages of the transcript
+    # --since TIME          only print transcript messages sent since a timestamp or ISO date
+    # --output FILE         write the transcript to FILE instead of printing it
+    # --profile             print how long each phase of the command took
+    import openai
+
+    from wigli import WigliBot
+    from wigli._wigli_cli import wigli_cli
+    from wigli._wigli_data import WigliData
+
+    monkeypatch.setattr(openai, "api_key", "test")
+    data = WigliData(lambda: 0, data_dir=str(tmp_path))
+    bot = WigliBot(data=data, title="Ducks")
+    for n in range(5):
+        bot.And({"role": "user", "content": f"Quack {n}"})
+    capsys.readouterr()
+    for n, message in enumerate(bot.messages):
+        message.timestamp = 1680000000.0 + n * 60
+    data.archive_chat(bot)
+
+    wigli_cli(["-r", "-T", "--limit", "2"], data_dir=str(tmp_path))
+    out = capsys.readouterr().out
+    assert "Quack 2" not in out and "> Quack 3" in out and "> Quack 4" in out
+
+    wigli_cli(
+        ["-r", "-T", "--since", "1680000120", "--limit", "5"],
+        data_dir=str(tmp_path),
+    )
+    out = capsys.readouterr().out
+    assert "Quack 1" not in out and out.count("[user]") == 3
+
+    wigli_cli(["-r", "-T", "--profile"], data_dir=str(tmp_path))
+    err = capsys.readouterr().err
+    assert "cli.load_chat" in err and "data.read_chat" in err
+
+    output = tmp_path / "transcript.txt"
+    wigli_cli(["-r", "-T", "--output", str(output)], data_dir=str(tmp_path))
+    assert capsys.readouterr().out == ""
+    assert output.read_text(encoding="utf-8") == bot.format_transcript() + "\n"
+
+
+def test_cli_version_skips_heavy_imports(tmp_path):
+    # -V only needs the version, so the OpenAI client, tokenizer, HTML
+    # parser and archive format aren't imported at all
+    from subprocess import run
+    from sys import executable
+
+    heavy = ["openai", "tiktoken", "bs4", "urllib3", "jsonpickle", "dotenv"]
+    code = f"""\
+import sys
+from wigli._wigli_cli import wigli_cli
+wigli_cli(["-V"], data_dir={str(tmp_path)!r})
+print(sorted(name for name in {heavy!r} if name in sys.modules))
+"""
+    result = run([executable, "-c", code], capture_output=True, text=True)
+    assert "You are using Wigli v" in result.stdout
+    assert result.stdout.strip().endswith("[]")
+
+
+def test_cli_serve_forwards_commands(capsys, monkeypatch, tmp_path):
+    # --serve               run a daemon that keeps Wigli loaded, so later commands start instantly
+    from subprocess import Popen
+    from sys import executable
+    from time import sleep
+
+    import openai
+
+    from wigli import WigliBot
+    from wigli._wigli_daemon import forward, socket_path
+    from wigli._wigli_data import WigliData
+
+    # Without a daemon, commands run in the calling process
+    assert forward(["-V"], data_dir=str(tmp_path)) is None
+
+    monkeypatch.setattr(openai, "api_key", "test")
+    data = WigliData(lambda: 0, data_dir=str(tmp_path))
+    bot = WigliBot(data=data, title="Ducks")
+    bot.And({"role": "user", "content": "Quack"})
+    capsys.readouterr()
+
+    daemon = Popen(
+        [
+            executable,
+            "-c",
+            "from wigli._wigli_cli import wigli_cli; "
+            f"wigli_cli(['--serve'], data_dir={str(tmp_path)!r})",
+        ]
+    )
+    try:
+        for _ in range(100):
+            if forward(["-V"], data_dir=str(tmp_path)) is not None:
+                break
+            sleep(0.1)
+        assert "You are using Wigli v" in capsys.readouterr().out
+
+        # Loaded chats stay cached, and each command gets its own copy
+        assert forward(["-r", "-e", "1", "-T"], data_dir=str(tmp_path)) == 0
+        assert capsys.readouterr().out == "\n"
+        assert forward(["-r", "-T"], data_dir=str(tmp_path)) == 0
+        assert "> Quack" in capsys.readouterr().out
+
+        assert forward(["--bogus"], data_dir=str(tmp_path)) == 2
+        assert "required: prompt" in capsys.readouterr().err
+        # Only this user can connect
+        assert stat(socket_path(str(tmp_path))).st_mode & 0o077 == 0
+    finally:
+        daemon.terminate()
+        daemon.wait(10)
+    assert not exists(socket_path(str(tmp_path)))
+
+
+def test_daemon_commands_run_with_their_clients_env_and_output(monkeypatch):
+    import sys
+    from io import BytesIO, StringIO
+    from json import loads
+    from threading import Thread
+
+    import openai
+
+    from wigli._wigli_daemon import _RoutedStream, _run_request
+
+    own = StringIO()
+    monkeypatch.setattr(openai, "api_key", "daemon")
+    monkeypatch.setattr(sys, "stdout", _RoutedStream("stdout", own))
+
+    def run(argv):
+        print(openai.api_key)
+        # Threads that aren't the command's print to the daemon's output
+        other = Thread(target=print, args=("daemon output",))
+        other.start()
+        other.join()
+
+    wfile = BytesIO()
+    request = {"argv": [], "env": {"OPENAI_API_KEY": "client"}}
+    _run_request(run, request, BytesIO(), wfile)
+    messages = [loads(line) for line in wfile.getvalue().splitlines()]
+    assert "".join(m.get("out", "") for m in messages) == "client\n"
+    assert messages[-1] == {"exit": 0}
+    assert own.getvalue() == "daemon output\n"
+    assert openai.api_key == "daemon"
+
+
+def test_daemon_commands_dont_change_later_commands_limits(tmp_path):
+    from io import BytesIO
+
+    import wigli._wigli_plugins as plugins
+    from wigli._wigli_bots import get_rate_limiter
+    from wigli._wigli_cli import wigli_cli
+    from wigli._wigli_daemon import _run_request
+
+    memory_limit = plugins.PYTHON_MEMORY_LIMIT
+    rate_limit = get_rate_limiter().per_minute
+    argv = ["--rate", "1", "--python-memory", "64", "--budget", "10", "--stats"]
+    _run_request(
+        lambda argv: wigli_cli(argv_=argv, data_dir=str(tmp_path)),
+        {"argv": argv},
+        BytesIO(),
+        BytesIO(),
+    )
+    assert plugins.PYTHON_MEMORY_LIMIT == memory_limit
+    assert get_rate_limiter().per_minute == rate_limit
+
+
+def test_cli_batch(capsys, monkeypatch, tmp_path):
+    # --batch FILE          run each prompt in a JSON lines file (- for stdin) in a new chat
+    # --order {input,completion}
+    # --lean                don't save batch prompts as chats, skipping titles and transcripts
+    from json import dumps, loads
+    from time import sleep
+
+    import openai
+
+    from wigli import WigliBot
+    from wigli._wigli_cli import wigli_cli
+    from wigli._wigli_data import WigliData
+
+    def fake_chat(self, prompt=None, **kwargs):
+        # The first prompt finishes last
+        sleep(0.3 if prompt == "Quack 0" else 0)
+        self._record_usage("gpt-3.5-turbo", 10, 2)
+        systems = [m.content for m in self.messages if m.role == "system"]
+        return " ".join(systems + [prompt.upper()])
+
+    monkeypatch.setattr(openai, "api_key", "test")
+    monkeypatch.setattr(WigliBot, "Chat", fake_chat)
+    prompts = tmp_path / "prompts.jsonl"
+    prompts.write_text(
+        "\n".join(
+            [
+                dumps("Quack 0"),
+                dumps({"id": "b", "prompt": "Quack 1", "system": "Duck!"}),
+                "",
+                "not json",
+                dumps({"prompt": "Quack 3", "plugins": ["--no-such-plugin"]}),
+            ]
+        )
+    )
+
+    results = tmp_path / "results.jsonl"
+    wigli_cli(
+        ["--batch", str(prompts), "--lean", "--output", str(results)],
+        data_dir=str(tmp_path),
+    )
+    assert "Ran 4 prompts" in capsys.readouterr().err
+    records = [loads(line) for line in results.read_text().splitlines()]
+    assert [record["index"] for record in records] == [0, 1, 2, 3]
+    assert records[0]["response"] == "QUACK 0"
+    assert records[1]["id"] == "b" and records[1]["response"] == "Duck! QUACK 1"
+    assert "NOT JSON" in records[2]["error"]
+    assert "no-such-plugin" in records[3]["error"]
+    # Lean items still go in the usage ledger
+    (day,) = WigliData(lambda: 0, data_dir=str(tmp_path)).usage_summary()
+    assert day["requests"] == 2 and day["tokens"] == 24
+
+    wigli_cli(
+        ["--batch", str(prompts), "--lean", "--order", "completion"],
+        data_dir=str(tmp_path),
+    )
+    records = [loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert sorted(record["index"] for record in records) == [0, 1, 2, 3]
+    assert records[-1]["index"] == 0
+
+    # Lean batches aren't saved as chats
+    assert list_dir(join(str(tmp_path), "Wigli Files")) == []
+
+
+def test_cli_interactive(capsys, monkeypatch, tmp_path):
+    # -I, --interactive     chat back and forth in one session, with /help for commands
+    from io import StringIO
+
+    import openai
+
+    from wigli import WigliBot, WigliMessage
+    from wigli._wigli_cli import wigli_cli
+    from wigli._wigli_data import WigliData
+
+    def fake_chat(self, prompt=None, **kwargs):
+        self.And(prompt, role="user")
+        self.And(WigliMessage(f"{prompt} back", "assistant"))
+        return f"{prompt} back"
+
+    monkeypatch.setattr(openai, "api_key", "test")
+    monkeypatch.setattr(WigliBot, "Chat", fake_chat)
+    data = WigliData(lambda: 0, data_dir=str(tmp_path))
+    bot = WigliBot(data=data, title="Ducks")
+    bot.And({"role": "user", "content": "Quack"})
+    capsys.readouterr()
+
+    session = [
+        "/plugins",
+        "Quack 1",
+        "Quack 2",
+        "/erase 2",
+        "/plugin python",
+        "/plugins",
+        "/bogus",
+        "/transcript",
+        "/quit",
+        "Never sent",
+    ]
+    monkeypatch.setattr("sys.stdin", StringIO("\n".join(session) + "\n"))
+    wigli_cli(["-r", "-I", "-x"], data_dir=str(tmp_path))
+    out = capsys.readouterr().out
+    listings = [line for line in out.splitlines() if "python (-x" in line]
+    assert listings[0].startswith("* ") and listings[1].startswith("  ")
+    assert "Turned python off" in out
+    assert "UNKNOWN COMMAND /bogus" in out
+    transcript = out[out.index("Turned python off") :]
+    assert "> Quack 1 back" in transcript and "Quack 2" not in transcript
+
+    # The chat was saved in the background before the session ended
+    chat = data.read_chat(data.list_chats()[-1])
+    contents = [message.content for message in chat.messages]
+    assert "Quack 1 back" in contents and "Quack 2" not in contents
+    assert "Never sent" not in contents
+    assert not any(cmd.keyword == "```python" for cmd in chat.active_cmds)
+
+
+def test_cli_stats(capsys, tmp_path):
+    # --stats               print latency and throughput percentiles of past completions
+    from wigli._wigli_cli import wigli_cli
+    from wigli._wigli_data import WigliData
+
+    wigli_cli(["--stats"], data_dir=str(tmp_path))
+    assert "No completions recorded yet" in capsys.readouterr().out
+
+    data = WigliData(lambda: 0, data_dir=str(tmp_path))
+    for n in range(1, 101):
+        data.record_completion(
+            {
+                "timestamp": 1680000000.0 + n,
+                "model": "gpt-3.5-turbo",
+                "bot": "PythonBot",
+                "stream": True,
+                "seconds": n / 10,
+                "first_token": n / 100,
+                "inter_token_p50": 0.02,
+                "inter_token_p95": 0.05,
+                "inter_token_p99": 0.09,
+                "prompt_tokens": 100,
+                "completion_tokens": 10,
+                "finish_reason": "stop",
+            }
+        )
+    wigli_cli(["--stats"], data_dir=str(tmp_path))
+    out = capsys.readouterr().out
+    assert "gpt-3.5-turbo, PythonBot: 100 calls" in out
+    total = next(line for line in out.splitlines() if "total" in line)
+    assert total.split() == ["total", "5000.0ms", "9500.0ms", "9900.0ms"]
+
+    wigli_cli(["--stats", "--since", "1680000091"], data_dir=str(tmp_path))
+    assert "PythonBot: 10 calls" in capsys.readouterr().out
+
+
+def test_cli_usage_and_budget(capsys, monkeypatch, tmp_path):
+    # --usage [BY]          print the tokens spent, grouped by a comma-separated list of
+    # --budget N            stop before this command's requests spend more than N tokens
+    import openai
+    import pytest
+
+    import wigli._wigli_bots as bots
+    from wigli import WigliBot
+    from wigli._wigli_cli import wigli_cli
+    from wigli._wigli_data import WigliData
+
+    wigli_cli(["--usage"], data_dir=str(tmp_path))
+    assert "No usage recorded yet" in capsys.readouterr().out
+
+    data = WigliData(lambda: 0, data_dir=str(tmp_path))
+    for n, model in enumerate(["gpt-4", "gpt-4", "gpt-3.5-turbo"]):
+        data.record_usage(
+            {
+                "timestamp": 1680000000.0 + n,
+                "model": model,
+                "chat": "1680000000.0_Ducks",
+                "birthstamp": 1680000000.0,
+                "bot": "SearchBot",
+                "command": "search_web(" if n == 1 else None,
+                "prompt_tokens": 1000,
+                "completion_tokens": 500,
+                "cost": None,
+            }
+        )
+    wigli_cli(["--usage", "model"], data_dir=str(tmp_path))
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].split() == [
+        "model",
+        "requests",
+        "prompt",
+        "completion",
+        "total",
+        "cost",
+    ]
+    assert lines[2].split()[:5] == ["gpt-4", "2", "2000", "1000", "3000"]
+
+    wigli_cli(["--usage", "command"], data_dir=str(tmp_path))
+    assert "search_web(" in capsys.readouterr().out
+    with pytest.raises(SystemExit):
+        wigli_cli(["--usage", "color"], data_dir=str(tmp_path))
+    assert "can't group usage by 'color'" in capsys.readouterr().err
+
+    # The prompt alone would take the chat over its budget
+    monkeypatch.setattr(openai, "api_key", "test")
+    monkeypatch.setattr(bots, "count_tokens", lambda messages, model: 10)
+    bot = WigliBot(data=data, title="Ducks")
+    bot.And({"role": "user", "content": "Quack"})
+    capsys.readouterr()
+    wigli_cli(["-r", "-m", "--budget", "5"], data_dir=str(tmp_path))
+    assert WigliBot.BUDGET_MSG.format(limit=5) in capsys.readouterr().out
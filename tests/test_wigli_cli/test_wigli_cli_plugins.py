@@ -1,5 +1,7 @@
 from os.path import join
 from shutil import copy2, move
+from subprocess import run
+from sys import executable
 from unittest.mock import MagicMock
 
 from wigli._wigli_plugins import get_user_input
@@ -9,6 +11,51 @@ from wigli._wigli_tools import list_dir, remove_file
 # These are some examples of the usage of the Wigli CLI with plugins
 
 
+def test_cli_list_installed_plugins(capsys):
+    # -L, --list-installed-plugins list installed plugins
+    cli_tester(
+        [["-L"], ["--list-installed-plugins"]],
+        out_assert=["--professor", "--python", "--search"],
+        capsys=capsys,
+    )
+
+
+def test_cli_plugins_import_lazily():
+    # Listing plugins must not import any of them
+    p = run(
+        [
+            executable,
+            "-c",
+            "import sys; from wigli._wigli_cli import wigli_cli; "
+            f"wigli_cli(['-L'], data_dir={join(get_test_dir(), 'dynamic_data_dir')!r}); "
+            "print('wigli._wigli_plugins' in sys.modules)",
+        ],
+        capture_output=True,
+        text=True,
+    )
+    assert p.stdout.strip().endswith("False")
+
+
+def test_cli_plugin_flags_cant_set_core_options(capsys):
+    # A plugin flag that clashes is skipped with a warning, and one named
+    # like a core option's dest doesn't set that option
+    from wigli._wigli_argparser import fetch_args
+    from wigli._wigli_registry import BUILTIN_PLUGINS, plugin_dest
+
+    def plugin(name: str, flags: list) -> dict:
+        return {"name": name, "flags": flags, "description": name}
+
+    plugins = BUILTIN_PLUGINS + [
+        plugin("clash", ["-x"]),
+        plugin("stats", ["--web_cache_stats"]),
+    ]
+    args = fetch_args(["--web_cache_stats", "Quack"], plugins)
+    assert "PLUGIN clash WAS SKIPPED" in capsys.readouterr().err
+    assert getattr(args, plugin_dest(plugins[-1]))
+    assert not args.web_cache_stats
+    assert not getattr(args, plugin_dest(BUILTIN_PLUGINS[1]))
+
+
 def test_cli_doctest(capsys):
     # --doctest             interpret prompt as a Python function and invoke the headless DocTest bot
     cli_tester(